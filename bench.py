@@ -0,0 +1,1442 @@
+"""Бенчмарки Control Europe
+
+Запуск: python bench.py <сценарий> [параметры]
+Все файлы создаются во временной папке, рабочие данные бота не затрагиваются.
+"""
+import argparse
+import asyncio
+import copy
+import gc
+import heapq
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from functools import partial
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, GetMe, GetUpdates, SendMessage
+from aiogram.types import Update, User
+from aiohttp import ClientSession, web
+
+import bot
+
+
+def make_games(chats: int, players_per_chat: int, seed: int = 1, now: datetime = None) -> bot.GameTable:
+    """Сгенерировать синтетические игры (одинаковые seed и now дают одинаковые данные)"""
+    rng = random.Random(seed)
+    country_ids = list(bot.COUNTRIES)
+    now = now or datetime.now()
+    result = bot.GameTable()
+    for chat_index in range(chats):
+        chat_id = -1000000000000 - chat_index
+        game = bot.Game(chat_id=chat_id, creator_id=chat_index * players_per_chat + 1)
+        for player_index in range(players_per_chat):
+            user_id = chat_index * players_per_chat + player_index + 1
+            player = bot.Player(
+                user_id=user_id,
+                username=f"player{user_id}",
+                country=country_ids[player_index % len(country_ids)],
+                money=rng.uniform(0, 1_000_000),
+                army_level=rng.randint(1, 30),
+                city_level=rng.randint(1, 30),
+                last_income=now - timedelta(seconds=rng.randint(0, 86400)),
+                last_tax=now - timedelta(seconds=rng.randint(0, bot.TAX_INTERVAL)),
+                wins=rng.randint(0, 50),
+                losses=rng.randint(0, 50),
+                tax_paid=rng.uniform(0, 100_000),
+            )
+            game.players[user_id] = player
+            game.tax_history.add(now - timedelta(hours=rng.randint(0, 700)), rng.uniform(50, 5000))
+        result[chat_id] = game
+    return result
+
+
+def timed(fn: Callable, *args: Any) -> Tuple[float, Any]:
+    """Выполнить fn и вернуть (секунды, результат)"""
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+def mark_all_dirty():
+    """Отметить все игры и всех игроков как измененные (полное сохранение)"""
+    for chat_id, game in bot.games.items():
+        bot.mark_dirty(chat_id)
+        for user_id in game.players:
+            bot.mark_dirty(chat_id, user_id)
+
+
+class FakeSession(BaseSession):
+    """Сессия бота без сети: все запросы к Telegram считаются успешными
+
+    getUpdates отдает заранее подготовленные обновления пачками по 100
+    с задержкой rtt (сетевая задержка long polling). Каждое flood_every-е
+    сообщение (один раз) получает ответ 429 с retry_after, отправленные сообщения
+    записываются в sent как (момент, чат, текст), правки — в edits как
+    (чат, сообщение) -> (текст, клавиатура). Остальные запросы выполняются
+    за latency секунд.
+    """
+
+    def __init__(self, updates: List[Dict[str, Any]] = (), rtt: float = 0.0,
+                 flood_every: int = 0, retry_after: int = 1, latency: float = 0.0):
+        super().__init__()
+        self.updates = list(updates)
+        self.rtt = rtt
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.answered = 0
+        self.flooded = 0
+        self.send_attempts = 0
+        self._flooded: set = set()
+        self.sent: List[Tuple[float, Any, str]] = []
+        self.edits: Dict[Tuple[Any, int], Tuple[str, Any]] = {}
+        self.edit_requests = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests += 1
+        if isinstance(method, GetMe):
+            return User(id=42, is_bot=True, first_name="bench", username="bench_bot")
+        if isinstance(method, GetUpdates):
+            await asyncio.sleep(self.rtt)
+            limit = method.limit or 100
+            batch, self.updates = self.updates[:limit], self.updates[limit:]
+            return [Update(**update) for update in batch]
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, AnswerCallbackQuery):
+            self.answered += 1
+        if isinstance(method, EditMessageText):
+            self.edit_requests += 1
+            self.edits[(method.chat_id, method.message_id)] = (method.text, method.reply_markup)
+        if isinstance(method, SendMessage):
+            self.send_attempts += 1
+            if self.flood_every and self.send_attempts % self.flood_every == 0 and id(method) not in self._flooded:
+                # Каждое сообщение получает 429 не больше одного раза
+                self._flooded.add(id(method))
+                self.flooded += 1
+                raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=self.retry_after)
+            self.sent.append((time.monotonic(), method.chat_id, method.text))
+        return True
+
+    async def stream_content(self, url, timeout, chunk_size):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def make_fake_bot() -> Bot:
+    """Бот с FakeSession (функция уровня модуля, чтобы передаваться в процессы)"""
+    return Bot(token="42:FAKE", session=FakeSession())
+
+
+def callback_update(update_id: int, chat_id: int, user_id: int, data: str) -> Dict[str, Any]:
+    """Сырое обновление Telegram с нажатием inline-кнопки в группе"""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"player{user_id}"},
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def message_update(update_id: int, chat_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    """Сырое обновление Telegram с текстовым сообщением (chat_id == user_id — личные сообщения)"""
+    chat = ({"id": chat_id, "type": "private", "first_name": f"player{user_id}"} if chat_id == user_id
+            else {"id": chat_id, "type": "supergroup", "title": "bench"})
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"player{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+
+
+def bench_codec(args) -> Dict[str, Any]:
+    """Сохранение и загрузка: stdlib json (indent=2) против кодека бота"""
+    bot.games = make_games(args.chats, args.players // args.chats)
+    players = sum(len(game.players) for game in bot.games.values())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline_file = os.path.join(tmp, "baseline.json")
+        games_file = os.path.join(tmp, "games.json")
+
+        def baseline_save():
+            data = {}
+            for chat_id, game in bot.games.items():
+                game_data = bot.serialize_game(game)
+                game_data["players"] = {str(user_id): bot.serialize_player(player)
+                                        for user_id, player in game.players.items()}
+                data[str(chat_id)] = game_data
+            with open(baseline_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+
+        def baseline_load():
+            with open(baseline_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return {int(chat_id): bot.game_from_row(int(chat_id), game_data) for chat_id, game_data in data.items()}
+
+        storage = bot.JsonStorage(games_file, os.path.join(tmp, "promocodes.json"))
+
+        def full_save():
+            mark_all_dirty()
+            return storage.write(bot.build_changes())
+
+        def single_player_save():
+            game = next(iter(bot.games.values()))
+            user_id = next(iter(game.players))
+            game.players[user_id].army_level += 1
+            bot.mark_dirty(game.chat_id, user_id)
+            return storage.write(bot.build_changes())
+
+        def codec_load():
+            data, _ = bot.JsonStorage(games_file, os.path.join(tmp, "promocodes.json")).load()
+            return {int(chat_id): bot.game_from_row(int(chat_id), game_data) for chat_id, game_data in data.items()}
+
+        baseline_save_time, _ = timed(baseline_save)
+        baseline_load_time, _ = timed(baseline_load)
+        save_time, _ = timed(full_save)
+        single_save_time, _ = timed(single_player_save)
+        load_time, _ = timed(codec_load)
+
+        return {
+            "codec": bot.JSON_CODEC,
+            "players": players,
+            "baseline_save_s": baseline_save_time,
+            "baseline_load_s": baseline_load_time,
+            "baseline_file_bytes": os.path.getsize(baseline_file),
+            "full_save_s": save_time,
+            "single_player_save_s": single_save_time,
+            "load_s": load_time,
+            "file_bytes": os.path.getsize(games_file),
+        }
+
+
+@dataclass
+class LegacyPlayer:
+    """Прежняя запись игрока (dataclass с __dict__ и datetime) для сравнения"""
+    user_id: int
+    username: str
+    country: str
+    money: float = 1000.0
+    army_level: int = 1
+    city_level: int = 1
+    last_income: datetime = field(default_factory=datetime.now)
+    last_tax: datetime = field(default_factory=datetime.now)
+    wins: int = 0
+    losses: int = 0
+    is_online: bool = True
+    has_dm_notifications: bool = True
+    tax_paid: float = 0.0
+    used_promocodes: List[str] = field(default_factory=list)
+
+
+def bench_memory(args) -> Dict[str, Any]:
+    """Память на одного игрока: прежний dataclass против записи со __slots__"""
+    count = args.players
+    rows = [bot.serialize_player(player) for game in make_games(1, min(count, 1000)).values()
+            for player in game.players.values()]
+
+    def build(factory: Callable) -> float:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        players = []
+        for index in range(count):
+            row = rows[index % len(rows)]
+            players.append(factory(
+                user_id=index + 1,
+                # Копия строки, как после разбора JSON
+                username=row["username"].encode().decode(),
+                country=row["country"].encode().decode(),
+                money=row["money"] + 0.5,
+                army_level=row["army_level"],
+                city_level=row["city_level"],
+                last_income=datetime.fromisoformat(row["last_income"]),
+                last_tax=datetime.fromisoformat(row["last_tax"]),
+                wins=row["wins"],
+                losses=row["losses"],
+                tax_paid=row["tax_paid"] + 0.5,
+                used_promocodes=[],
+            ))
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del players
+        return used / count
+
+    legacy = build(LegacyPlayer)
+    current = build(bot.Player)
+    return {
+        "players": count,
+        "legacy_bytes_per_player": legacy,
+        "bytes_per_player": current,
+        "saved_percent": (1 - current / legacy) * 100,
+    }
+
+
+def bench_economy(args) -> Dict[str, Any]:
+    """Глобальный проход по экономике (догоняющий расчет после простоя)"""
+    result: Dict[str, Any] = {}
+    for size in args.sizes:
+        chats = max(size // 100, 1)
+        now = datetime.now()
+        all_games = make_games(chats, size // chats, now=now)
+        elapsed, payments = timed(bot.economy_pass, all_games, now)
+        result[f"pass_{size}_s"] = elapsed
+        result[f"pass_{size}_us_per_player"] = elapsed / size * 1e6
+        result[f"taxes_{size}"] = sum(map(len, payments.values()))
+    return result
+
+
+def bench_shards(args) -> Dict[str, Any]:
+    """Пропускная способность обработки обновлений при разном числе процессов-шардов"""
+    all_games = make_games(args.chats, args.players // args.chats)
+    updates = make_top_updates(all_games, args.updates)
+
+    result: Dict[str, Any] = {"cpus": os.cpu_count(), "updates": args.updates}
+    workdir = os.getcwd()
+    for shard_count in args.shards:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                # Раскладываем игры по файлам шардов заранее, загрузка не входит в замер
+                for shard_id in range(shard_count):
+                    bot.games = bot.GameTable({chat_id: game for chat_id, game in all_games.items()
+                                               if bot.shard_of(chat_id, shard_count) == shard_id})
+                    mark_all_dirty()
+                    bot.JsonStorage(bot.shard_file(bot.GAMES_FILE, shard_id),
+                                    bot.shard_file(bot.PROMOCODES_FILE, shard_id)).write(bot.build_changes())
+
+                inboxes, outbox, workers = bot.start_shards(shard_count, make_fake_bot)
+                started = time.perf_counter()
+                for update in updates:
+                    inboxes[bot.update_shard(update, shard_count)].put(("update", update))
+                stats = bot.stop_shards(inboxes, outbox, workers)
+                elapsed = time.perf_counter() - started
+            finally:
+                os.chdir(workdir)
+
+        assert sum(stat["updates"] for stat in stats) == args.updates
+        result[f"shards_{shard_count}_s"] = elapsed
+        result[f"shards_{shard_count}_updates_per_s"] = args.updates / elapsed
+        result[f"shards_{shard_count}_scaling"] = (result[f"shards_{args.shards[0]}_s"] / elapsed
+                                                   * args.shards[0])
+    return result
+
+
+def make_top_updates(all_games: Dict[int, bot.Game], count: int) -> List[Dict[str, Any]]:
+    """Нажатия кнопки "Топ" случайными игроками случайных чатов"""
+    rng = random.Random(2)
+    chat_ids = list(all_games)
+    updates = []
+    for update_id in range(count):
+        chat_id = rng.choice(chat_ids)
+        user_id = rng.choice(list(all_games[chat_id].players))
+        updates.append(callback_update(update_id, chat_id, user_id, f"top_{user_id}"))
+    return updates
+
+
+async def wait_answered(session: FakeSession, count: int):
+    """Дождаться ответа бота на count нажатий"""
+    while session.answered < count:
+        await asyncio.sleep(0.005)
+
+
+async def run_polling_mode(updates: List[Dict[str, Any]], rtt: float) -> float:
+    """Обработать обновления через dp.start_polling, вернуть секунды"""
+    session = FakeSession(updates, rtt)
+    bot.bot = Bot(token="42:FAKE", session=session)
+    dp = bot.build_dispatcher()
+    started = time.perf_counter()
+    polling = asyncio.create_task(dp.start_polling(bot.bot, handle_signals=False, close_bot_session=False))
+    await wait_answered(session, len(updates))
+    elapsed = time.perf_counter() - started
+    await dp.stop_polling()
+    await polling
+    return elapsed
+
+
+async def run_webhook_mode(updates: List[Dict[str, Any]], connections: int) -> float:
+    """Отправить обновления POST-запросами на локальный webhook, вернуть секунды"""
+    session = FakeSession()
+    bot.bot = Bot(token="42:FAKE", session=session)
+    dp = bot.build_dispatcher()
+    receiver = bot.WebhookReceiver(lambda update: dp.feed_raw_update(bot.bot, update), "secret",
+                                   bot.WEBHOOK_MAX_CONCURRENCY)
+    runner = web.AppRunner(receiver.app(bot.WEBHOOK_PATH))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}{bot.WEBHOOK_PATH}"
+    bodies = [bot.json_dumps(update) for update in updates]
+
+    async with ClientSession() as client:
+        # Неверный токен отклоняется
+        async with client.post(url, data=b"{}", headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+            assert response.status == 401
+
+        started = time.perf_counter()
+
+        async def sender(offset: int):
+            # Telegram держит до max_connections параллельных соединений
+            for body in bodies[offset::connections]:
+                async with client.post(url, data=body, headers={
+                    "X-Telegram-Bot-Api-Secret-Token": "secret",
+                    "Content-Type": "application/json",
+                }) as response:
+                    assert response.status == 200
+
+        await asyncio.gather(*(sender(offset) for offset in range(connections)))
+        await receiver.drain()
+        elapsed = time.perf_counter() - started
+
+    await runner.cleanup()
+    assert session.answered == len(updates) and receiver.failed == 0
+    return elapsed
+
+
+def bench_webhook(args) -> Dict[str, Any]:
+    """Обновления в секунду: long polling против webhook (без сети)"""
+    bot.games = make_games(args.chats, args.players // args.chats)
+    updates = make_top_updates(bot.games, args.updates)
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Файл состояний FSM создается во временной папке
+        os.chdir(tmp)
+        try:
+            polling_time = asyncio.run(run_polling_mode(updates, args.rtt))
+            webhook_time = asyncio.run(run_webhook_mode(updates, args.connections))
+        finally:
+            os.chdir(workdir)
+    return {
+        "updates": args.updates,
+        "polling_rtt_s": args.rtt,
+        "polling_s": polling_time,
+        "polling_updates_per_s": args.updates / polling_time,
+        "webhook_connections": args.connections,
+        "webhook_s": webhook_time,
+        "webhook_updates_per_s": args.updates / webhook_time,
+    }
+
+
+def rate_violations(sent: List[Tuple[float, Any, str]], limit: int, window: float, key: Callable) -> int:
+    """Сколько раз в скользящем окне window секунд было больше limit сообщений
+
+    Допуск 50 мс: между выдачей слота и записью отправки задача может
+    ждать своей очереди в event loop.
+    """
+    groups: Dict[Any, List[float]] = {}
+    for moment, chat_id, _ in sent:
+        groups.setdefault(key(chat_id), []).append(moment)
+
+    violations = 0
+    for moments in groups.values():
+        moments.sort()
+        start = 0
+        for end, moment in enumerate(moments):
+            while moment - moments[start] >= window - 0.05:
+                start += 1
+            if end - start + 1 > limit:
+                violations += 1
+    return violations
+
+
+def bench_sendqueue(args) -> Dict[str, Any]:
+    """Рассылка оповещений с интерактивными ответами посреди нее через SendQueue"""
+
+    async def run() -> Dict[str, Any]:
+        session = FakeSession(flood_every=args.flood_every)
+        bot.bot = Bot(token="42:FAKE", session=session)
+        bot.bot.session.middleware(bot.send_queue)
+        chats = [-1000000000000 - index for index in range(args.send_chats)]
+
+        started = time.monotonic()
+        broadcast = asyncio.gather(*(bot.send_notice(chat_id, f"notice {index}")
+                                     for index in range(args.messages) for chat_id in chats))
+        await asyncio.sleep(1)
+        depth_during_broadcast = bot.send_queue.metrics()["queue_depth"]
+
+        latencies = []
+
+        async def reply(chat_id: int):
+            reply_started = time.monotonic()
+            await bot.bot.send_message(chat_id, "reply")
+            latencies.append(time.monotonic() - reply_started)
+
+        await asyncio.gather(*(reply(chat_id) for chat_id in chats))
+        replies_done = time.monotonic()
+        await broadcast
+        elapsed = time.monotonic() - started
+
+        latencies.sort()
+        return {
+            "messages": len(session.sent),
+            "elapsed_s": elapsed,
+            "replies_done_s": replies_done - started,
+            "reply_p50_s": latencies[len(latencies) // 2],
+            "reply_max_s": latencies[-1],
+            "queue_depth_during_broadcast": depth_during_broadcast,
+            "flooded": session.flooded,
+            **{f"queue_{key}": value for key, value in bot.send_queue.metrics().items()},
+            "chat_limit_violations": rate_violations(session.sent, *bot.SEND_LIMIT_PER_CHAT, lambda c: c),
+            "group_limit_violations": rate_violations(session.sent, *bot.SEND_LIMIT_PER_GROUP, lambda c: c),
+            "global_limit_violations": rate_violations(session.sent, *bot.SEND_LIMIT_GLOBAL, lambda c: 0),
+        }
+
+    return asyncio.run(run())
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    """Перцентиль по отсортированной копии выборки"""
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def bench_fsm(args) -> Dict[str, Any]:
+    """Задержка set_state/set_data/get_state/get_data для хранилищ FSM"""
+
+    async def measure(fsm_storage) -> Dict[str, List[float]]:
+        keys = [StorageKey(bot_id=42, chat_id=-1000000000000 - index % 100, user_id=index + 1)
+                for index in range(args.fsm_keys)]
+        samples: Dict[str, List[float]] = {"set_state": [], "set_data": [], "get_state": [], "get_data": []}
+        for key in keys:
+            # Так же, как cmd_join: состояние выбора страны и данные диалога
+            started = time.perf_counter()
+            await fsm_storage.set_state(None, key, bot.GameStates.waiting_for_country)
+            samples["set_state"].append(time.perf_counter() - started)
+            started = time.perf_counter()
+            await fsm_storage.set_data(None, key, {"chat_id": key.chat_id, "user_id": key.user_id})
+            samples["set_data"].append(time.perf_counter() - started)
+        for key in keys:
+            started = time.perf_counter()
+            state = await fsm_storage.get_state(None, key)
+            samples["get_state"].append(time.perf_counter() - started)
+            started = time.perf_counter()
+            data = await fsm_storage.get_data(None, key)
+            samples["get_data"].append(time.perf_counter() - started)
+            assert state == bot.GameStates.waiting_for_country.state and data["user_id"] == key.user_id
+        await fsm_storage.close()
+        return samples
+
+    result: Dict[str, Any] = {"keys": args.fsm_keys}
+    with tempfile.TemporaryDirectory() as tmp:
+        backends = {
+            "memory": bot.MemoryStorage(),
+            "sqlite": bot.SqliteFsmStorage(os.path.join(tmp, "fsm.db"), bot.FSM_STATE_TTL),
+        }
+        for name, fsm_storage in backends.items():
+            for operation, values in asyncio.run(measure(fsm_storage)).items():
+                result[f"{name}_{operation}_p50_us"] = percentile(values, 0.5) * 1e6
+                result[f"{name}_{operation}_p99_us"] = percentile(values, 0.99) * 1e6
+
+        # Состояние переживает перезапуск, просроченное не читается
+        path = os.path.join(tmp, "fsm.db")
+        key = StorageKey(bot_id=42, chat_id=-1, user_id=1)
+        reopened = bot.SqliteFsmStorage(path, bot.FSM_STATE_TTL)
+        assert asyncio.run(reopened.get_data(None, StorageKey(bot_id=42, chat_id=-1000000000000, user_id=1)))
+        asyncio.run(reopened.close())
+        expiring = bot.SqliteFsmStorage(path, 0.05)
+        asyncio.run(expiring.set_state(None, key, bot.GameStates.waiting_for_war_target))
+        time.sleep(0.1)
+        assert asyncio.run(expiring.get_state(None, key)) is None
+        # Очистку выполняет поток хранилища, как в фоновой задаче run()
+        result["sqlite_purged"] = asyncio.run(expiring._call(expiring.purge_expired))
+        asyncio.run(expiring.close())
+        result["sqlite_file_bytes"] = sum(os.path.getsize(os.path.join(tmp, name))
+                                          for name in os.listdir(tmp) if name.startswith("fsm.db"))
+    return result
+
+
+def bench_index(args) -> Dict[str, Any]:
+    """Поиск игр игрока и занятой страны: полный перебор против PlayerIndex"""
+    # Страна в чате занята одним игроком, поэтому игроков в чате не больше, чем стран,
+    # а недостающие игроки раскладываются по дополнительным чатам
+    per_chat = max(min(args.players // args.chats, len(bot.COUNTRIES)), 1)
+    all_games = make_games(max(args.chats, args.players // per_chat), per_chat)
+    rng = random.Random(3)
+    chat_ids = list(all_games)
+    lookups = [(chat_id, rng.choice(list(all_games[chat_id].players))) for chat_id in
+               (rng.choice(chat_ids) for _ in range(1000))]
+
+    index = bot.PlayerIndex()
+    tracemalloc.start()
+    rebuild_time, _ = timed(index.rebuild, all_games)
+    index_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    def scan_user_chats():
+        return [[chat_id for chat_id, game in all_games.items() if user_id in game.players] for _, user_id in lookups]
+
+    def index_user_chats():
+        return [index.chats_of(user_id) for _, user_id in lookups]
+
+    # make_games раздает страны по порядку, поэтому первая страна занята в каждом чате
+    taken = next(iter(bot.COUNTRIES))
+
+    def scan_countries():
+        return [next((p.user_id for p in all_games[chat_id].players.values() if p.country == taken), None)
+                for chat_id, _ in lookups]
+
+    def index_countries():
+        return [index.country_owner(chat_id, taken) for chat_id, _ in lookups]
+
+    scan_chats_time, scanned = timed(scan_user_chats)
+    index_chats_time, indexed = timed(index_user_chats)
+    assert [sorted(chats) for chats in scanned] == [sorted(chats) for chats in indexed]
+    scan_country_time, scanned_owners = timed(scan_countries)
+    index_country_time, indexed_owners = timed(index_countries)
+    assert scanned_owners == indexed_owners and None not in indexed_owners
+    return {
+        "chats": len(all_games),
+        "players": sum(len(game.players) for game in all_games.values()),
+        "rebuild_s": rebuild_time,
+        "index_bytes": index_bytes,
+        "user_chats_scan_us": scan_chats_time / len(lookups) * 1e6,
+        "user_chats_index_us": index_chats_time / len(lookups) * 1e6,
+        "country_scan_us": scan_country_time / len(lookups) * 1e6,
+        "country_index_us": index_country_time / len(lookups) * 1e6,
+    }
+
+
+def bench_leaderboard(args) -> Dict[str, Any]:
+    """Общий топ: сортировка всех игроков против Leaderboards"""
+    bot.games = make_games(args.chats, args.players // args.chats)
+    boards = bot.Leaderboards()
+    rebuild_time, _ = timed(boards.rebuild, bot.games)
+    now_ts = time.time()
+    reads = 20
+
+    def sort_all():
+        for _ in range(reads):
+            everyone = [(chat_id, player) for chat_id, game in bot.games.items() for player in game.players.values()]
+            ranked = sorted(everyone, key=lambda entry: bot.projected_money(entry[1], now_ts), reverse=True)
+        return [player.user_id for _, player in ranked[:bot.TOP_SIZE]]
+
+    def read_board():
+        for _ in range(reads):
+            top = boards.board("money").top(bot.TOP_SIZE, now_ts)
+        return [player.user_id for _, player, _ in top]
+
+    sort_time, sorted_top = timed(sort_all)
+    board_time, board_top = timed(read_board)
+    assert sorted_top == board_top
+
+    rng = random.Random(5)
+    touches = [(chat_id, rng.choice(list(bot.games[chat_id].players))) for chat_id in
+               (rng.choice(list(bot.games)) for _ in range(10_000))]
+    for chat_id, user_id in touches[:100]:
+        bot.games[chat_id].players[user_id].tax_paid += 1_000_000
+    touch_time, _ = timed(lambda: [boards.touch(chat_id, user_id) for chat_id, user_id in touches])
+    richest = max((p for game in bot.games.values() for p in game.players.values()), key=lambda p: p.tax_paid)
+    assert boards.board("tax_paid").top(1, now_ts)[0][1] is richest
+
+    async def refresh_with_stalls():
+        stalls = []
+
+        async def probe():
+            while True:
+                started = time.perf_counter()
+                await asyncio.sleep(0)
+                stalls.append(time.perf_counter() - started)
+
+        prober = asyncio.create_task(probe())
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        await boards.refresh()
+        elapsed = time.perf_counter() - started
+        prober.cancel()
+        return elapsed, max(stalls, default=0.0)
+
+    refresh_time, max_stall = asyncio.run(refresh_with_stalls())
+    return {
+        "players": sum(len(game.players) for game in bot.games.values()),
+        "rebuild_s": rebuild_time,
+        "top_sort_ms": sort_time / reads * 1e3,
+        "top_board_ms": board_time / reads * 1e3,
+        "touch_us": touch_time / len(touches) * 1e6,
+        "refresh_s": refresh_time,
+        "refresh_max_stall_ms": max_stall * 1e3,
+    }
+
+
+def bench_views(args) -> Dict[str, Any]:
+    """Меню игрока: отрисовка и правки сообщения с ViewCache и без
+
+    Каждый игрок дважды подряд нажимает "Обновить", второе нажатие приходит
+    с уже показанным меню. Половина игроков не в сети и их деньги не растут,
+    у остальных деньги могут измениться и между двумя нажатиями.
+    """
+    bot.games = make_games(args.chats, args.players // args.chats)
+    rng = random.Random(4)
+    chat_ids = list(bot.games)
+    clicks = list({(chat_id, rng.choice(list(bot.games[chat_id].players)))
+                   for chat_id in (rng.choice(chat_ids) for _ in range(args.clicks))})
+    offline = set(clicks[::2])
+    for chat_id, user_id in offline:
+        bot.games[chat_id].players[user_id].is_online = False
+
+    def render_plain():
+        for chat_id, user_id in clicks:
+            game = bot.games[chat_id]
+            bot.render_player_menu(game, game.players[user_id], 100.0, None)
+            bot.get_game_keyboard.__wrapped__(user_id)
+
+    def render_cached():
+        for chat_id, user_id in clicks:
+            game = bot.games[chat_id]
+            player = game.players[user_id]
+            bot.views.render(("menu", chat_id, user_id), (game.version, int(player.money), 100, None),
+                             partial(bot.render_player_menu, game, player, 100.0, None))
+            bot.get_game_keyboard(user_id)
+
+    render_cached()  # Заполнение кэша
+    plain_time, _ = timed(render_plain)
+    cached_time, _ = timed(render_cached)
+
+    def refresh_update(update_id: int, chat_id: int, user_id: int, shown: Tuple[str, Any] = None):
+        update = callback_update(update_id, chat_id, user_id, f"refresh_{user_id}")
+        message = update["callback_query"]["message"]
+        message["message_id"] = user_id
+        if shown:
+            message["text"] = shown[0]
+            message["reply_markup"] = shown[1].dict(exclude_none=True)
+        return update
+
+    async def double_clicks():
+        session = FakeSession()
+        bot.bot = Bot(token="42:FAKE", session=session)
+        dp = bot.build_dispatcher()
+        first_edits = 0
+        edits = {"online": 0, "offline": 0}
+        for update_id, (chat_id, user_id) in enumerate(clicks):
+            before = session.edit_requests
+            await dp.feed_raw_update(bot.bot, refresh_update(2 * update_id, chat_id, user_id))
+            first_edits += session.edit_requests - before
+            before = session.edit_requests
+            shown = session.edits[(chat_id, user_id)]
+            await dp.feed_raw_update(bot.bot, refresh_update(2 * update_id + 1, chat_id, user_id, shown))
+            edits["offline" if (chat_id, user_id) in offline else "online"] += session.edit_requests - before
+        await dp.storage.close()
+        return first_edits, edits
+
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Файл состояний FSM создается во временной папке
+        os.chdir(tmp)
+        try:
+            first_edits, repeat_edits = asyncio.run(double_clicks())
+        finally:
+            os.chdir(workdir)
+
+    assert first_edits == len(clicks)
+    return {
+        "clicks": len(clicks),
+        "render_plain_us": plain_time / len(clicks) * 1e6,
+        "render_cached_us": cached_time / len(clicks) * 1e6,
+        "repeat_edits_online": f"{repeat_edits['online']}/{len(clicks) - len(offline)}",
+        "repeat_edits_offline": f"{repeat_edits['offline']}/{len(offline)}",
+        **{f"cache_{key}": value for key, value in bot.views.metrics().items()},
+    }
+
+
+class NoLocks:
+    """Заглушка KeyedLocks для сравнения: ничего не блокирует"""
+
+    def locked(self, key: Any) -> bool:
+        return False
+
+    @asynccontextmanager
+    async def hold(self, *keys: Any):
+        yield
+
+
+class SlowShardLink:
+    """ShardLink без других шардов: ответ приходит через latency секунд"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def request_all(self, kind: str, **fields: Any) -> List[Any]:
+        await asyncio.sleep(self.latency)
+        return [0]
+
+
+class UnreservedShardLink(SlowShardLink):
+    """SlowShardLink, снимающий резервирование промокода на время ожидания
+
+    Резервирование в cmd_promocode само защищает от повторной активации,
+    поэтому без него между проверкой и записью остается окно: только
+    блокировка промокода не дает активировать его дважды.
+    """
+
+    async def request_all(self, kind: str, **fields: Any) -> List[Any]:
+        promo = bot.promocodes[fields["code"]]
+        promo.used_count -= 1
+        promo.users_used.remove(fields["user_id"])
+        try:
+            return await super().request_all(kind, **fields)
+        finally:
+            promo.used_count += 1
+            promo.users_used.append(fields["user_id"])
+
+
+def upgrade_costs(base_cost: int, level_from: int, level_to: int) -> int:
+    """Сколько стоят улучшения с уровня level_from до level_to"""
+    return sum(base_cost * level for level in range(level_from, level_to))
+
+
+LOCKS_SEED = 6
+LOCKS_CONTROL = (10, 100, 1000)  # Чаты, игроки и обновления, на которых без блокировок есть гонки
+
+
+def bench_locks(args) -> Dict[str, Any]:
+    """Стресс-тест: тысячи одновременных нажатий и активаций промокода, проверка денег
+
+    Промокод активируется через медленный ShardLink без резервирования
+    (UnreservedShardLink): между проверкой users_used и записью есть
+    ожидание, как при шардировании. Гонки без блокировок вероятностны,
+    поэтому прогон без блокировок только печатается, а инварианты
+    проверяются на прогоне с блокировками: на размере из аргументов и на
+    контрольном размере LOCKS_CONTROL, на котором гонки воспроизводятся.
+    """
+    latency = 0.002
+    reward = 1000.0
+    start_money = 50_000.0
+
+    def run(locked: bool, chats: int, players_count: int, updates_count: int) -> Dict[str, Any]:
+        bot.games = make_games(chats, min(players_count // chats, len(bot.COUNTRIES)))
+        for game in bot.games.values():
+            for player in game.players.values():
+                player.is_online = False  # Деньги меняются только улучшениями и промокодом
+                player.money = start_money
+        bot.player_index.rebuild(bot.games)
+        initial = {(chat_id, user_id): (player.army_level, player.city_level)
+                   for chat_id, game in bot.games.items() for user_id, player in game.players.items()}
+        bot.promocodes = {"STRESS": bot.Promocode(code="STRESS", reward=reward, max_uses=len(initial) // 2)}
+        bot.shard_link = UnreservedShardLink(latency)
+        bot.chat_locks, bot.promocode_locks = (bot.KeyedLocks(), bot.KeyedLocks()) if locked else (NoLocks(), NoLocks())
+
+        rng = random.Random(LOCKS_SEED)
+        players = list(initial)
+        updates = []
+        for update_id in range(updates_count):
+            chat_id, user_id = rng.choice(players)
+            action = rng.random()
+            if action < 0.1:
+                updates.append(message_update(update_id, user_id, user_id, "/promocode STRESS"))
+            else:
+                kind = "upgrade_army" if action < 0.55 else "upgrade_city"
+                updates.append(callback_update(update_id, chat_id, user_id, f"{kind}_{user_id}"))
+
+        async def fire():
+            bot.bot = Bot(token="42:FAKE", session=FakeSession(latency=latency))
+            bot.bot.session.middleware(bot.release_chat_lock_middleware)
+            dp = bot.build_dispatcher()
+            started = time.perf_counter()
+            await asyncio.gather(*(dp.feed_raw_update(bot.bot, update) for update in updates))
+            elapsed = time.perf_counter() - started
+            await dp.storage.close()
+            return elapsed
+
+        elapsed = asyncio.run(fire())
+
+        promo = bot.promocodes["STRESS"]
+        redeemed = set(promo.users_used)
+        money_errors = 0
+        for (chat_id, user_id), (army_level, city_level) in initial.items():
+            player = bot.games[chat_id].players[user_id]
+            country = bot.COUNTRIES[player.country]
+            expected = (start_money + reward * (user_id in redeemed)
+                        - upgrade_costs(country.army_cost, army_level, player.army_level)
+                        - upgrade_costs(country.city_cost, city_level, player.city_level))
+            if abs(player.money - expected) > 1e-6 or player.money < 0:
+                money_errors += 1
+        return {
+            "s": elapsed,
+            "updates_per_s": len(updates) / elapsed,
+            "promocode_uses": f"{promo.used_count}/{promo.max_uses}",
+            "double_redemptions": len(promo.users_used) - len(redeemed),
+            "over_limit": max(promo.used_count - promo.max_uses, 0),
+            "money_errors": money_errors,
+            **({"contended": bot.chat_locks.contended + bot.promocode_locks.contended,
+                "locks_left": len(bot.chat_locks._locks) + len(bot.promocode_locks._locks)} if locked else {}),
+        }
+
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Файл состояний FSM создается во временной папке
+        os.chdir(tmp)
+        try:
+            unlocked = run(False, args.chats, args.players, args.updates)
+            locked = run(True, args.chats, args.players, args.updates)
+            control_unlocked = run(False, *LOCKS_CONTROL)
+            control_locked = run(True, *LOCKS_CONTROL)
+        finally:
+            os.chdir(workdir)
+            bot.shard_link = None
+
+    def violations(result: Dict[str, Any]) -> int:
+        return result["double_redemptions"] + result["over_limit"] + result["money_errors"]
+
+    for result in (locked, control_locked):
+        assert violations(result) == 0 and result["locks_left"] == 0, result
+    return {
+        "updates": args.updates,
+        **{f"unlocked_{key}": value for key, value in unlocked.items()},
+        **{f"locked_{key}": value for key, value in locked.items()},
+        "unlocked_violations": violations(unlocked),
+        "control_size": "{} чатов, {} игроков, {} обновлений".format(*LOCKS_CONTROL),
+        "control_unlocked_violations": violations(control_unlocked),
+        "control_locked_violations": violations(control_locked),
+        "control_locked_contended": control_locked["contended"],
+    }
+
+
+def bench_metrics(args) -> Dict[str, Any]:
+    """Накладные расходы метрик: нажатия через диспетчер без метрик и с ними, отдача /metrics"""
+    bot.games = make_games(args.chats, args.players // args.chats)
+    rng = random.Random(6)
+    chat_ids = list(bot.games)
+    clicks = [(chat_id, rng.choice(list(bot.games[chat_id].players)))
+              for chat_id in (rng.choice(chat_ids) for _ in range(args.clicks))]
+
+    async def feed(enabled: bool) -> float:
+        bot.metrics = bot.Metrics(enabled)
+        bot.bot = Bot(token="42:FAKE", session=FakeSession())
+        dp = bot.build_dispatcher()
+        started = time.perf_counter()
+        for update_id, (chat_id, user_id) in enumerate(clicks):
+            await dp.feed_raw_update(bot.bot, callback_update(update_id, chat_id, user_id, f"stats_{user_id}"))
+        elapsed = time.perf_counter() - started
+        await dp.storage.close()
+        return elapsed
+
+    async def scrape() -> Tuple[float, str]:
+        with socket.socket() as probe:
+            probe.bind((bot.METRICS_HOST, 0))
+            port = probe.getsockname()[1]
+        server = asyncio.create_task(bot.serve_metrics(port))
+        await asyncio.sleep(0.1)
+        try:
+            async with ClientSession() as session:
+                started = time.perf_counter()
+                async with session.get(f"http://{bot.METRICS_HOST}:{port}/metrics") as response:
+                    assert response.status == 200
+                    body = await response.text()
+                return time.perf_counter() - started, body
+        finally:
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+    async def run() -> Dict[str, Any]:
+        # Чередование режимов сглаживает прогрев и шум, берется лучший из трех
+        disabled, enabled = [], []
+        for _ in range(3):
+            disabled.append(await feed(False))
+            enabled.append(await feed(True))
+        scrape_time, body = await scrape()
+        return {"disabled": min(disabled), "enabled": min(enabled), "scrape": scrape_time, "body": body}
+
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            result = asyncio.run(run())
+        finally:
+            os.chdir(workdir)
+            bot.metrics = bot.Metrics(False)
+
+    body = result["body"]
+    assert f'bot_handler_seconds_count{{handler="callback_stats"}} {len(clicks)}' in body
+    return {
+        "clicks": len(clicks),
+        "disabled_us_per_update": result["disabled"] / len(clicks) * 1e6,
+        "enabled_us_per_update": result["enabled"] / len(clicks) * 1e6,
+        "overhead_percent": (result["enabled"] / result["disabled"] - 1) * 100,
+        "scrape_ms": result["scrape"] * 1000,
+        "scrape_bytes": len(body.encode()),
+        "series": sum(1 for line in body.splitlines() if not line.startswith("#")),
+    }
+
+
+def process_memory_mb(field_name: str = "VmRSS") -> float:
+    """Память текущего процесса из /proc/self/status (VmRSS — текущая, VmHWM — пиковая)"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field_name + ":"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def startup_child(mode: str, workdir: str, chat_id: int, user_id: int) -> Dict[str, Any]:
+    """Запуск бота в чистом процессе: загрузка, первый ответ, восстановление всех игр"""
+    os.chdir(workdir)
+    bot.STARTUP_LOAD = mode
+    bot.storage = bot.create_storage("json")
+    rss_before = process_memory_mb()
+
+    async def run() -> Tuple[float, float, float]:
+        started = time.perf_counter()
+        bot.prepare_game_data()
+        ready = time.perf_counter() - started
+        bot.bot = Bot(token="42:FAKE", session=FakeSession())
+        dp = bot.build_dispatcher()
+        restoring = asyncio.create_task(bot.restore_cold_games())
+        await dp.feed_raw_update(bot.bot, callback_update(1, chat_id, user_id, f"refresh_{user_id}"))
+        first = time.perf_counter() - started
+        await restoring
+        restored = time.perf_counter() - started
+        await bot.save_coordinator.flush()
+        await dp.storage.close()
+        return ready, first, restored
+
+    ready, first, restored = asyncio.run(run())
+    return {
+        "ready_s": ready,
+        "first_response_s": first,
+        "all_restored_s": restored,
+        "rss_before_mb": rss_before,
+        "peak_rss_mb": process_memory_mb("VmHWM"),
+        "players": sum(len(game.players) for game in bot.games.values()),
+    }
+
+
+def bench_startup(args) -> Dict[str, Any]:
+    """Запуск с большим файлом игр: полная загрузка (full) против восстановления по обращению (lazy)
+
+    Каждый режим запускается в отдельном процессе, первый ответ — нажатие
+    "Обновить" в последнем чате файла сразу после запуска.
+    """
+    bot.games = make_games(args.chats, args.players // args.chats)
+    chat_id = list(bot.games)[-1]
+    user_id = next(iter(bot.games[chat_id].players))
+    result: Dict[str, Any] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        mark_all_dirty()
+        bot.JsonStorage(os.path.join(tmp, bot.GAMES_FILE),
+                        os.path.join(tmp, bot.PROMOCODES_FILE)).write(bot.build_changes())
+        result["file_mb"] = os.path.getsize(os.path.join(tmp, bot.GAMES_FILE)) / 2 ** 20
+        bot.games = bot.GameTable()
+
+        context = multiprocessing.get_context("spawn")
+        for mode in ("full", "lazy"):
+            with context.Pool(1) as pool:
+                stats = pool.apply(startup_child, (mode, tmp, chat_id, user_id))
+            result.update({f"{mode}_{key}": value for key, value in stats.items()})
+
+    assert result["full_players"] == result["lazy_players"] == args.players // args.chats * args.chats
+    return result
+
+
+def evict_with_backend(backend: str, chats: int, per_chat: int, active: int) -> Dict[str, Any]:
+    """Все игры в памяти против active недавних: память, выгрузка и возвращение игр"""
+    gc.collect()
+    tracemalloc.start()
+    bot.storage = bot.create_storage(backend)
+    bot.games = make_games(chats, per_chat)
+    mark_all_dirty()
+    bot.storage.write(bot.build_changes())
+    bot.tax_scheduler.rebuild(bot.games)
+    bot.player_index.rebuild(bot.games)
+    bot.leaderboards.rebuild(bot.games)
+    chat_ids = list(bot.games)
+    for chat_id in chat_ids[-active:]:
+        bot.games.touch(chat_id)
+    gc.collect()
+    all_hot = tracemalloc.get_traced_memory()[0]
+
+    pinned = bot.leaderboards.chat_ids()
+    evict_time, evicted = timed(bot.evict_games, bot.games.idle_ids(float("-inf"), active), pinned)
+    gc.collect()
+    bounded = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Игроки выгруженных игр остаются в пересчете рейтингов: обнуляем силу игроков
+    # в памяти, и рейтинг силы должен заполниться игроками выгруженных игр
+    for game in list(bot.games.values()):
+        for player in game.players.values():
+            player.army_level = 0
+    asyncio.run(bot.leaderboards.refresh())
+    board = bot.leaderboards.board("power")
+    stored = {chat_id: bot.game_from_row(chat_id, bot.json_loads(bot.storage.load_game(chat_id)))
+              for chat_id in chat_ids if bot.games.loaded(chat_id) is None}
+    expected = heapq.nlargest(board.size, ((player.power, chat_id, player.user_id)
+                                           for chat_id, game in {**dict(bot.games), **stored}.items()
+                                           for player in game.players.values()))
+    assert set(board._scores) == {(chat_id, user_id) for _, chat_id, user_id in expected}
+    assert all(bot.games.loaded(chat_id) is None for chat_id in board.chat_ids())
+
+    rng = random.Random(5)
+    cold = [chat_id for chat_id in chat_ids if bot.games.loaded(chat_id) is None]
+    samples = []
+    for chat_id in rng.sample(cold, min(1000, len(cold))):
+        seconds, game = timed(bot.games.__getitem__, chat_id)
+        assert len(game.players) == per_chat
+        samples.append(seconds)
+    bot.storage.close()
+    result = {
+        "evicted": evicted,
+        "pinned_by_top": len(pinned),
+        "evict_us_per_game": evict_time / max(evicted, 1) * 1e6,
+        "all_hot_mb": all_hot / 2 ** 20,
+        "active_hot_mb": bounded / 2 ** 20,
+    }
+    if samples:
+        # Если рейтинги закрепили все чаты, выгружать и восстанавливать нечего
+        result["restore_p50_ms"] = percentile(samples, 0.5) * 1000
+        result["restore_p99_ms"] = percentile(samples, 0.99) * 1000
+    return result
+
+
+def simulate_online_taxes(game: bot.Game, now_ts: float) -> int:
+    """Налоги игры до now_ts так, как их собирает update_income_and_taxes (тик раз в секунду)"""
+    due = {user_id: player.last_tax_ts + bot.TAX_INTERVAL for user_id, player in game.players.items()}
+    tick = math.ceil(min(due.values()))
+    collected = 0
+    while tick <= now_ts:
+        for user_id, due_ts in due.items():
+            if due_ts > tick:
+                continue
+            player = game.players[user_id]
+            if bot.collect_tax(game, player, datetime.fromtimestamp(tick)) is None:
+                due[user_id] = tick + bot.tax_retry_delay(player)
+            else:
+                collected += 1
+                due[user_id] = player.last_tax_ts + bot.TAX_INTERVAL
+        tick = max(tick + 1, math.ceil(min(due.values())))
+    return collected
+
+
+def bench_eviction(args) -> Dict[str, Any]:
+    """Выгрузка простаивающих игр из памяти (json и sqlite) и догоняющий сбор налогов
+
+    Налоги игры, пролежавшей выгруженной idle_hours часов, сравниваются со
+    сбором по секундным тикам, как если бы игра все это время была в памяти.
+    """
+    per_chat = max(args.players // args.chats, 1)
+    active = max(int(args.chats * args.active), 1)
+    result: Dict[str, Any] = {"chats": args.chats, "players_per_chat": per_chat, "active_chats": active}
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for backend in ("json", "sqlite"):
+                stats = evict_with_backend(backend, args.chats, per_chat, active)
+                result.update({f"{backend}_{key}": value for key, value in stats.items()})
+        finally:
+            os.chdir(workdir)
+            bot.games = bot.GameTable()
+
+    now = datetime.now()
+    online_taxes = offline_taxes = 0
+    online_treasury = offline_treasury = 0.0
+    for game in make_games(20, 6, seed=7, now=now - timedelta(hours=args.idle_hours)).values():
+        online, offline = copy.deepcopy(game), copy.deepcopy(game)
+        online_taxes += simulate_online_taxes(online, now.timestamp())
+        offline_taxes += bot.catch_up_taxes(offline, now)
+        online_treasury += online.treasury
+        offline_treasury += offline.treasury
+    result.update({
+        "idle_hours": args.idle_hours,
+        "online_taxes": online_taxes,
+        "catch_up_taxes": offline_taxes,
+        "treasury_diff_percent": abs(offline_treasury - online_treasury) / online_treasury * 100,
+    })
+    return result
+
+
+LOAD_ACTIONS = ("upgrade", "top", "join", "promocode", "war")
+LOAD_PROMOCODE = "LOAD"
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """Веса действий сценария load: "upgrade=50,top=25" -> {"upgrade": 50.0, "top": 25.0}"""
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in LOAD_ACTIONS:
+            raise argparse.ArgumentTypeError(f"неизвестное действие {name!r}, доступны: {', '.join(LOAD_ACTIONS)}")
+        weights[name] = float(weight)
+    return weights
+
+
+def make_load_script(all_games: Dict[int, bot.Game], actions: int, mix: Dict[str, float],
+                     seed: int = 7) -> List[List[Tuple[str, Dict[str, Any]]]]:
+    """Действия игроков для сценария load: списки (обработчик, обновление) по порядку
+
+    join — /join нового игрока и выбор свободной страны (новый чат, когда
+    свободных стран не осталось), war — "Начать войну" и выбор цели (одна
+    война на чат, затем вместо войны — топ), promocode — /promocode в ЛС.
+    """
+    rng = random.Random(seed)
+    country_ids = list(bot.COUNTRIES)
+    players = [(chat_id, user_id) for chat_id, game in all_games.items() for user_id in game.players]
+    free = {}
+    for chat_id, game in all_games.items():
+        taken = {player.country for player in game.players.values()}
+        if len(taken) < len(country_ids):
+            free[chat_id] = [country_id for country_id in country_ids if country_id not in taken]
+    peaceful = [chat_id for chat_id, game in all_games.items() if len(game.players) >= 2]
+    rng.shuffle(peaceful)
+    next_chat = min(all_games) - 1
+    next_user = max(user_id for _, user_id in players) + 1
+    kinds, weights = list(mix), list(mix.values())
+
+    script = []
+    for update_id in range(0, actions * 2, 2):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "war" and not peaceful:
+            kind = "top"
+        chat_id, user_id = rng.choice(players)
+        if kind == "upgrade":
+            handler = rng.choice(("callback_upgrade_army", "callback_upgrade_city"))
+            data = f"{handler[len('callback_'):]}_{user_id}"
+            steps = [(handler, callback_update(update_id, chat_id, user_id, data))]
+        elif kind == "top":
+            steps = [("callback_top", callback_update(update_id, chat_id, user_id, f"top_{user_id}"))]
+        elif kind == "promocode":
+            steps = [("cmd_promocode", message_update(update_id, user_id, user_id, f"/promocode {LOAD_PROMOCODE}"))]
+        elif kind == "join":
+            if not free:
+                free[next_chat] = list(country_ids)
+                next_chat -= 1
+            chat_id = rng.choice(list(free))
+            country_id = free[chat_id].pop(rng.randrange(len(free[chat_id])))
+            if not free[chat_id]:
+                del free[chat_id]
+            user_id, next_user = next_user, next_user + 1
+            steps = [("cmd_join", message_update(update_id, chat_id, user_id, "/join")),
+                     ("callback_country_selection",
+                      callback_update(update_id + 1, chat_id, user_id, f"country_{country_id}"))]
+        else:
+            chat_id = peaceful.pop()
+            attacker_id, target_id = rng.sample(list(all_games[chat_id].players), 2)
+            steps = [("callback_start_war", callback_update(update_id, chat_id, attacker_id, f"start_war_{attacker_id}")),
+                     ("callback_war_target", callback_update(update_id + 1, chat_id, attacker_id, f"wartarget_{target_id}"))]
+        script.append(steps)
+    return script
+
+
+def bench_load(args) -> Dict[str, Any]:
+    """Нагрузочный тест всего бота: действия игроков с заданной частотой через диспетчер
+
+    Действия приходят по расписанию (rate в секунду, открытая модель):
+    задержка обновления считается от момента, когда оно должно было прийти,
+    поэтому отставание бота от потока попадает в перцентили. Работают те же
+    фоновые задачи, что и в main (налоги, таймеры войн, рейтинги,
+    сохранения); запросы к Telegram выполняет FakeSession.
+    """
+    per_chat = min(args.players // args.chats, len(bot.COUNTRIES))
+    actions = int(args.rate * args.duration)
+
+    async def run() -> Dict[str, Any]:
+        session = FakeSession(latency=args.api_latency)
+        bot.bot = Bot(token="42:FAKE", session=session)
+        bot.bot.session.middleware(bot.release_chat_lock_middleware)
+        if args.send_queue:
+            bot.send_queue = bot.SendQueue(bot.SEND_LIMIT_PER_CHAT, bot.SEND_LIMIT_PER_GROUP, bot.SEND_LIMIT_GLOBAL)
+            bot.bot.session.middleware(bot.send_queue)
+        dp = bot.build_dispatcher()
+        background = [asyncio.create_task(task) for task in (
+            bot.update_income_and_taxes(), bot.war_scheduler.run(), bot.leaderboards.run())]
+        latencies: Dict[str, List[float]] = {}
+        outcome = {"errors": 0, "unhandled": 0}
+
+        async def perform(steps: List[Tuple[str, Dict[str, Any]]], due: float):
+            # Следующий шаг игрок делает, только увидев ответ на предыдущий
+            for handler, update in steps:
+                try:
+                    if await dp.feed_raw_update(bot.bot, update) is UNHANDLED:
+                        outcome["unhandled"] += 1
+                except Exception:
+                    outcome["errors"] += 1
+                finished = time.perf_counter()
+                latencies.setdefault(handler, []).append(finished - due)
+                due = finished
+
+        rss_before = process_memory_mb()
+        started = time.perf_counter()
+        tasks = []
+        for index, steps in enumerate(script):
+            due = started + index / args.rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(perform(steps, due)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        rss_after = process_memory_mb()
+
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await bot.save_coordinator.flush()
+        await dp.storage.close()
+        return {"s": elapsed, "latencies": latencies, "rss_before": rss_before, "rss_after": rss_after,
+                "sent": len(session.sent), "edits": session.edit_requests, **outcome}
+
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Хранилище и состояния FSM создаются во временной папке
+        os.chdir(tmp)
+        try:
+            bot.games = make_games(args.chats, per_chat)
+            bot.storage = bot.create_storage(args.storage)
+            for index in (bot.tax_scheduler, bot.war_scheduler, bot.player_index, bot.leaderboards):
+                index.rebuild(bot.games)
+            bot.promocodes = {LOAD_PROMOCODE: bot.Promocode(code=LOAD_PROMOCODE, reward=1000.0, max_uses=actions)}
+            players_before = sum(len(game.players) for game in bot.games.values())
+            script = make_load_script(bot.games, actions, args.mix)
+            gc.collect()
+            result = asyncio.run(run())
+            players_after = sum(len(game.players) for game in bot.games.values())
+            bot.storage.close()
+        finally:
+            os.chdir(workdir)
+
+    samples = [sample for handler_samples in result["latencies"].values() for sample in handler_samples]
+    report = {
+        "chats": args.chats,
+        "players": players_before,
+        "mix": ",".join(f"{name}={weight:g}" for name, weight in args.mix.items()),
+        "storage": args.storage,
+        "send_queue": args.send_queue,
+        "api_latency_s": args.api_latency,
+        "target_actions_per_s": args.rate,
+        "actions": actions,
+        "updates": len(samples),
+        "s": result["s"],
+        "actions_per_s": actions / result["s"],
+        "updates_per_s": len(samples) / result["s"],
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples) * 1000,
+        "errors": result["errors"],
+        "unhandled": result["unhandled"],
+        "joined": players_after - players_before,
+        "sent": result["sent"],
+        "edits": result["edits"],
+        "rss_before_mb": result["rss_before"],
+        "rss_after_mb": result["rss_after"],
+        "rss_peak_mb": process_memory_mb("VmHWM"),
+    }
+    for handler, handler_samples in sorted(result["latencies"].items()):
+        report[f"{handler}_count"] = len(handler_samples)
+        report[f"{handler}_p50_ms"] = percentile(handler_samples, 0.5) * 1000
+        report[f"{handler}_p99_ms"] = percentile(handler_samples, 0.99) * 1000
+    return report
+
+
+SCENARIOS = {
+    "codec": bench_codec,
+    "memory": bench_memory,
+    "metrics": bench_metrics,
+    "economy": bench_economy,
+    "eviction": bench_eviction,
+    "fsm": bench_fsm,
+    "index": bench_index,
+    "locks": bench_locks,
+    "leaderboard": bench_leaderboard,
+    "load": bench_load,
+    "sendqueue": bench_sendqueue,
+    "shards": bench_shards,
+    "startup": bench_startup,
+    "views": bench_views,
+    "webhook": bench_webhook,
+}
+
+
+def source_revision() -> str:
+    """Коммит git, на котором запущен бенчмарк (пустая строка вне репозитория)"""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки Control Europe")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--chats", type=int, default=1000, help="Количество чатов")
+    parser.add_argument("--players", type=int, default=100_000, help="Всего игроков")
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")],
+                        default=[10_000, 100_000, 1_000_000], help="Размеры наборов игроков через запятую")
+    parser.add_argument("--shards", type=lambda value: [int(count) for count in value.split(",")],
+                        default=[1, 2, 4], help="Числа процессов-шардов через запятую")
+    parser.add_argument("--updates", type=int, default=20_000, help="Обновлений для сценариев shards, webhook и locks")
+    parser.add_argument("--rtt", type=float, default=0.05, help="Сетевая задержка getUpdates (в секундах)")
+    parser.add_argument("--connections", type=int, default=40, help="Параллельных соединений webhook")
+    parser.add_argument("--send-chats", type=int, default=50, help="Чатов в рассылке для сценария sendqueue")
+    parser.add_argument("--messages", type=int, default=5, help="Оповещений на чат для сценария sendqueue")
+    parser.add_argument("--flood-every", type=int, default=25, help="Каждое N-е сообщение получает 429")
+    parser.add_argument("--fsm-keys", type=int, default=10_000, help="Ключей FSM для сценария fsm")
+    parser.add_argument("--clicks", type=int, default=2000, help="Игроков, нажимающих \"Обновить\", для сценария views")
+    parser.add_argument("--active", type=float, default=0.1, help="Доля активных чатов для сценария eviction")
+    parser.add_argument("--idle-hours", type=int, default=24, help="Часов простоя выгруженной игры для сценария eviction")
+    parser.add_argument("--rate", type=float, default=200, help="Действий игроков в секунду для сценария load")
+    parser.add_argument("--duration", type=float, default=10, help="Длительность подачи нагрузки (в секундах) для сценария load")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("upgrade=50,top=25,join=10,promocode=10,war=5"),
+                        help="Веса действий сценария load через запятую: " + ", ".join(LOAD_ACTIONS))
+    parser.add_argument("--storage", choices=["json", "sqlite", "log"], default="json", help="Хранилище для сценария load")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Задержка ответа Telegram (в секундах) для сценария load")
+    parser.add_argument("--send-queue", action="store_true", help="Отправлять сообщения через SendQueue с лимитами Telegram")
+    parser.add_argument("--output", help="Записать результат в JSON-файл")
+    parser.add_argument("--baseline", help="Сравнить результат с JSON-файлом прошлого запуска (--output)")
+    args = parser.parse_args()
+
+    result = SCENARIOS[args.scenario](args)
+    for key, value in result.items():
+        if isinstance(value, float):
+            value = f"{value:.4f}"
+        print(f"{key:>28}: {value}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\nИзменения относительно {args.baseline} ({baseline.get('revision') or 'без версии'}):")
+        for key, value in result.items():
+            previous = baseline.get(key)
+            if (isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and isinstance(previous, (int, float)) and not isinstance(previous, bool) and previous):
+                print(f"{key:>28}: {previous:.4f} -> {value:.4f} ({(value / previous - 1) * 100:+.1f}%)")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"scenario": args.scenario, "revision": source_revision(), **result}, f,
+                      ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
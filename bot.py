@@ -1,19 +1,50 @@
 import asyncio
+import bisect
+import codecs
+import contextvars
+import heapq
+import hmac
+import itertools
 import json
 import os
 import random
 import logging
+import secrets
+import multiprocessing
 import signal
+import sqlite3
 import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Any, Set, Tuple
 from dataclasses import dataclass, field
+from functools import lru_cache, partial
+from itertools import islice
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
 from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
 
 # Настройка логирования
@@ -29,14 +60,85 @@ ADMIN_ID = 8541762027  # Ваш ID для админки
 
 # Константы игры
 WAR_PREPARATION_TIME = 300  # 5 минут на подготовку к войне (в секундах)
+WAR_DURATION = 60  # Длительность войны (в секундах)
+WAR_TIMER_IDLE = 60  # Проверка таймеров войн без дедлайнов (в секундах)
 TAX_INTERVAL = 3600  # 1 час между сборами налогов (в секундах)
 TAX_RATE = 0.05  # 5% налогов от дохода
 MIN_TAX = 50  # Минимальный налог
-SAVE_INTERVAL = 5  # Сохранять данные каждые 5 секунд
+SAVE_INTERVAL = 5  # Обслуживание хранилища каждые 5 секунд
+SAVE_DEBOUNCE = 0.5  # Запись не чаще раза в 0.5 секунды после затихания изменений
+SAVE_MAX_DELAY = 5  # Изменения записываются не позже чем через 5 секунд
+TAX_HISTORY_HOURS = 30 * 24  # История налогов хранится 30 дней почасовыми корзинами
+TAX_WINDOWS = (24, 7 * 24, 30 * 24)  # Окна сумм налогов для казны (в часах)
+TAX_RETRY_INTERVAL = 60  # Повторная попытка сбора налога (в секундах), если ее нельзя рассчитать
 
 # Хранилище данных
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # "json", "sqlite" или "log"
 GAMES_FILE = "games_data.json"
 PROMOCODES_FILE = "promocodes.json"
+SQLITE_FILE = "games_data.db"
+EVENT_LOG_FILE = "games_data.log"  # Журнал изменений для хранилища "log"
+FSYNC_POLICY = os.getenv("FSYNC_POLICY", "batch")  # "event", "batch" или "snapshot"
+FSYNC_BATCH_MS = 200  # Интервал группового fsync журнала (в миллисекундах)
+SNAPSHOT_INTERVAL = 300  # Компакция журнала в снимок каждые 5 минут (в секундах)
+EVENT_LOG_MAX_BYTES = 16 * 1024 * 1024  # Компакция при превышении размера журнала
+STARTUP_LOAD = os.getenv("STARTUP_LOAD", "lazy")  # "lazy" — игры восстанавливаются по обращению и в фоне, "full" — все до запуска
+RESTORE_SLICE = 100  # Игр за один шаг фоновой загрузки, между шагами обрабатываются обновления
+RESTORE_PAUSE = 0.005  # Пауза между шагами: фильтры aiogram ходят в пул потоков и не должны ждать всю загрузку
+LOAD_CHUNK = 1024 * 1024  # Блок чтения при потоковом разборе JSON (в байтах)
+GAME_IDLE_TTL = int(os.getenv("GAME_IDLE_TTL", "1800"))  # Игра без обновлений 30 минут выгружается из памяти (0 — не выгружать)
+GAMES_HOT_LIMIT = int(os.getenv("GAMES_HOT_LIMIT", "0"))  # Мягкий предел игр в памяти, сверх него выгружаются давние (0 — без предела)
+EVICT_INTERVAL = 60  # Проверка простаивающих игр раз в минуту (в секундах)
+EVICT_SLICE = 500  # Игр за один шаг выгрузки
+
+# Состояния диалогов (FSM)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")  # "sqlite", "redis" или "memory"
+FSM_FILE = "fsm_states.db"  # Общий для всех шардов
+FSM_REDIS_URL = os.getenv("FSM_REDIS_URL", "redis://localhost:6379/0")
+FSM_STATE_TTL = 3600  # Незавершенный диалог (выбор страны, цели войны) живет 1 час
+FSM_PURGE_INTERVAL = 300  # Удаление просроченных состояний раз в 5 минут
+FSM_BUSY_TIMEOUT = 5  # Ожидание записи другого шарда в fsm_states.db (в секундах)
+
+# Исходящие сообщения (лимиты Telegram)
+SEND_LIMIT_PER_CHAT = (1, 1.0)  # Не больше 1 сообщения в секунду в один чат
+SEND_LIMIT_PER_GROUP = (20, 60.0)  # Не больше 20 сообщений в минуту в одну группу
+SEND_LIMIT_GLOBAL = (30, 1.0)  # Не больше 30 сообщений в секунду на всего бота
+SEND_MAX_RETRIES = 3  # Повторных попыток после ответа 429 (retry_after)
+FANOUT_CONCURRENCY = 10  # Одновременных отправок в одной рассылке
+PRIORITY_INTERACTIVE = 0  # Ответы на действия пользователя
+PRIORITY_NOTICE = 1  # Оповещения и рассылки
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_NOTICE: "notice"}
+
+# Режим получения обновлений
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес бота; пусто — long polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Сверяется с заголовком X-Telegram-Bot-Api-Secret-Token; пусто — случайный на запуск
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))  # Render передает порт в переменной PORT
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "100"))  # Обновлений в обработке одновременно
+
+# Шардирование по чатам
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))  # Число процессов-шардов (1 — без шардирования)
+PROMOCODE_SHARD = 0  # Шард, которому принадлежат промокоды и личные сообщения
+PROMOCODE_COMMANDS = {"/promocode", "/createpromo", "/deletepromo", "/listpromos", "/togglepromo"}
+SHARD_REQUEST_TIMEOUT = 10  # Ожидание ответов других шардов (в секундах)
+PROMOCODE_RESERVATION_TTL = 6 * SHARD_REQUEST_TIMEOUT  # Резервирование промокода без подтверждения забывается
+SHARD_POLLING_TIMEOUT = 30  # Long polling в процессе-маршрутизаторе (в секундах)
+SHARD_STOP_TIMEOUT = 30  # Ожидание остановки шардов (в секундах)
+
+# Рейтинги
+TOP_SIZE = 10  # Игроков в топе игры
+LEADERBOARD_SIZE = 100  # Игроков, которых хранит общий рейтинг по каждой метрике
+LEADERBOARD_REFRESH = 60  # Полный пересчет общего рейтинга (в секундах)
+LEADERBOARD_SLICE = 5000  # Игроков за один шаг пересчета, между шагами обрабатываются обновления
+
+# Отрисовка экранов
+VIEW_CACHE_SIZE = 10_000  # Отрисованных экранов игроков в кэше
+
+# Метрики (текстовый формат Prometheus)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Порт /metrics (0 — метрики выключены), шарды: +1+номер шарда
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # По умолчанию доступен только локально
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Границы корзин (в секундах)
 
 # Глобальная переменная для graceful shutdown
 is_shutting_down = False
@@ -63,25 +165,65 @@ COUNTRIES = {
     "finland": Country("Финляндия", "🇫🇮", 5.0, tax_modifier=0.7),
     "spain": Country("Испания", "🇪🇸", 9.0, tax_modifier=1.2),
 }
+COUNTRY_IDS = {country_id: country_id for country_id in COUNTRIES}
+
+
+class Timestamp:
+    """Дескриптор времени: хранит float (секунды эпохи) в слоте, отдает datetime"""
+
+    def __init__(self, slot: str):
+        self.slot = slot
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        ts = getattr(obj, self.slot)
+        return None if ts is None else datetime.fromtimestamp(ts)
+
+    def __set__(self, obj, value):
+        if isinstance(value, datetime):
+            value = value.timestamp()
+        setattr(obj, self.slot, None if value is None else float(value))
 
 
-@dataclass
 class Player:
-    """Класс игрока"""
-    user_id: int
-    username: str
-    country: str
-    money: float = 1000.0
-    army_level: int = 1
-    city_level: int = 1
-    last_income: datetime = field(default_factory=datetime.now)
-    last_tax: datetime = field(default_factory=datetime.now)  # Время последнего сбора налогов
-    wins: int = 0
-    losses: int = 0
-    is_online: bool = True
-    has_dm_notifications: bool = True  # Флаг для уведомлений в ЛС
-    tax_paid: float = 0.0  # Всего уплачено налогов
-    used_promocodes: List[str] = field(default_factory=list)  # Использованные промокоды
+    """Класс игрока
+
+    Запись без __dict__ (__slots__): время хранится как float в полях *_ts,
+    а атрибуты last_income/last_tax по-прежнему отдают datetime.
+    """
+    __slots__ = (
+        "user_id", "username", "country", "money", "army_level", "city_level",
+        "last_income_ts", "last_tax_ts", "wins", "losses", "is_online",
+        "has_dm_notifications", "tax_paid", "used_promocodes"
+    )
+
+    last_income = Timestamp("last_income_ts")
+    last_tax = Timestamp("last_tax_ts")  # Время последнего сбора налогов
+
+    def __init__(self, user_id: int, username: str, country: str, money: float = 1000.0,
+                 army_level: int = 1, city_level: int = 1, last_income: Optional[datetime] = None,
+                 last_tax: Optional[datetime] = None, wins: int = 0, losses: int = 0,
+                 is_online: bool = True, has_dm_notifications: bool = True, tax_paid: float = 0.0,
+                 used_promocodes: Tuple[str, ...] = ()):
+        now = time.time()
+        self.user_id = user_id
+        self.username = username
+        self.country = COUNTRY_IDS.get(country, country)  # Общая строка вместо копии на каждого игрока
+        self.money = money
+        self.army_level = army_level
+        self.city_level = city_level
+        self.last_income = now if last_income is None else last_income
+        self.last_tax = now if last_tax is None else last_tax
+        self.wins = wins
+        self.losses = losses
+        self.is_online = is_online
+        self.has_dm_notifications = has_dm_notifications  # Флаг для уведомлений в ЛС
+        self.tax_paid = tax_paid  # Всего уплачено налогов
+        self.used_promocodes = tuple(used_promocodes)  # Использованные промокоды
+
+    def __repr__(self) -> str:
+        return f"Player(user_id={self.user_id!r}, username={self.username!r}, country={self.country!r})"
 
     @property
     def total_income_per_hour(self) -> float:
@@ -96,22 +238,161 @@ class Player:
         base_tax = self.total_income_per_hour * TAX_RATE * country.tax_modifier
         return max(base_tax, MIN_TAX)
 
+    @property
+    def power(self) -> float:
+        """Сила атаки"""
+        return self.army_level * (1 + 0.1 * self.city_level)
+
+
+class TaxHistory:
+    """История налогов в почасовых корзинах (кольцевой буфер на 30 дней)
+
+    Суммы за окна TAX_WINDOWS поддерживаются нарастающим итогом: при сдвиге
+    текущего часа из каждого окна вычитается выпавшая корзина, поэтому чтение
+    суммы стоит O(1), а память ограничена TAX_HISTORY_HOURS корзинами.
+    Окно считается с точностью до часа: сумма за 24 часа включает текущий
+    неполный час и 23 предыдущих. Корзины выделяются при первом сборе:
+    у чатов без налогов история почти не занимает памяти.
+    """
+
+    __slots__ = ("_buckets", "_head", "_window_sums")
+
+    def __init__(self):
+        self._buckets: Optional[List[float]] = None  # Выделяются при первом сборе (_allocate)
+        self._head: Optional[int] = None  # Номер текущего часа (часы с начала эпохи)
+        self._window_sums: Optional[Dict[int, float]] = None
+
+    def _allocate(self):
+        self._buckets = [0.0] * TAX_HISTORY_HOURS
+        self._window_sums = {hours: 0.0 for hours in TAX_WINDOWS}
+
+    @staticmethod
+    def hour_of(when: datetime) -> int:
+        return int(when.timestamp() // 3600)
+
+    def _advance(self, hour: int):
+        """Сдвинуть текущий час, вычитая выпавшие из окон корзины"""
+        if self._buckets is None:
+            # Налогов еще не было: вычитать нечего, запоминается только час
+            self._head = hour if self._head is None else max(self._head, hour)
+            return
+        if self._head is None:
+            self._head = hour
+            return
+        if hour <= self._head:
+            return
+
+        if hour - self._head >= TAX_HISTORY_HOURS:
+            self._buckets = [0.0] * TAX_HISTORY_HOURS
+            self._window_sums = {hours: 0.0 for hours in TAX_WINDOWS}
+        else:
+            for current in range(self._head + 1, hour + 1):
+                for hours in TAX_WINDOWS:
+                    expired = self._buckets[(current - hours) % TAX_HISTORY_HOURS]
+                    if expired:
+                        self._window_sums[hours] -= expired
+                self._buckets[current % TAX_HISTORY_HOURS] = 0.0
+        self._head = hour
+
+    def add(self, when: datetime, amount: float):
+        """Учесть сбор налога"""
+        hour = self.hour_of(when)
+        if self._buckets is None:
+            self._allocate()
+        self._advance(hour)
+        if hour <= self._head - TAX_HISTORY_HOURS:
+            return  # Старше хранимой истории
+
+        self._buckets[hour % TAX_HISTORY_HOURS] += amount
+        for hours in TAX_WINDOWS:
+            if hour > self._head - hours:
+                self._window_sums[hours] += amount
+
+    def total(self, hours: int, now: Optional[datetime] = None) -> float:
+        """Сумма налогов за последние hours часов (hours из TAX_WINDOWS)"""
+        self._advance(self.hour_of(now or datetime.now()))
+        if self._buckets is None:
+            return 0.0
+        return max(self._window_sums[hours], 0.0)
+
+    def bucket(self, hour: int) -> float:
+        """Сумма налогов за указанный час"""
+        if self._buckets is None or not self._head - TAX_HISTORY_HOURS < hour <= self._head:
+            return 0.0
+        return self._buckets[hour % TAX_HISTORY_HOURS]
+
+    def to_rows(self) -> List[Tuple[int, float]]:
+        """Непустые корзины в виде (час, сумма) по возрастанию часа"""
+        if self._buckets is None:
+            return []
+        rows = []
+        for hour in range(self._head - TAX_HISTORY_HOURS + 1, self._head + 1):
+            amount = self._buckets[hour % TAX_HISTORY_HOURS]
+            if amount:
+                rows.append((hour, amount))
+        return rows
+
+    @classmethod
+    def from_rows(cls, rows: List[Any]) -> "TaxHistory":
+        """Восстановить историю из корзин или из старого списка (ISO-время, сумма)"""
+        history = cls()
+        if rows and not isinstance(rows[0][0], str):
+            # Корзины заполняются напрямую, без пошагового сдвига окон
+            history._allocate()
+            history._head = max(hour for hour, _ in rows)
+            for hour, amount in rows:
+                if hour <= history._head - TAX_HISTORY_HOURS:
+                    continue
+                history._buckets[hour % TAX_HISTORY_HOURS] += amount
+                for hours in TAX_WINDOWS:
+                    if hour > history._head - hours:
+                        history._window_sums[hours] += amount
+            return history
+
+        for when, amount in rows:
+            history.add(datetime.fromisoformat(when), amount)
+        return history
+
 
-@dataclass
 class Game:
-    """Класс игры"""
-    chat_id: int
-    creator_id: int
-    players: Dict[int, Player] = field(default_factory=dict)
-    war_active: bool = False
-    war_preparation: bool = False  # Флаг подготовки к войне
-    war_participants: List[int] = field(default_factory=list)
-    war_start_time: Optional[datetime] = None
-    war_preparation_end: Optional[datetime] = None  # Время окончания подготовки
-    last_war: Optional[datetime] = None
-    created_at: datetime = field(default_factory=datetime.now)
-    treasury: float = 0.0  # Государственная казна (налоги)
-    tax_history: List[Tuple[datetime, float]] = field(default_factory=list)  # История сборов налогов
+    """Класс игры
+
+    Запись без __dict__ (__slots__): время хранится как float в полях *_ts,
+    а атрибуты war_start_time/war_preparation_end/last_war/created_at отдают datetime.
+    """
+    __slots__ = (
+        "chat_id", "creator_id", "players", "war_active", "war_preparation", "war_participants",
+        "war_start_time_ts", "war_preparation_end_ts", "last_war_ts", "created_at_ts",
+        "treasury", "tax_history", "version"
+    )
+
+    war_start_time = Timestamp("war_start_time_ts")
+    war_preparation_end = Timestamp("war_preparation_end_ts")  # Время окончания подготовки
+    last_war = Timestamp("last_war_ts")
+    created_at = Timestamp("created_at_ts")
+
+    def __init__(self, chat_id: int, creator_id: int, players: Optional[Dict[int, Player]] = None,
+                 war_active: bool = False, war_preparation: bool = False,
+                 war_participants: Optional[List[int]] = None, war_start_time: Optional[datetime] = None,
+                 war_preparation_end: Optional[datetime] = None, last_war: Optional[datetime] = None,
+                 created_at: Optional[datetime] = None, treasury: float = 0.0,
+                 tax_history: Optional[TaxHistory] = None):
+        self.chat_id = chat_id
+        self.creator_id = creator_id
+        self.players: Dict[int, Player] = {} if players is None else players
+        self.war_active = war_active
+        self.war_preparation = war_preparation  # Флаг подготовки к войне
+        self.war_participants: List[int] = [] if war_participants is None else war_participants
+        self.war_start_time = war_start_time
+        self.war_preparation_end = war_preparation_end
+        self.last_war = last_war
+        self.created_at = time.time() if created_at is None else created_at
+        self.treasury = treasury  # Государственная казна (налоги)
+        self.tax_history = TaxHistory() if tax_history is None else tax_history  # История сборов налогов
+        self.version = 0  # Растет при каждом изменении (mark_dirty), не сохраняется
+
+    def __repr__(self) -> str:
+        return f"Game(chat_id={self.chat_id!r}, players={len(self.players)})"
 
 
 @dataclass
@@ -134,226 +415,2141 @@ class GameStates(StatesGroup):
     waiting_for_promocode = State()
 
 
+class GameTable(dict):
+    """Игры по chat_id, часть из которых не загружена в память
+
+    Холодные игры — еще не восстановленные после запуска (лежат
+    закодированным JSON, restore_cold_games) и выгруженные за простой
+    (evict_idle_games, их заново читает хранилище). Холодная игра
+    возвращается в память при первом обращении (games[chat_id], get, in).
+    items()/values() перебирают только игры в памяти.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cold: Dict[int, bytes] = {}
+        self._evicted: Dict[int, int] = {}  # chat_id -> версия игры на момент выгрузки
+        self._active: "OrderedDict[int, float]" = OrderedDict()  # chat_id -> последнее обращение (monotonic)
+        for chat_id in self:
+            self.touch(chat_id)
+
+    @property
+    def cold_count(self) -> int:
+        return len(self._cold)
+
+    @property
+    def evicted_count(self) -> int:
+        return len(self._evicted)
+
+    def cold_ids(self, limit: Optional[int] = None) -> List[int]:
+        return list(self._cold if limit is None else islice(self._cold, limit))
+
+    def add_cold(self, chat_id: int, raw: bytes):
+        self._cold[chat_id] = raw
+
+    def loaded(self, chat_id: int) -> Optional[Game]:
+        """Игра, если она в памяти (без восстановления)"""
+        return dict.get(self, chat_id)
+
+    def touch(self, chat_id: int):
+        """Отметить обращение к игре в памяти"""
+        if dict.__contains__(self, chat_id):
+            self._active[chat_id] = time.monotonic()
+            self._active.move_to_end(chat_id)
+
+    def idle_ids(self, idle_before: float, keep: int = 0) -> List[int]:
+        """Игры в памяти от давних к недавним: без обращений с idle_before и сверх предела keep"""
+        excess = len(self._active) - keep if keep else 0
+        chat_ids = []
+        for chat_id, last_seen in self._active.items():
+            if last_seen >= idle_before and len(chat_ids) >= excess:
+                break
+            chat_ids.append(chat_id)
+        return chat_ids
+
+    def evict(self, chat_id: int):
+        """Убрать игру из памяти (она уже сохранена в хранилище)"""
+        game = dict.pop(self, chat_id)
+        self._active.pop(chat_id, None)
+        self._evicted[chat_id] = game.version
+
+    def __setitem__(self, chat_id: int, game: Game):
+        dict.__setitem__(self, chat_id, game)
+        self.touch(chat_id)
+
+    def __missing__(self, chat_id: int) -> Game:
+        if (self._cold or self._evicted) and self.restore([chat_id]):
+            return dict.__getitem__(self, chat_id)
+        raise KeyError(chat_id)
+
+    def __contains__(self, chat_id: Any) -> bool:
+        return dict.__contains__(self, chat_id) or (
+            bool(self._cold or self._evicted) and bool(self.restore([chat_id])))
+
+    def get(self, chat_id: Any, default: Any = None) -> Any:
+        game = dict.get(self, chat_id)
+        if game is None and (self._cold or self._evicted) and self.restore([chat_id]):
+            game = dict.__getitem__(self, chat_id)
+        return default if game is None else game
+
+    def restore(self, chat_ids: List[int]) -> Dict[int, Game]:
+        """Вернуть холодные игры в память и подключить их (register_games)
+
+        Выгруженной игре сначала собираются налоги, пропущенные за время
+        простоя (catch_up_taxes).
+        """
+        restored = {}
+        now = datetime.now()
+        for chat_id in chat_ids:
+            evicted = self._evicted.pop(chat_id, None)
+            try:
+                raw = self._cold.pop(chat_id, None) if evicted is None else storage.load_game(chat_id)
+                if raw is None:
+                    if evicted is not None:
+                        logger.error(f"Выгруженная игра {chat_id} не найдена в хранилище")
+                    continue
+                game = game_from_row(chat_id, json_loads(raw))
+            except Exception as e:
+                logger.error(f"Не удалось восстановить игру {chat_id}: {e}")
+                if evicted is not None:
+                    self._evicted[chat_id] = evicted  # Попробуем снова при следующем обращении
+                continue
+            self[chat_id] = game
+            if evicted is not None:
+                game.version = evicted + 1  # Кэш экранов не должен принять ее за прежнюю версию
+                catch_up_taxes(game, now)
+            restored[chat_id] = game
+        if restored:
+            register_games(restored)
+        return restored
+
+
 # Глобальные переменные
-games: Dict[int, Game] = {}
+games: GameTable = GameTable()
 promocodes: Dict[str, Promocode] = {}
 bot: Optional[Bot] = None
+dispatcher: Optional[Dispatcher] = None
+shard_link: Optional["ShardLink"] = None  # Связь с другими шардами (только в процессе-шарде)
+# (код, user_id) -> (чаты игрока, время): первая фаза награды промокодом другого шарда
+promocode_reservations: Dict[Tuple[str, int], Tuple[List[int], float]] = {}
+
+
+class PlayerIndex:
+    """Обратные индексы игроков: user_id -> чаты и (чат, страна) -> user_id
+
+    Обновляются при вступлении (add) и выходе игрока (remove) и
+    пересобираются при загрузке данных (rebuild). Большинство игроков
+    состоит в одном чате, поэтому для них хранится сам chat_id, а множество
+    заводится только со второго чата.
+    """
+
+    def __init__(self):
+        self._chats_by_user: Dict[int, Any] = {}  # user_id -> chat_id или Set[chat_id]
+        self._countries_by_chat: Dict[int, Dict[str, int]] = {}  # chat_id -> {страна: user_id}
+
+    def add(self, chat_id: int, player: Player):
+        chats = self._chats_by_user.get(player.user_id)
+        if chats is None:
+            self._chats_by_user[player.user_id] = chat_id
+        elif isinstance(chats, set):
+            chats.add(chat_id)
+        elif chats != chat_id:
+            self._chats_by_user[player.user_id] = {chats, chat_id}
+        self._countries_by_chat.setdefault(chat_id, {})[player.country] = player.user_id
+
+    def remove(self, chat_id: int, player: Player):
+        chats = self._chats_by_user.get(player.user_id)
+        if isinstance(chats, set):
+            chats.discard(chat_id)
+            if len(chats) == 1:
+                self._chats_by_user[player.user_id] = next(iter(chats))
+        elif chats == chat_id:
+            del self._chats_by_user[player.user_id]
+
+        countries = self._countries_by_chat.get(chat_id)
+        if countries and countries.get(player.country) == player.user_id:
+            del countries[player.country]
+            if not countries:
+                del self._countries_by_chat[chat_id]
+
+    def rebuild(self, all_games: Dict[int, "Game"]):
+        """Пересобрать индексы по текущему состоянию игр"""
+        self._chats_by_user = {}
+        self._countries_by_chat = {}
+        for chat_id, game in all_games.items():
+            for player in game.players.values():
+                self.add(chat_id, player)
+
+    def chats_of(self, user_id: int) -> List[int]:
+        """Чаты, в которых состоит игрок"""
+        chats = self._chats_by_user.get(user_id)
+        if chats is None:
+            return []
+        return list(chats) if isinstance(chats, set) else [chats]
+
+    def country_owner(self, chat_id: int, country_id: str) -> Optional[int]:
+        """Игрок, занявший страну в чате (None, если страна свободна)"""
+        return self._countries_by_chat.get(chat_id, {}).get(country_id)
+
+
+# Ленивое начисление дохода
+def settle_income(player: Player, now: Optional[datetime] = None):
+    """Начислить пассивный доход игроку за время с последнего расчета
+
+    Доход считается в закрытой форме (base_income * city_level * прошедшее время)
+    только тогда, когда состояние игрока читается или изменяется.
+    """
+    if not player.is_online:
+        return
+
+    now_ts = time.time() if now is None else now.timestamp()
+    time_diff = now_ts - player.last_income_ts
+    if time_diff > 0:
+        country = COUNTRIES[player.country]
+        player.money += country.base_income * player.city_level * time_diff
+        player.last_income_ts = now_ts
+
+
+def projected_money(player: Player, now_ts: float) -> float:
+    """Деньги игрока на момент now_ts вместе с еще не начисленным доходом (игрок не меняется)"""
+    if not player.is_online or now_ts <= player.last_income_ts:
+        return player.money
+    return player.money + COUNTRIES[player.country].base_income * player.city_level * (now_ts - player.last_income_ts)
+
+
+def top_players(players, key, n: int = TOP_SIZE) -> List[Player]:
+    """n лучших игроков по ключу без сортировки всего списка"""
+    return heapq.nlargest(n, players, key=key)
+
+
+def settle_game_income(game: Game, now: Optional[datetime] = None):
+    """Начислить пассивный доход всем игрокам игры"""
+    if now is None:
+        now = datetime.now()
+
+    for player in game.players.values():
+        settle_income(player, now)
+
+
+# Блокировки чатов и промокодов
+class KeyedLocks:
+    """asyncio-блокировки по ключу (чат или промокод)
+
+    Запись создается при первом захвате и удаляется, когда блокировку
+    никто не держит и не ждет, поэтому их число не растет вместе с числом
+    чатов. Блокировки не реентерабельны. hold() отдает функцию release,
+    снимающую блокировки досрочно: запись ключа (busy) остается до выхода
+    из hold().
+    """
+
+    def __init__(self):
+        self._locks: Dict[Any, List[Any]] = {}  # ключ -> [Lock, держащих и ждущих]
+        self.acquired = 0
+        self.contended = 0  # Захватов, которым пришлось ждать
+
+    def locked(self, key: Any) -> bool:
+        entry = self._locks.get(key)
+        return entry is not None and entry[0].locked()
+
+    def busy(self, key: Any) -> bool:
+        """Блокировку ключа держат или ждут"""
+        return key in self._locks
+
+    @asynccontextmanager
+    async def hold(self, *keys: Any):
+        """Захватить блокировки ключей в порядке сортировки (без взаимных блокировок)"""
+        entries = []
+        for key in sorted(set(keys)):
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            entries.append((key, entry))
+
+        taken = []
+
+        def release():
+            while taken:
+                taken.pop().release()
+
+        try:
+            for key, entry in entries:
+                if entry[0].locked():
+                    self.contended += 1
+                await entry[0].acquire()
+                taken.append(entry[0])
+                self.acquired += 1
+            yield release
+        finally:
+            release()
+            for key, entry in entries:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"held": len(self._locks), "acquired": self.acquired, "contended": self.contended}
+
+
+@asynccontextmanager
+async def hold_chat(chat_id: int):
+    """Блокировка чата до конца блока или до первого запроса к Telegram
+
+    Проверки и изменения игры идут до ответа, а ответ может ждать лимитов
+    SendQueue секундами: release_chat_lock_middleware снимает блокировку
+    перед любым запросом, чтобы очередь отправки не задерживала другие
+    обновления чата.
+    """
+    async with chat_locks.hold(chat_id) as release:
+        token = chat_lock_release.set(release)
+        try:
+            yield
+        finally:
+            chat_lock_release.reset(token)
+
+
+async def release_chat_lock_middleware(make_request, bot_instance, method):
+    """Middleware сессии бота: запрос к Telegram завершает критическую секцию обработчика"""
+    release = chat_lock_release.get()
+    if release is not None:
+        release()
+    return await make_request(bot_instance, method)
+
+
+async def chat_lock_middleware(handler, event, data):
+    """Обновления одного чата обрабатываются по очереди, разных чатов — параллельно"""
+    chat = data.get("event_chat")
+    if chat is None:
+        return await handler(event, data)
+    games.touch(chat.id)
+    async with hold_chat(chat.id):
+        return await handler(event, data)
+
+
+# Планировщик налогов
+class TaxScheduler:
+    """Очередь дедлайнов сбора налогов (min-heap по last_tax + TAX_INTERVAL)
+
+    Тик забирает из кучи только тех игроков, у которых подошел срок.
+    Устаревшие записи отбрасываются лениво: актуальный дедлайн каждого
+    игрока хранится в self._deadlines.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, int]] = []
+        self._deadlines: Dict[Tuple[int, int], float] = {}
+        self.collected = 0  # Успешных сборов
+        self.deferred = 0  # Переносов (не хватило денег или идет война)
+        self.last_lag = 0.0  # Задержка последнего сбора относительно дедлайна (сек)
+        self.max_lag = 0.0
+
+    def schedule(self, chat_id: int, user_id: int, due_ts: float):
+        """Запланировать сбор налога у игрока на момент due_ts (секунды эпохи)"""
+        self._deadlines[(chat_id, user_id)] = due_ts
+        heapq.heappush(self._heap, (due_ts, chat_id, user_id))
+
+    def unschedule(self, chat_id: int, user_id: int):
+        """Снять игрока с учета (запись в куче станет устаревшей)"""
+        self._deadlines.pop((chat_id, user_id), None)
+
+    def rebuild(self, all_games: Dict[int, "Game"]):
+        """Пересобрать очередь по текущему состоянию игр"""
+        self._deadlines = {}
+        for chat_id, game in all_games.items():
+            for user_id, player in game.players.items():
+                self._deadlines[(chat_id, user_id)] = player.last_tax_ts + TAX_INTERVAL
+        self._heap = [(due_ts, chat_id, user_id) for (chat_id, user_id), due_ts in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def add_games(self, added: Dict[int, "Game"]):
+        """Поставить в очередь игроков игр, загруженных после rebuild"""
+        for chat_id, game in added.items():
+            for user_id, player in game.players.items():
+                self.schedule(chat_id, user_id, player.last_tax_ts + TAX_INTERVAL)
+
+    def pop_due(self, now: datetime) -> List[Tuple[int, int]]:
+        """Забрать всех игроков, у которых наступил срок налога"""
+        now_ts = now.timestamp()
+        due_players = []
+        while self._heap and self._heap[0][0] <= now_ts:
+            due_ts, chat_id, user_id = heapq.heappop(self._heap)
+            key = (chat_id, user_id)
+            if self._deadlines.get(key) != due_ts:
+                continue  # Устаревшая запись
+            del self._deadlines[key]
+            lag = now_ts - due_ts
+            self.last_lag = lag
+            if lag > self.max_lag:
+                self.max_lag = lag
+            due_players.append(key)
+        return due_players
+
+    def metrics(self) -> Dict[str, float]:
+        """Метрики очереди: глубина, задержка, счетчики"""
+        next_due_in = None
+        if self._deadlines:
+            # Вершина кучи может быть устаревшей, поэтому берем минимум по актуальным дедлайнам
+            while self._heap and self._deadlines.get((self._heap[0][1], self._heap[0][2])) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            next_due_in = max(self._heap[0][0] - datetime.now().timestamp(), 0.0)
+        return {
+            "queue_depth": len(self._deadlines),
+            "heap_size": len(self._heap),
+            "next_due_in": next_due_in,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+            "collected": self.collected,
+            "deferred": self.deferred,
+        }
+
+
+class WarScheduler:
+    """Таймеры войн: абсолютные дедлайны в min-heap и одна задача на все войны
+
+    Дедлайн подготовки — war_preparation_end, дедлайн боя — war_start_time
+    + WAR_DURATION. Оба хранятся в самой игре, поэтому после перезапуска
+    очередь восстанавливается из хранилища (rebuild), а просроченные
+    таймеры срабатывают сразу. Устаревшие записи кучи отбрасываются
+    лениво по self._deadlines.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, str]] = []
+        self._deadlines: Dict[int, Tuple[float, str]] = {}  # chat_id -> (дедлайн, "start" или "finish")
+        self._wakeup: Optional[asyncio.Event] = None
+        self._running: Set[asyncio.Task] = set()
+        self.fired = 0  # Сработавших таймеров
+        self.last_lag = 0.0  # Опоздание последнего таймера относительно дедлайна (сек)
+        self.max_lag = 0.0
+
+    def schedule(self, chat_id: int, kind: str, due_ts: float):
+        """Запланировать начало ("start") или окончание ("finish") войны в чате"""
+        self._deadlines[chat_id] = (due_ts, kind)
+        heapq.heappush(self._heap, (due_ts, chat_id, kind))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def unschedule(self, chat_id: int):
+        """Снять таймер чата (запись в куче станет устаревшей)"""
+        self._deadlines.pop(chat_id, None)
+
+    @staticmethod
+    def deadline_of(game: "Game", now_ts: float) -> Optional[Tuple[float, str]]:
+        """Таймер, который нужен игре по ее состоянию: (дедлайн, вид) или None"""
+        if game.war_preparation:
+            return game.war_preparation_end_ts or now_ts, "start"
+        if game.war_active:
+            return (game.war_start_time_ts + WAR_DURATION if game.war_start_time_ts else now_ts), "finish"
+        return None
+
+    def rebuild(self, all_games: Dict[int, "Game"]):
+        """Восстановить таймеры по состоянию игр (после загрузки данных)"""
+        now_ts = time.time()
+        self._deadlines = {}
+        for chat_id, game in all_games.items():
+            deadline = self.deadline_of(game, now_ts)
+            if deadline is not None:
+                self._deadlines[chat_id] = deadline
+        self._heap = [(due_ts, chat_id, kind) for chat_id, (due_ts, kind) in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def add_games(self, added: Dict[int, "Game"]):
+        """Запустить таймеры игр, загруженных после rebuild"""
+        now_ts = time.time()
+        for chat_id, game in added.items():
+            deadline = self.deadline_of(game, now_ts)
+            if deadline is not None:
+                self.schedule(chat_id, deadline[1], deadline[0])
+
+    def pop_due(self, now_ts: float) -> List[Tuple[int, str]]:
+        """Забрать все таймеры, у которых наступил срок"""
+        due = []
+        while self._heap and self._heap[0][0] <= now_ts:
+            due_ts, chat_id, kind = heapq.heappop(self._heap)
+            if self._deadlines.get(chat_id) != (due_ts, kind):
+                continue  # Устаревшая запись
+            del self._deadlines[chat_id]
+            self.last_lag = now_ts - due_ts
+            self.max_lag = max(self.max_lag, self.last_lag)
+            due.append((chat_id, kind))
+        return due
+
+    def next_due_in(self, now_ts: float) -> Optional[float]:
+        """Секунд до ближайшего актуального дедлайна (None, если таймеров нет)"""
+        while self._heap and self._deadlines.get(self._heap[0][1]) != (self._heap[0][0], self._heap[0][2]):
+            heapq.heappop(self._heap)
+        return max(self._heap[0][0] - now_ts, 0.0) if self._heap else None
+
+    async def _fire(self, handler, chat_id: int):
+        async with hold_chat(chat_id):
+            await handler(chat_id)
+
+    async def run(self):
+        """Единственная задача, исполняющая все таймеры войн"""
+        self._wakeup = asyncio.Event()
+        while not is_shutting_down:
+            try:
+                for chat_id, kind in self.pop_due(time.time()):
+                    self.fired += 1
+                    handler = start_war if kind == "start" else finish_war
+                    # Рассылки одной войны не задерживают таймеры других чатов
+                    task = asyncio.create_task(self._fire(handler, chat_id))
+                    self._running.add(task)
+                    task.add_done_callback(self._running.discard)
+
+                delay = self.next_due_in(time.time())
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), WAR_TIMER_IDLE if delay is None else delay)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                logger.error(f"Ошибка в таймерах войн: {e}")
+                await asyncio.sleep(5)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Метрики таймеров: число войн, ближайший дедлайн, опоздание"""
+        return {
+            "timers": len(self._deadlines),
+            "running": len(self._running),
+            "next_due_in": self.next_due_in(time.time()),
+            "fired": self.fired,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
+
+
+def collect_tax(game: Game, player: Player, now: datetime) -> Optional[float]:
+    """Собрать налог с игрока, если он в сети и хватает денег, и вернуть его сумму"""
+    if not player.is_online:
+        return None  # Игроки не в сети налог не платят
+
+    settle_income(player, now)
+    tax_amount = player.next_tax_amount
+    if player.money < tax_amount:
+        return None
+
+    player.money -= tax_amount
+    player.tax_paid += tax_amount
+    game.treasury += tax_amount
+    game.tax_history.add(now, tax_amount)
+    player.last_tax_ts = now.timestamp()
+    return tax_amount
+
+
+def tax_retry_delay(player: Player) -> float:
+    """Через сколько секунд у игрока накопится сумма налога"""
+    if not player.is_online:
+        return TAX_RETRY_INTERVAL
+
+    income_per_sec = COUNTRIES[player.country].base_income * player.city_level
+    deficit = player.next_tax_amount - player.money
+    if income_per_sec <= 0 or deficit <= 0:
+        return 1.0
+    return max(deficit / income_per_sec, 1.0)
+
+
+def catch_up_taxes(game: Game, now: datetime) -> int:
+    """Собрать налоги, пропущенные игрой, пока она была выгружена из памяти
+
+    Каждый налог собирается в момент своего дедлайна, как это сделал бы
+    update_income_and_taxes: доход начисляется до дедлайна, а при нехватке
+    денег сбор переносится на момент, когда их станет достаточно.
+    Возвращает число собранных налогов.
+    """
+    now_ts = now.timestamp()
+    collected = 0
+    for user_id, player in game.players.items():
+        due_ts = player.last_tax_ts + TAX_INTERVAL
+        while due_ts <= now_ts:
+            when = datetime.fromtimestamp(due_ts)
+            tax_amount = collect_tax(game, player, when)
+            if tax_amount is None:
+                if not player.is_online:
+                    break  # Без дохода денег не прибавится
+                due_ts += tax_retry_delay(player)
+                continue
+            mark_tax_collected(game, when, tax_amount)
+            mark_dirty(game.chat_id, user_id)
+            collected += 1
+            due_ts = player.last_tax_ts + TAX_INTERVAL
+    if collected:
+        mark_dirty(game.chat_id)
+        tax_scheduler.collected += collected
+    return collected
+
+
+# Общий рейтинг игроков всех чатов
+LEADERBOARD_METRICS = {
+    "money": projected_money,
+    "power": lambda player, now_ts: player.power,
+    "tax_paid": lambda player, now_ts: player.tax_paid,
+}
+
+
+class ScoreRecord:
+    """Очки игрока выгруженной игры: только поля, которые читают метрики рейтингов"""
+    __slots__ = ("user_id", "country", "money", "city_level", "last_income_ts", "is_online", "power", "tax_paid")
+
+    def __init__(self, player: Player):
+        self.user_id = player.user_id
+        self.country = player.country
+        self.money = player.money
+        self.city_level = player.city_level
+        self.last_income_ts = player.last_income_ts
+        self.is_online = player.is_online
+        self.power = player.power
+        self.tax_paid = player.tax_paid
+
+
+class Leaderboard:
+    """Лучшие игроки всех чатов по одной метрике
+
+    Хранится только size записей (chat_id, user_id) -> очки. Изменившийся
+    игрок (touch) сразу попадает в рейтинг, если обгоняет последнего, и
+    обновляет свои очки, если уже в нем. Падения очков и рост дохода
+    остальных игроков учитываются полным пересчетом (replace).
+    """
+
+    def __init__(self, metric, size: int = LEADERBOARD_SIZE):
+        self.metric = metric
+        self.size = size
+        self._scores: Dict[Tuple[int, int], float] = {}
+        self._floor = float("-inf")  # Очки последнего, когда рейтинг заполнен
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def _update_floor(self):
+        self._floor = min(self._scores.values()) if len(self._scores) >= self.size else float("-inf")
+
+    def touch(self, chat_id: int, player: Player, now_ts: float):
+        key = (chat_id, player.user_id)
+        score = self.metric(player, now_ts)
+        if key not in self._scores and score <= self._floor:
+            return
+
+        self._scores[key] = score
+        if len(self._scores) > self.size:
+            del self._scores[min(self._scores, key=self._scores.__getitem__)]
+        self._update_floor()
+
+    def discard(self, chat_id: int, user_id: int):
+        if self._scores.pop((chat_id, user_id), None) is not None:
+            self._update_floor()
+
+    def chat_ids(self) -> Set[int]:
+        return {chat_id for chat_id, _ in self._scores}
+
+    def replace(self, scored: List[Tuple[float, int, int]]):
+        """Заменить рейтинг результатом полного пересчета: [(очки, chat_id, user_id)]"""
+        self._scores = {(chat_id, user_id): score for score, chat_id, user_id in scored}
+        self._update_floor()
+
+    def top(self, n: int, now_ts: float) -> List[Tuple[int, Player, float]]:
+        """n лучших: [(chat_id, игрок, очки)] с очками на момент now_ts"""
+        entries = []
+        for chat_id, user_id in self._scores:
+            game = games.get(chat_id)
+            player = game.players.get(user_id) if game else None
+            if player is not None:
+                entries.append((chat_id, player, self.metric(player, now_ts)))
+        return heapq.nlargest(n, entries, key=lambda entry: entry[2])
+
+
+class Leaderboards:
+    """Общие рейтинги по всем метрикам и их фоновый пересчет
+
+    Пересчет идет срезами по LEADERBOARD_SLICE игроков и отдает управление
+    event loop между срезами. Игроки, изменившиеся во время пересчета,
+    повторно применяются к его результату, чтобы их не потерять. Игроки
+    выгруженных игр участвуют в пересчете по сохраненным очкам (park).
+    """
+
+    def __init__(self):
+        self.boards = {name: Leaderboard(metric) for name, metric in LEADERBOARD_METRICS.items()}
+        self._touched: Optional[Set[Tuple[int, int]]] = None  # Изменения во время пересчета
+        self._parked: Dict[int, Tuple[ScoreRecord, ...]] = {}  # chat_id выгруженной игры -> очки игроков
+        self.refreshes = 0
+        self.last_refresh_seconds = 0.0
+
+    def board(self, name: str) -> Leaderboard:
+        return self.boards[name]
+
+    def touch(self, chat_id: int, user_id: int):
+        game = games.loaded(chat_id)
+        if game is None and chat_id in self._parked:
+            return  # Выгруженная игра не меняется, ее очки уже сохранены
+        player = game.players.get(user_id) if game else None
+        if player is None:
+            self.discard(chat_id, user_id)
+            return
+
+        now_ts = time.time()
+        for board in self.boards.values():
+            board.touch(chat_id, player, now_ts)
+        if self._touched is not None:
+            self._touched.add((chat_id, user_id))
+
+    def discard(self, chat_id: int, user_id: int):
+        for board in self.boards.values():
+            board.discard(chat_id, user_id)
+
+    def chat_ids(self) -> Set[int]:
+        """Чаты игроков из рейтингов: их игры не выгружаются из памяти"""
+        return set().union(*(board.chat_ids() for board in self.boards.values()))
+
+    def park(self, chat_id: int, game: "Game"):
+        """Сохранить очки игроков игры, выгружаемой из памяти"""
+        self._parked[chat_id] = tuple(ScoreRecord(player) for player in game.players.values())
+
+    def unpark(self, chat_id: int):
+        """Забыть сохраненные очки: игра вернулась в память"""
+        self._parked.pop(chat_id, None)
+
+    def _scan(self, players, now_ts: float, heaps: Dict[str, List[Tuple[float, int, int]]]):
+        for chat_id, player in players:
+            for name, board in self.boards.items():
+                entry = (board.metric(player, now_ts), chat_id, player.user_id)
+                heap = heaps[name]
+                if len(heap) < board.size:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+
+    def _apply(self, heaps: Dict[str, List[Tuple[float, int, int]]]):
+        for name, board in self.boards.items():
+            board.replace(heaps[name])
+
+    def rebuild(self, all_games: Dict[int, "Game"]):
+        """Пересчитать рейтинги целиком (при загрузке данных)"""
+        heaps = {name: [] for name in self.boards}
+        now_ts = time.time()
+        self._parked = {}  # При загрузке выгруженных игр еще нет
+        self._scan(((chat_id, player) for chat_id, game in all_games.items()
+                    for player in game.players.values()), now_ts, heaps)
+        self._apply(heaps)
+
+    async def refresh(self):
+        """Полный пересчет срезами, не блокирующий обработку обновлений"""
+        started = time.perf_counter()
+        self._touched = set()
+        try:
+            heaps = {name: [] for name in self.boards}
+            now_ts = time.time()
+            batch = []
+            loaded = ((chat_id, game.players.values()) for chat_id, game in list(games.items()))
+            for chat_id, players in itertools.chain(loaded, list(self._parked.items())):
+                batch.extend((chat_id, player) for player in list(players))
+                if len(batch) >= LEADERBOARD_SLICE:
+                    self._scan(batch, now_ts, heaps)
+                    batch = []
+                    await asyncio.sleep(0)
+            self._scan(batch, now_ts, heaps)
+            self._apply(heaps)
+            touched = self._touched
+        finally:
+            self._touched = None
+
+        for chat_id, user_id in touched:
+            self.touch(chat_id, user_id)
+        self.refreshes += 1
+        self.last_refresh_seconds = time.perf_counter() - started
+
+    async def run(self):
+        """Периодический пересчет рейтингов"""
+        while not is_shutting_down:
+            await asyncio.sleep(LEADERBOARD_REFRESH)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Ошибка пересчета рейтингов: {e}")
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "refreshes": self.refreshes,
+            "last_refresh_seconds": self.last_refresh_seconds,
+            "entries": {name: len(board) for name, board in self.boards.items()},
+            "parked_chats": len(self._parked),
+        }
+
+
+# Порядок захвата: промокод, затем чаты. Обработчик обновления держит блокировку
+# своего чата до первого запроса к Telegram (hold_chat)
+chat_locks = KeyedLocks()
+promocode_locks = KeyedLocks()
+chat_lock_release: contextvars.ContextVar[Optional[Callable[[], None]]] = contextvars.ContextVar(
+    "chat_lock_release", default=None)
+tax_scheduler = TaxScheduler()
+war_scheduler = WarScheduler()
+player_index = PlayerIndex()
+leaderboards = Leaderboards()
+
+
+# Массовые проходы по экономике (догоняющий расчет после простоя, общий сбор налогов)
+def economy_pass(all_games: Dict[int, Game], now: datetime) -> Dict[int, List[Tuple[int, float]]]:
+    """Начислить доход и собрать просроченные налоги, вернуть платежи по чатам"""
+    now_ts = now.timestamp()
+    payments: Dict[int, List[Tuple[int, float]]] = {}
+    for chat_id, game in all_games.items():
+        for player in game.players.values():
+            settle_income(player, now)
+            if game.war_active or not player.is_online or now_ts - player.last_tax_ts < TAX_INTERVAL:
+                continue
+            tax_amount = player.next_tax_amount
+            if player.money >= tax_amount:
+                player.money -= tax_amount
+                player.tax_paid += tax_amount
+                player.last_tax_ts = now_ts
+                payments.setdefault(chat_id, []).append((player.user_id, tax_amount))
+    return payments
+
+
+def run_economy_pass(now: Optional[datetime] = None, target: Optional[Dict[int, Game]] = None) -> int:
+    """Глобальный проход: доход всем игрокам и сбор всех просроченных налогов
+
+    target — игры, восстановленные после запуска (по умолчанию все загруженные).
+    Возвращает количество собранных налогов.
+    """
+    if now is None:
+        now = datetime.now()
+    passed = games if target is None else target
+
+    payments = economy_pass(passed, now)
+
+    collected = 0
+    for chat_id, paid in payments.items():
+        game = passed[chat_id]
+        total = sum(amount for _, amount in paid)
+        game.treasury += total
+        game.tax_history.add(now, total)
+        mark_dirty(chat_id)
+        mark_tax_collected(game, now, total)
+        for user_id, _ in paid:
+            mark_dirty(chat_id, user_id)
+        collected += len(paid)
+
+    if target is None:
+        tax_scheduler.rebuild(games)
+    else:
+        tax_scheduler.add_games(target)
+    tax_scheduler.collected += collected
+    return collected
+
+
+def register_games(restored: Dict[int, Game]) -> int:
+    """Подключить игры, восстановленные после запуска
+
+    Как и при полной загрузке: доход и налоги за простой, таймеры налогов
+    и войн, индексы игроков и общий рейтинг. Возвращает число собранных налогов.
+    """
+    collected = run_economy_pass(target=restored)
+    war_scheduler.add_games(restored)
+    for chat_id, game in restored.items():
+        leaderboards.unpark(chat_id)
+        for player in game.players.values():
+            player_index.add(chat_id, player)
+            leaderboards.touch(chat_id, player.user_id)
+    return collected
+
+
+def evict_games(chat_ids: List[int], pinned: Set[int]) -> int:
+    """Выгрузить игры из памяти (действие, обратное register_games), вернуть число выгруженных
+
+    Выгружаются только сохраненные игры вне войны, которые сейчас никто не
+    обрабатывает и чьих игроков нет в рейтингах (pinned). Индекс игроков
+    продолжает указывать на выгруженные игры, а таймеры налогов снимаются:
+    пропущенные налоги соберет catch_up_taxes при возвращении игры. Очки
+    игроков остаются в пересчете рейтингов (leaderboards.park).
+    """
+    evicted = 0
+    for chat_id in chat_ids:
+        game = games.loaded(chat_id)
+        if (game is None or game.war_active or game.war_preparation or chat_id in pinned
+                or chat_id in dirty.games or chat_id in dirty.players or chat_locks.busy(chat_id)):
+            continue
+        for user_id in game.players:
+            tax_scheduler.unschedule(chat_id, user_id)
+        leaderboards.park(chat_id, game)
+        games.evict(chat_id)
+        evicted += 1
+    return evicted
 
 
 # Функции для работы с данными
-def save_data():
-    """Сохранить данные игр и промокодов"""
+def serialize_game(game: Game) -> Dict[str, Any]:
+    """Снимок полей игры без игроков (изменяемые списки копируются)"""
+    return {
+        "chat_id": game.chat_id,
+        "creator_id": game.creator_id,
+        "war_active": game.war_active,
+        "war_preparation": game.war_preparation,
+        "war_participants": list(game.war_participants),
+        "war_start_time": game.war_start_time.isoformat() if game.war_start_time else None,
+        "war_preparation_end": game.war_preparation_end.isoformat() if game.war_preparation_end else None,
+        "last_war": game.last_war.isoformat() if game.last_war else None,
+        "created_at": game.created_at.isoformat(),
+        "treasury": game.treasury,
+        "tax_history": game.tax_history.to_rows()
+    }
+
+
+def serialize_player(player: Player) -> Dict[str, Any]:
+    """Снимок игрока в виде словаря"""
+    return {
+        "user_id": player.user_id,
+        "username": player.username,
+        "country": player.country,
+        "money": player.money,
+        "army_level": player.army_level,
+        "city_level": player.city_level,
+        "last_income": player.last_income.isoformat(),
+        "last_tax": player.last_tax.isoformat(),
+        "wins": player.wins,
+        "losses": player.losses,
+        "is_online": player.is_online,
+        "has_dm_notifications": player.has_dm_notifications,
+        "tax_paid": player.tax_paid,
+        "used_promocodes": list(player.used_promocodes)
+    }
+
+
+def serialize_promocode(promo: Promocode) -> Dict[str, Any]:
+    """Снимок промокода в виде словаря"""
+    return {
+        "reward": promo.reward,
+        "max_uses": promo.max_uses,
+        "used_count": promo.used_count,
+        "created_by": promo.created_by,
+        "created_at": promo.created_at.isoformat(),
+        "is_active": promo.is_active,
+        "users_used": list(promo.users_used)
+    }
+
+
+class DirtyTracker:
+    """Учет записей, измененных с момента последнего сохранения"""
+
+    def __init__(self):
+        self.games: Set[int] = set()  # Изменены поля самой игры
+        self.players: Dict[int, Set[int]] = {}  # chat_id -> изменённые user_id
+        self.promocodes: Set[str] = set()
+        self.tax_rows: List[Tuple[int, int, float]] = []  # Измененные корзины истории налогов
+        self.events: List[Dict[str, Any]] = []  # Игровые события для журнала
+
+    def __bool__(self) -> bool:
+        return bool(self.games or self.players or self.promocodes or self.tax_rows)
+
+    def take(self) -> "DirtyTracker":
+        """Забрать накопленные изменения и начать учет заново"""
+        taken = DirtyTracker()
+        taken.games, self.games = self.games, set()
+        taken.players, self.players = self.players, {}
+        taken.promocodes, self.promocodes = self.promocodes, set()
+        taken.tax_rows, self.tax_rows = self.tax_rows, []
+        taken.events, self.events = self.events, []
+        return taken
+
+
+dirty = DirtyTracker()
+
+
+def mark_dirty(chat_id: int, user_id: Optional[int] = None):
+    """Отметить игру (или одного игрока в ней) как измененную"""
+    game = games.loaded(chat_id)
+    if game is not None:
+        game.version += 1
+    if user_id is None:
+        dirty.games.add(chat_id)
+    else:
+        dirty.players.setdefault(chat_id, set()).add(user_id)
+        leaderboards.touch(chat_id, user_id)
+
+
+def mark_promocode_dirty(code: str):
+    """Отметить промокод как измененный (в том числе удаленный)"""
+    dirty.promocodes.add(code)
+
+
+def mark_tax_collected(game: Game, when: datetime, amount: float):
+    """Запомнить измененную корзину истории налогов для хранилищ, пишущих ее построчно"""
+    hour = TaxHistory.hour_of(when)
+    dirty.tax_rows.append((game.chat_id, hour, game.tax_history.bucket(hour)))
+    record_event("tax_collected", chat_id=game.chat_id, amount=amount)
+
+
+def record_event(event: str, **fields: Any):
+    """Добавить игровое событие в журнал ближайшего сохранения"""
+    dirty.events.append({"event": event, "ts": datetime.now().isoformat(), **fields})
+
+
+def build_changes() -> Dict[str, Any]:
+    """Снять копию измененных записей (выполняется в потоке event loop)
+
+    Удаленные записи передаются как None.
+    """
+    changed = dirty.take()
+    changes: Dict[str, Any] = {
+        "games": {}, "players": {}, "promocodes": {}, "tax_rows": changed.tax_rows, "events": changed.events
+    }
+
+    for chat_id in changed.games:
+        game = games.get(chat_id)
+        changes["games"][chat_id] = serialize_game(game) if game else None
+
+    for chat_id, user_ids in changed.players.items():
+        game = games.get(chat_id)
+        if game is None:
+            continue
+        changes["players"][chat_id] = {
+            user_id: serialize_player(game.players[user_id]) if user_id in game.players else None
+            for user_id in user_ids
+        }
+
+    for code in changed.promocodes:
+        promo = promocodes.get(code)
+        changes["promocodes"][code] = serialize_promocode(promo) if promo else None
+
+    return changes
+
+
+def write_bytes_atomic(path: str, payload: bytes) -> int:
+    """Записать данные во временный файл и атомарно подменить им целевой"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(payload)
+
+
+# JSON-кодек: orjson или msgspec, если установлены, иначе стандартный json
+if orjson is not None:
+    JSON_CODEC = "orjson"
+    JSON_DECODE_ERRORS: Tuple[type, ...] = (orjson.JSONDecodeError,)
+
+    def json_dumps(data: Any) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    def json_loads(data: Any) -> Any:
+        return orjson.loads(data)
+elif msgspec is not None:
+    JSON_CODEC = "msgspec"
+    JSON_DECODE_ERRORS = (msgspec.DecodeError,)
+    _msgspec_encoder = msgspec.json.Encoder()
+    _msgspec_decoder = msgspec.json.Decoder()
+
+    def json_dumps(data: Any) -> bytes:
+        return _msgspec_encoder.encode(data)
+
+    def json_loads(data: Any) -> Any:
+        return _msgspec_decoder.decode(data)
+else:
+    JSON_CODEC = "json"
+    JSON_DECODE_ERRORS = (ValueError,)
+
+    def json_dumps(data: Any) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def json_loads(data: Any) -> Any:
+        return json.loads(data)
+
+
+def read_json_file(path: str) -> Any:
+    """Прочитать и разобрать JSON-файл выбранным кодеком"""
+    with open(path, 'rb') as f:
+        return json_loads(f.read())
+
+
+def iter_json_object(path: str) -> Iterator[Tuple[str, Any]]:
+    """Потоковый разбор JSON-объекта верхнего уровня: пары (ключ, значение) по одной
+
+    Файл читается блоками по LOAD_CHUNK, в памяти одновременно находится
+    только текущий блок и одно значение, а не весь разобранный файл.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    with open(path, 'rb') as f:
+        buf, pos, eof = "", 0, False
+
+        def read_more() -> bool:
+            nonlocal buf, pos, eof
+            if eof:
+                return False
+            chunk = f.read(LOAD_CHUNK)
+            eof = not chunk
+            buf = buf[pos:] + utf8.decode(chunk, final=eof)
+            pos = 0
+            return True
+
+        def next_char() -> str:
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n":
+                    pos += 1
+                if pos < len(buf):
+                    return buf[pos]
+                if not read_more():
+                    return ""
+
+        def next_value() -> Any:
+            nonlocal pos
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # Значение оборвано концом блока
+                    if read_more():
+                        continue
+                    raise
+                if end == len(buf) and read_more():
+                    continue  # Число на границе блока могло продолжаться
+                pos = end
+                return value
+
+        if next_char() != "{":
+            raise ValueError(f"{path}: ожидался JSON-объект")
+        pos += 1
+        if next_char() == "}":
+            return
+        while True:
+            key = next_value()
+            if next_char() != ":":
+                raise ValueError(f"{path}: ожидалось ':' после ключа {key!r}")
+            pos += 1
+            next_char()
+            yield key, next_value()
+            separator = next_char()
+            pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"{path}: ожидалось ',' после значения {key!r}")
+            next_char()
+
+
+def changes_from_rows(games_data: Dict[str, Any], promocodes_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Представить полный набор данных в формате изменений (для миграции)"""
+    changes: Dict[str, Any] = {
+        "games": {}, "players": {}, "promocodes": dict(promocodes_data), "tax_rows": [], "events": []
+    }
+    for chat_id_str, game_data in games_data.items():
+        chat_id = int(chat_id_str)
+        changes["games"][chat_id] = {key: value for key, value in game_data.items() if key != "players"}
+        changes["players"][chat_id] = {
+            int(user_id): player_data for user_id, player_data in game_data["players"].items()
+        }
+        history = TaxHistory.from_rows(game_data.get("tax_history", []))
+        changes["games"][chat_id]["tax_history"] = history.to_rows()
+        for hour, amount in history.to_rows():
+            changes["tax_rows"].append((chat_id, hour, amount))
+    return changes
+
+
+class StorageBackend:
+    """Базовый класс хранилища
+
+    load возвращает данные в виде словарей того же формата, что и JSON-файлы,
+    write принимает изменения из build_changes. write вызывается из рабочего
+    потока, но никогда не параллельно.
+    """
+
+    def load(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        raise NotImplementedError
+
+    def load_raw(self) -> Optional[Tuple[Iterator[Tuple[str, bytes]], Dict[str, Any]]]:
+        """Потоковая загрузка: игры по одной закодированным JSON и промокоды
+
+        None — хранилище умеет только полную загрузку (load).
+        """
+        return None
+
+    def load_game(self, chat_id: int) -> Optional[bytes]:
+        """Одна сохраненная игра закодированным JSON (для игр, выгруженных из памяти)
+
+        Вызывается из event loop, пока в рабочем потоке может идти запись
+        других игр. None — игры нет в хранилище.
+        """
+        raise NotImplementedError
+
+    def write(self, changes: Dict[str, Any]) -> int:
+        raise NotImplementedError
+
+    def maintain(self):
+        """Периодическое обслуживание (вызывается из auto_save_data)"""
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonStorage(StorageBackend):
+    """Хранилище в JSON-файлах с инкрементальным кодированием
+
+    Для каждой игры и каждого игрока хранится уже закодированный фрагмент
+    JSON, поэтому при сохранении кодируются только измененные записи, а файл
+    собирается из готовых фрагментов. Подходит для небольших установок.
+
+    В файле каждая игра записана отдельной строкой, поэтому load_raw делит
+    его на игры без разбора JSON.
+    """
+
+    def __init__(self, games_file: str, promocodes_file: str):
+        self.games_file = games_file
+        self.promocodes_file = promocodes_file
+        self._game_fragments: Dict[str, bytes] = {}  # chat_id -> поля игры без игроков
+        self._player_fragments: Dict[str, Dict[str, bytes]] = {}  # chat_id -> user_id -> игрок
+        self._promocodes: Dict[str, Dict[str, Any]] = {}
+        self._unencoded: Dict[str, Any] = {}  # Игры с диска (словарь или JSON в байтах), еще не разбитые на фрагменты
+        self._materializing = threading.Lock()  # load_game из event loop не должен застать игру между словарями
+
+    def load(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        games_data: Dict[str, Any] = {}
+        promocodes_data: Dict[str, Any] = {}
+
+        if os.path.exists(self.games_file):
+            games_data = read_json_file(self.games_file)
+        else:
+            logger.info("Файл данных не найден, будет создан новый")
+
+        if os.path.exists(self.promocodes_file):
+            promocodes_data = read_json_file(self.promocodes_file)
+
+        # Фрагменты кодируются лениво, чтобы не замедлять запуск
+        self._game_fragments = {}
+        self._player_fragments = {}
+        self._unencoded = dict(games_data)
+        self._promocodes = dict(promocodes_data)
+
+        return games_data, promocodes_data
+
+    def load_raw(self) -> Tuple[Iterator[Tuple[str, bytes]], Dict[str, Any]]:
+        promocodes_data: Dict[str, Any] = {}
+        if os.path.exists(self.promocodes_file):
+            promocodes_data = read_json_file(self.promocodes_file)
+
+        self._game_fragments = {}
+        self._player_fragments = {}
+        self._unencoded = {}
+        self._promocodes = dict(promocodes_data)
+        return self._iter_raw_games(), promocodes_data
+
+    def _iter_raw_games(self) -> Iterator[Tuple[str, bytes]]:
+        """Игры из файла по одной: (chat_id, JSON игры в байтах)
+
+        Файлы другого вида (старый формат в одну строку, indent=2) разбираются
+        потоково через iter_json_object и перекодируются по одной игре.
+        """
+        if not os.path.exists(self.games_file):
+            logger.info("Файл данных не найден, будет создан новый")
+            return
+
+        with open(self.games_file, 'rb') as f:
+            if f.readline() == b"{\n":
+                line = f.readline()
+                if line.startswith(b'"') or line.startswith(b"}"):
+                    while not line.startswith(b"}"):
+                        if not line.endswith(b"\n"):
+                            raise ValueError(f"{self.games_file}: файл оборван")
+                        key_end = line.index(b'":')
+                        chat_id, raw = line[1:key_end].decode(), line[key_end + 2:].rstrip(b",\n")
+                        self._unencoded[chat_id] = raw
+                        yield chat_id, raw
+                        line = f.readline()
+                    return
+
+        for chat_id, game_data in iter_json_object(self.games_file):
+            raw = json_dumps(game_data)
+            self._unencoded[chat_id] = raw
+            yield chat_id, raw
+
+    def _materialize(self, chat_id: str):
+        """Закодировать фрагменты игры, прочитанной с диска"""
+        game_data = self._unencoded.get(chat_id)
+        if game_data is None:
+            return
+        if isinstance(game_data, bytes):
+            game_data = json_loads(game_data)
+        game_row = {key: value for key, value in game_data.items() if key != "players"}
+        game_fragment = json_dumps(game_row)
+        player_fragments = {
+            user_id: json_dumps(player_data) for user_id, player_data in game_data["players"].items()
+        }
+        with self._materializing:
+            self._game_fragments[chat_id] = game_fragment
+            self._player_fragments[chat_id] = player_fragments
+            del self._unencoded[chat_id]
+
+    def _game_json(self, chat_id: str, game_fragment: bytes) -> bytes:
+        """Собрать JSON игры из фрагментов"""
+        players = b",".join(
+            b'"%s":%s' % (user_id.encode(), fragment)
+            for user_id, fragment in self._player_fragments.get(chat_id, {}).items()
+        )
+        return b'%s,"players":{%s}}' % (game_fragment[:-1], players)
+
+    def load_game(self, chat_id: int) -> Optional[bytes]:
+        """Игра из уже загруженных данных: с диска как есть или из фрагментов"""
+        key = str(chat_id)
+        with self._materializing:
+            game_data = self._unencoded.get(key)
+            game_fragment = self._game_fragments.get(key)
+        if game_data is not None:
+            return game_data if isinstance(game_data, bytes) else json_dumps(game_data)
+        return None if game_fragment is None else self._game_json(key, game_fragment)
+
+    def apply(self, changes: Dict[str, Any]) -> Tuple[bool, bool]:
+        """Обновить кэш фрагментов, вернуть признаки изменения игр и промокодов"""
+        for chat_id in list(changes["games"]) + list(changes["players"]):
+            self._materialize(str(chat_id))
+
+        for chat_id, game_row in changes["games"].items():
+            key = str(chat_id)
+            if game_row is None:
+                self._game_fragments.pop(key, None)
+                self._player_fragments.pop(key, None)
+                continue
+            self._game_fragments[key] = json_dumps(game_row)
+            self._player_fragments.setdefault(key, {})
+
+        for chat_id, player_rows in changes["players"].items():
+            fragments = self._player_fragments.setdefault(str(chat_id), {})
+            for user_id, player_row in player_rows.items():
+                if player_row is None:
+                    fragments.pop(str(user_id), None)
+                else:
+                    fragments[str(user_id)] = json_dumps(player_row)
+
+        for code, promo_row in changes["promocodes"].items():
+            if promo_row is None:
+                self._promocodes.pop(code, None)
+            else:
+                self._promocodes[code] = promo_row
+
+        return bool(changes["games"] or changes["players"]), bool(changes["promocodes"])
+
+    def write(self, changes: Dict[str, Any]) -> int:
+        """Применить изменения и записать затронутые файлы, вернуть число байт"""
+        games_changed, promocodes_changed = self.apply(changes)
+        written = 0
+        if games_changed:
+            written += self.write_games_file()
+        if promocodes_changed:
+            written += self.write_promocodes_file()
+        return written
+
+    def write_games_file(self) -> int:
+        """Собрать файл игр из закодированных фрагментов и записать его (по игре на строке)"""
+        parts = []
+        for chat_id, game_data in list(self._unencoded.items()):
+            if isinstance(game_data, bytes):
+                # Неизмененная игра с диска пишется как есть
+                parts.append(b'"%s":%s' % (chat_id.encode(), game_data))
+            else:
+                self._materialize(chat_id)
+
+        for chat_id, game_fragment in self._game_fragments.items():
+            parts.append(b'"%s":%s' % (chat_id.encode(), self._game_json(chat_id, game_fragment)))
+        body = b",\n".join(parts)
+        return write_bytes_atomic(self.games_file, b"{\n" + body + (b"\n" if parts else b"") + b"}\n")
+
+    def write_promocodes_file(self) -> int:
+        return write_bytes_atomic(self.promocodes_file, json_dumps(self._promocodes))
+
+
+class SqliteStorage(StorageBackend):
+    """Хранилище в SQLite (WAL)
+
+    Игры, игроки, история налогов и промокоды лежат в отдельных таблицах.
+    Все изменения одного сохранения записываются одной транзакцией, поэтому
+    объем записи пропорционален числу измененных строк.
+    """
+
+    GAME_COLUMNS = (
+        "chat_id", "creator_id", "war_active", "war_preparation", "war_participants",
+        "war_start_time", "war_preparation_end", "last_war", "created_at", "treasury"
+    )
+    PLAYER_COLUMNS = (
+        "chat_id", "user_id", "username", "country", "money", "army_level", "city_level",
+        "last_income", "last_tax", "wins", "losses", "is_online", "has_dm_notifications",
+        "tax_paid", "used_promocodes"
+    )
+    PROMOCODE_COLUMNS = (
+        "code", "reward", "max_uses", "used_count", "created_by", "created_at", "is_active", "users_used"
+    )
+    JSON_COLUMNS = {"war_participants", "used_promocodes", "users_used"}
+    BOOL_COLUMNS = {"war_active", "war_preparation", "is_online", "has_dm_notifications", "is_active"}
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS games (
+            chat_id INTEGER PRIMARY KEY,
+            creator_id INTEGER NOT NULL,
+            war_active INTEGER NOT NULL DEFAULT 0,
+            war_preparation INTEGER NOT NULL DEFAULT 0,
+            war_participants TEXT NOT NULL DEFAULT '[]',
+            war_start_time TEXT,
+            war_preparation_end TEXT,
+            last_war TEXT,
+            created_at TEXT NOT NULL,
+            treasury REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS players (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            country TEXT NOT NULL,
+            money REAL NOT NULL,
+            army_level INTEGER NOT NULL,
+            city_level INTEGER NOT NULL,
+            last_income TEXT NOT NULL,
+            last_tax TEXT NOT NULL,
+            wins INTEGER NOT NULL DEFAULT 0,
+            losses INTEGER NOT NULL DEFAULT 0,
+            is_online INTEGER NOT NULL DEFAULT 1,
+            has_dm_notifications INTEGER NOT NULL DEFAULT 1,
+            tax_paid REAL NOT NULL DEFAULT 0,
+            used_promocodes TEXT NOT NULL DEFAULT '[]',
+            PRIMARY KEY (chat_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_players_user ON players (user_id, chat_id);
+        CREATE TABLE IF NOT EXISTS tax_history (
+            chat_id INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            PRIMARY KEY (chat_id, hour)
+        );
+        CREATE TABLE IF NOT EXISTS promocodes (
+            code TEXT PRIMARY KEY,
+            reward REAL NOT NULL,
+            max_uses INTEGER NOT NULL,
+            used_count INTEGER NOT NULL,
+            created_by INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            is_active INTEGER NOT NULL,
+            users_used TEXT NOT NULL DEFAULT '[]'
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._reader: Optional[sqlite3.Connection] = None  # Чтение выгруженных игр из event loop
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Соединение используется из рабочего потока сохранения, но записи не пересекаются
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._migrate_tax_history()
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def _migrate_tax_history(self):
+        """Перевести старую построчную историю налогов в почасовые корзины"""
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(tax_history)")]
+        if "collected_at" not in columns:
+            return
+
+        histories: Dict[int, TaxHistory] = {}
+        for chat_id, collected_at, amount in self._conn.execute(
+                "SELECT chat_id, collected_at, amount FROM tax_history ORDER BY collected_at"):
+            histories.setdefault(chat_id, TaxHistory()).add(datetime.fromisoformat(collected_at), amount)
+
+        with self._conn:
+            self._conn.execute("DROP TABLE tax_history")
+            self._conn.executescript(self.SCHEMA)
+            self._conn.executemany(
+                "INSERT INTO tax_history (chat_id, hour, amount) VALUES (?, ?, ?)",
+                [(chat_id, hour, amount) for chat_id, history in histories.items() for hour, amount in history.to_rows()]
+            )
+        logger.info(f"История налогов переведена в почасовые корзины для {len(histories)} игр")
+
+    def _to_db(self, column: str, value: Any) -> Any:
+        if column in self.JSON_COLUMNS:
+            return json_dumps(value).decode('utf-8')
+        if column in self.BOOL_COLUMNS:
+            return int(bool(value))
+        return value
+
+    def _from_db(self, columns: Tuple[str, ...], values: Tuple[Any, ...]) -> Dict[str, Any]:
+        row = {}
+        for column, value in zip(columns, values):
+            if column in self.JSON_COLUMNS:
+                value = json_loads(value)
+            elif column in self.BOOL_COLUMNS:
+                value = bool(value)
+            row[column] = value
+        return row
+
+    def is_empty(self) -> bool:
+        conn = self._connect()
+        return conn.execute("SELECT COUNT(*) FROM games").fetchone()[0] == 0
+
+    def _select_games(self, conn: sqlite3.Connection, where: str = "",
+                      params: Tuple[Any, ...] = ()) -> Dict[str, Any]:
+        """Игры с игроками и историей налогов в формате JSON-файла (where — условие на chat_id)"""
+        games_data: Dict[str, Any] = {}
+
+        for values in conn.execute(f"SELECT {', '.join(self.GAME_COLUMNS)} FROM games {where}", params):
+            game_row = self._from_db(self.GAME_COLUMNS, values)
+            game_row["tax_history"] = []
+            game_row["players"] = {}
+            games_data[str(game_row["chat_id"])] = game_row
+
+        for values in conn.execute(f"SELECT {', '.join(self.PLAYER_COLUMNS)} FROM players {where}", params):
+            player_row = self._from_db(self.PLAYER_COLUMNS, values)
+            chat_id = player_row.pop("chat_id")
+            game_row = games_data.get(str(chat_id))
+            if game_row is not None:
+                game_row["players"][str(player_row["user_id"])] = player_row
+
+        for chat_id, hour, amount in conn.execute(
+                f"SELECT chat_id, hour, amount FROM tax_history {where} ORDER BY chat_id, hour", params):
+            game_row = games_data.get(str(chat_id))
+            if game_row is not None:
+                game_row["tax_history"].append((hour, amount))
+
+        return games_data
+
+    def _select_promocodes(self, conn: sqlite3.Connection) -> Dict[str, Any]:
+        """Промокоды в формате JSON-файла"""
+        promocodes_data: Dict[str, Any] = {}
+        for values in conn.execute(f"SELECT {', '.join(self.PROMOCODE_COLUMNS)} FROM promocodes"):
+            promo_row = self._from_db(self.PROMOCODE_COLUMNS, values)
+            promocodes_data[promo_row.pop("code")] = promo_row
+        return promocodes_data
+
+    def load(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        conn = self._connect()
+        return self._select_games(conn), self._select_promocodes(conn)
+
+    def load_shard(self, shard_id: int, shard_count: int) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Игры одного шарда (shard_of) и все промокоды — для переноса в файл шарда"""
+        conn = self._connect()
+        # В SQLite остаток от деления отрицательного chat_id отрицателен, в Python — нет
+        games_data = self._select_games(conn, "WHERE ((chat_id % ?) + ?) % ? = ?",
+                                        (shard_count, shard_count, shard_count, shard_id))
+        return games_data, self._select_promocodes(conn)
+
+    def load_game(self, chat_id: int) -> Optional[bytes]:
+        """Прочитать игру отдельным соединением (WAL: не ждет записи из рабочего потока)"""
+        if self._reader is None:
+            self._connect()
+            self._reader = sqlite3.connect(self.path, check_same_thread=False)
+        game_row = self._select_games(self._reader, "WHERE chat_id = ?", (chat_id,)).get(str(chat_id))
+        return None if game_row is None else json_dumps(game_row)
+
+    def write(self, changes: Dict[str, Any]) -> int:
+        """Записать изменения одной транзакцией, вернуть число измененных строк"""
+        conn = self._connect()
+        game_rows, deleted_games = [], []
+        for chat_id, game_row in changes["games"].items():
+            if game_row is None:
+                deleted_games.append((chat_id,))
+            else:
+                game_rows.append(tuple(self._to_db(column, game_row[column]) for column in self.GAME_COLUMNS))
+
+        player_rows, deleted_players = [], []
+        for chat_id, rows in changes["players"].items():
+            for user_id, player_row in rows.items():
+                if player_row is None:
+                    deleted_players.append((chat_id, user_id))
+                else:
+                    player_row = dict(player_row, chat_id=chat_id)
+                    player_rows.append(tuple(self._to_db(column, player_row[column]) for column in self.PLAYER_COLUMNS))
+
+        promo_rows, deleted_promos = [], []
+        for code, promo_row in changes["promocodes"].items():
+            if promo_row is None:
+                deleted_promos.append((code,))
+            else:
+                promo_row = dict(promo_row, code=code)
+                promo_rows.append(tuple(self._to_db(column, promo_row[column]) for column in self.PROMOCODE_COLUMNS))
+
+        def upsert(table: str, columns: Tuple[str, ...]) -> str:
+            return f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+        with conn:
+            conn.executemany(upsert("games", self.GAME_COLUMNS), game_rows)
+            conn.executemany(upsert("players", self.PLAYER_COLUMNS), player_rows)
+            conn.executemany(upsert("promocodes", self.PROMOCODE_COLUMNS), promo_rows)
+            conn.executemany("INSERT OR REPLACE INTO tax_history (chat_id, hour, amount) VALUES (?, ?, ?)",
+                             changes["tax_rows"])
+            # Корзины старше хранимой истории больше не нужны
+            conn.executemany("DELETE FROM tax_history WHERE chat_id = ? AND hour <= ?",
+                             [(chat_id, hour - TAX_HISTORY_HOURS) for chat_id, hour, _ in changes["tax_rows"]])
+            conn.executemany("DELETE FROM players WHERE chat_id = ? AND user_id = ?", deleted_players)
+            conn.executemany("DELETE FROM players WHERE chat_id = ?", deleted_games)
+            conn.executemany("DELETE FROM tax_history WHERE chat_id = ?", deleted_games)
+            conn.executemany("DELETE FROM games WHERE chat_id = ?", deleted_games)
+            conn.executemany("DELETE FROM promocodes WHERE code = ?", deleted_promos)
+
+        return (len(game_rows) + len(player_rows) + len(promo_rows) + len(changes["tax_rows"])
+                + len(deleted_games) + len(deleted_players) + len(deleted_promos))
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def apply_changes_to_rows(games_data: Dict[str, Any], promocodes_data: Dict[str, Any], changes: Dict[str, Any]):
+    """Применить изменения к данным в формате JSON-файлов"""
+    for chat_id, game_row in changes["games"].items():
+        key = str(chat_id)
+        if game_row is None:
+            games_data.pop(key, None)
+            continue
+        players = games_data[key]["players"] if key in games_data else {}
+        games_data[key] = dict(game_row, players=players)
+
+    for chat_id, player_rows in changes["players"].items():
+        game_data = games_data.get(str(chat_id))
+        if game_data is None:
+            continue
+        for user_id, player_row in player_rows.items():
+            if player_row is None:
+                game_data["players"].pop(str(user_id), None)
+            else:
+                game_data["players"][str(user_id)] = player_row
+
+    for code, promo_row in changes["promocodes"].items():
+        if promo_row is None:
+            promocodes_data.pop(code, None)
+        else:
+            promocodes_data[code] = promo_row
+
+
+class LogStorage(StorageBackend):
+    """Снимок в JSON-файлах плюс журнал изменений (append-only)
+
+    Каждое сохранение дописывает в журнал одну строку JSON с измененными
+    записями и игровыми событиями. Снимок периодически перезаписывается
+    целиком, после чего журнал обнуляется (компакция). При запуске состояние
+    собирается из снимка и хвоста журнала.
+
+    Политика fsync (FSYNC_POLICY):
+    • "event" - после каждой записи в журнал
+    • "batch" - не чаще раза в FSYNC_BATCH_MS миллисекунд; если запись пришла
+      раньше, таймер выполнит fsync не позже чем через FSYNC_BATCH_MS
+    • "snapshot" - только при компакции
+    """
+
+    def __init__(self, log_file: str, snapshot: JsonStorage, fsync_policy: str = "batch"):
+        self.log_file = log_file
+        self.snapshot = snapshot
+        self.fsync_policy = fsync_policy
+        self._lock = threading.Lock()  # write и maintain приходят из разных рабочих потоков
+        self._log = None
+        self._log_size = 0
+        self._unsynced = False
+        self._last_fsync = time.monotonic()
+        self._fsync_timer: Optional[threading.Timer] = None
+        self._last_compaction = time.monotonic()
+
+    def load(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        with self._lock:
+            games_data, promocodes_data = self.snapshot.load()
+            replayed = 0
+            if os.path.exists(self.log_file):
+                with open(self.log_file, 'rb') as f:
+                    for line in f:
+                        try:
+                            changes = json_loads(line)
+                        except JSON_DECODE_ERRORS:
+                            # Оборванная последняя строка после аварийной остановки
+                            logger.warning("Журнал изменений обрывается, хвост пропущен")
+                            break
+                        apply_changes_to_rows(games_data, promocodes_data, changes)
+                        self.snapshot.apply(changes)
+                        replayed += 1
+            if replayed:
+                logger.info(f"Из журнала применено {replayed} записей")
+                self._compact()
+            return games_data, promocodes_data
+
+    def write(self, changes: Dict[str, Any]) -> int:
+        """Дописать изменения в журнал, вернуть число байт"""
+        record = {key: changes[key] for key in ("games", "players", "promocodes", "events")}
+        line = json_dumps(record) + b"\n"
+        with self._lock:
+            log = self._open_log()
+            log.write(line)
+            log.flush()
+            self._log_size += len(line)
+            self._unsynced = True
+            if self.fsync_policy == "event":
+                self._fsync()
+            elif self.fsync_policy == "batch":
+                self._maybe_fsync()
+
+            self.snapshot.apply(changes)
+            if self._log_size >= EVENT_LOG_MAX_BYTES:
+                self._compact()
+        return len(line)
+
+    def load_game(self, chat_id: int) -> Optional[bytes]:
+        # Без self._lock: снимок уже содержит все записанные в журнал изменения
+        return self.snapshot.load_game(chat_id)
+
+    def maintain(self):
+        with self._lock:
+            if self.fsync_policy == "batch":
+                self._maybe_fsync()
+            if self._log_size and time.monotonic() - self._last_compaction >= SNAPSHOT_INTERVAL:
+                self._compact()
+
+    def close(self):
+        with self._lock:
+            if self._fsync_timer is not None:
+                self._fsync_timer.cancel()
+                self._fsync_timer = None
+            if self._log_size:
+                self._compact()
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def _open_log(self):
+        if self._log is None:
+            self._log = open(self.log_file, 'ab')
+            self._log_size = self._log.tell()
+        return self._log
+
+    def _fsync(self):
+        if self._log is not None and self._unsynced:
+            os.fsync(self._log.fileno())
+        self._unsynced = False
+        self._last_fsync = time.monotonic()
+
+    def _maybe_fsync(self):
+        if not self._unsynced:
+            return
+        delay = FSYNC_BATCH_MS / 1000 - (time.monotonic() - self._last_fsync)
+        if delay <= 0:
+            self._fsync()
+        elif self._fsync_timer is None:
+            # Следующей записи может не быть: fsync по таймеру, а не по write
+            self._fsync_timer = threading.Timer(delay, self._timed_fsync)
+            self._fsync_timer.daemon = True
+            self._fsync_timer.start()
+
+    def _timed_fsync(self):
+        with self._lock:
+            self._fsync_timer = None
+            self._maybe_fsync()
+
+    def _compact(self):
+        """Записать полный снимок и обнулить журнал"""
+        self.snapshot.write_games_file()
+        self.snapshot.write_promocodes_file()
+        log = self._open_log()
+        log.truncate(0)
+        log.seek(0)
+        os.fsync(log.fileno())
+        self._log_size = 0
+        self._unsynced = False
+        self._last_compaction = time.monotonic()
+        logger.debug("Журнал изменений сжат в снимок")
+
+
+def create_storage(backend: str) -> StorageBackend:
+    """Создать хранилище по имени ("json", "sqlite" или "log")"""
+    if backend == "sqlite":
+        return SqliteStorage(SQLITE_FILE)
+    if backend == "log":
+        return LogStorage(EVENT_LOG_FILE, JsonStorage(GAMES_FILE, PROMOCODES_FILE), FSYNC_POLICY)
+    if backend != "json":
+        logger.warning(f"Неизвестное хранилище {backend!r}, используется json")
+    return JsonStorage(GAMES_FILE, PROMOCODES_FILE)
+
+
+class SqliteFsmStorage(BaseStorage):
+    """Хранилище состояний FSM в SQLite (WAL) со временем жизни записей
+
+    Состояние и данные диалога переживают перезапуск. Запись живет ttl
+    секунд с последнего изменения: просроченные записи не читаются и раз
+    в FSM_PURGE_INTERVAL удаляются фоновой задачей run(). Файл в режиме WAL
+    открывают все процессы-шарды одновременно (ключ содержит чат, поэтому
+    шарды не пишут одни и те же строки), и запись может ждать запись
+    другого шарда: все запросы идут в отдельном потоке, а не в event loop.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS fsm (
+            bot_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            destiny TEXT NOT NULL,
+            state TEXT,
+            data BLOB,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (bot_id, chat_id, user_id, destiny)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_fsm_expires ON fsm (expires_at);
+    """
+    KEY_FILTER = "bot_id = ? AND chat_id = ? AND user_id = ? AND destiny = ?"
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def _call(self, fn, *args: Any) -> Any:
+        """Выполнить fn в потоке хранилища (один поток: соединение не делится между потоками)"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Автокоммит: каждая операция — отдельная короткая транзакция
+            self._conn = sqlite3.connect(self.path, timeout=FSM_BUSY_TIMEOUT, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    @staticmethod
+    def _key(key: StorageKey) -> Tuple[int, int, int, str]:
+        return key.bot_id, key.chat_id, key.user_id, key.destiny
+
+    def _upsert(self, key: StorageKey, column: str, value: Any):
+        """Записать state или data, сохранив вторую колонку, если запись не просрочена"""
+        conn = self._connect()
+        now = time.time()
+        other = "data" if column == "state" else "state"
+        conn.execute(
+            f"INSERT INTO fsm (bot_id, chat_id, user_id, destiny, {column}, expires_at) VALUES (?, ?, ?, ?, ?, ?) "
+            f"ON CONFLICT (bot_id, chat_id, user_id, destiny) DO UPDATE SET {column} = excluded.{column}, "
+            f"{other} = CASE WHEN fsm.expires_at > ? THEN fsm.{other} END, expires_at = excluded.expires_at",
+            (*self._key(key), value, now + self.ttl, now)
+        )
+        if value is None:
+            # Пустая запись (state.clear()) не хранится
+            conn.execute(f"DELETE FROM fsm WHERE {self.KEY_FILTER} AND state IS NULL AND data IS NULL",
+                         self._key(key))
+
+    def _select(self, key: StorageKey, column: str) -> Any:
+        row = self._connect().execute(
+            f"SELECT {column} FROM fsm WHERE {self.KEY_FILTER} AND expires_at > ?",
+            (*self._key(key), time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        """Удалить просроченные записи, вернуть их количество"""
+        now = time.time() if now is None else now
+        removed = self._connect().execute("DELETE FROM fsm WHERE expires_at <= ?", (now,)).rowcount
+        if removed:
+            logger.info(f"Удалено просроченных состояний FSM: {removed}")
+        return removed
+
+    async def run(self):
+        """Фоновая задача: удалять просроченные записи раз в FSM_PURGE_INTERVAL"""
+        while not is_shutting_down:
+            await asyncio.sleep(FSM_PURGE_INTERVAL)
+            try:
+                await self._call(self.purge_expired)
+            except Exception as e:
+                logger.error(f"Ошибка очистки состояний FSM: {e}")
+
+    async def set_state(self, bot: Bot, key: StorageKey, state: Any = None) -> None:
+        await self._call(self._upsert, key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, bot: Bot, key: StorageKey) -> Optional[str]:
+        return await self._call(self._select, key, "state")
+
+    async def set_data(self, bot: Bot, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._call(self._upsert, key, "data", json_dumps(data) if data else None)
+
+    async def get_data(self, bot: Bot, key: StorageKey) -> Dict[str, Any]:
+        data = await self._call(self._select, key, "data")
+        return json_loads(data) if data else {}
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self) -> None:
+        if self._executor is not None:
+            await self._call(self._close)
+            self._executor.shutdown()
+            self._executor = None
+
+
+def create_fsm_storage(backend: str) -> BaseStorage:
+    """Создать хранилище состояний FSM по имени ("sqlite", "redis" или "memory")"""
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError:
+            logger.warning("Пакет redis не установлен, состояния FSM хранятся в SQLite")
+        else:
+            return RedisStorage.from_url(FSM_REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    elif backend != "sqlite":
+        logger.warning(f"Неизвестное хранилище FSM {backend!r}, используется sqlite")
+    return SqliteFsmStorage(FSM_FILE, FSM_STATE_TTL)
+
+
+def migrate_json_to_sqlite():
+    """Одноразовый перенос данных из JSON-файлов в SQLite"""
+    source = JsonStorage(GAMES_FILE, PROMOCODES_FILE)
+    target = SqliteStorage(SQLITE_FILE)
     try:
-        # Сохраняем игры
-        data = {}
-        for chat_id, game in games.items():
-            game_data = {
-                "chat_id": game.chat_id,
-                "creator_id": game.creator_id,
-                "war_active": game.war_active,
-                "war_preparation": game.war_preparation,
-                "war_participants": game.war_participants,
-                "war_start_time": game.war_start_time.isoformat() if game.war_start_time else None,
-                "war_preparation_end": game.war_preparation_end.isoformat() if game.war_preparation_end else None,
-                "last_war": game.last_war.isoformat() if game.last_war else None,
-                "created_at": game.created_at.isoformat(),
-                "treasury": game.treasury,
-                "tax_history": [(dt.isoformat(), amount) for dt, amount in game.tax_history],
-                "players": {}
-            }
-            for user_id, player in game.players.items():
-                game_data["players"][str(user_id)] = {
-                    "user_id": player.user_id,
-                    "username": player.username,
-                    "country": player.country,
-                    "money": player.money,
-                    "army_level": player.army_level,
-                    "city_level": player.city_level,
-                    "last_income": player.last_income.isoformat(),
-                    "last_tax": player.last_tax.isoformat(),
-                    "wins": player.wins,
-                    "losses": player.losses,
-                    "is_online": player.is_online,
-                    "has_dm_notifications": player.has_dm_notifications,
-                    "tax_paid": player.tax_paid,
-                    "used_promocodes": player.used_promocodes
-                }
-            data[str(chat_id)] = game_data
-
-        with open(GAMES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-
-        # Сохраняем промокоды
-        promocodes_data = {}
-        for code, promo in promocodes.items():
-            promocodes_data[code] = {
-                "reward": promo.reward,
-                "max_uses": promo.max_uses,
-                "used_count": promo.used_count,
-                "created_by": promo.created_by,
-                "created_at": promo.created_at.isoformat(),
-                "is_active": promo.is_active,
-                "users_used": promo.users_used
-            }
-
-        with open(PROMOCODES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(promocodes_data, f, ensure_ascii=False, indent=2)
+        if not target.is_empty():
+            logger.error(f"База {SQLITE_FILE} уже содержит данные, миграция отменена")
+            return False
+
+        games_data, promocodes_data = source.load()
+        rows = target.write(changes_from_rows(games_data, promocodes_data))
+        logger.info(
+            f"Миграция завершена: {len(games_data)} игр, {len(promocodes_data)} промокодов, "
+            f"{rows} строк записано в {SQLITE_FILE}"
+        )
+        return True
+    finally:
+        target.close()
+
 
+storage: StorageBackend = create_storage(STORAGE_BACKEND)
+
+
+def save_data():
+    """Сохранить измененные данные игр и промокодов (синхронно)"""
+    try:
+        storage.write(build_changes())
         logger.info("Данные сохранены успешно")
     except Exception as e:
         logger.error(f"Ошибка сохранения данных: {e}")
 
 
+class SaveCoordinator:
+    """Координатор фоновых сохранений
+
+    Обработчики только сообщают, что состояние изменилось (notify). Запись
+    выполняется, когда уведомления затихли на min_interval секунд, но не
+    позже чем через max_delay секунд после первого несохраненного изменения
+    и не чаще раза в min_interval секунд. Копия измененных записей снимается
+    в event loop, а кодирование и запись идут в рабочем потоке; одновременно
+    выполняется не больше одной записи.
+    """
+
+    def __init__(self, min_interval: float, max_delay: float):
+        self.min_interval = min_interval
+        self.max_delay = max_delay
+        self._task: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._first_request: Optional[float] = None
+        self._last_request = 0.0
+        self._last_write = 0.0
+        self.requests = 0  # Уведомлений об изменениях
+        self.writes = 0  # Выполненных записей
+
+    def notify(self):
+        """Сообщить, что состояние изменилось"""
+        self.requests += 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (например, при запуске скриптов) сохраняем синхронно
+            save_data()
+            return
+
+        now = time.monotonic()
+        self._last_request = now
+        if self._first_request is None:
+            self._first_request = now
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    @property
+    def writing(self) -> bool:
+        """Идет запись: хранилище может еще не содержать последних снятых изменений"""
+        return self._lock is not None and self._lock.locked()
+
+    async def flush(self):
+        """Немедленно записать все несохраненные изменения"""
+        self._first_request = None
+        await self._write()
+
+    async def _run(self):
+        """Ждать окна записи, пока есть несохраненные изменения"""
+        while self._first_request is not None:
+            due = max(self._last_request, self._last_write) + self.min_interval
+            due = min(due, self._first_request + self.max_delay)
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            self._first_request = None
+            await self._write()
+
+    async def _write(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if not dirty:
+                return
+            started = time.perf_counter()
+            try:
+                changes = build_changes()
+                written = await asyncio.to_thread(storage.write, changes)
+                self.writes += 1
+                metrics.observe("bot_save_seconds", time.perf_counter() - started)
+                metrics.inc("bot_save_written_total", written, backend=STORAGE_BACKEND)
+                logger.debug(
+                    f"Данные сохранены асинхронно: {len(changes['games'])} игр, "
+                    f"{sum(len(rows) for rows in changes['players'].values())} игроков, "
+                    f"{len(changes['promocodes'])} промокодов, {written} байт"
+                )
+            except Exception as e:
+                metrics.inc("bot_save_errors_total")
+                logger.error(f"Ошибка асинхронного сохранения данных: {e}")
+            finally:
+                self._last_write = time.monotonic()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "writes": self.writes, "writing": self.writing}
+
+
+save_coordinator = SaveCoordinator(SAVE_DEBOUNCE, SAVE_MAX_DELAY)
+
+
 def save_data_async():
-    """Асинхронное сохранение данных (для фоновых задач)"""
-    try:
-        # Создаем копию данных для сохранения
-        data_to_save = {}
-        for chat_id, game in games.items():
-            game_data = {
-                "chat_id": game.chat_id,
-                "creator_id": game.creator_id,
-                "war_active": game.war_active,
-                "war_preparation": game.war_preparation,
-                "war_participants": game.war_participants,
-                "war_start_time": game.war_start_time.isoformat() if game.war_start_time else None,
-                "war_preparation_end": game.war_preparation_end.isoformat() if game.war_preparation_end else None,
-                "last_war": game.last_war.isoformat() if game.last_war else None,
-                "created_at": game.created_at.isoformat(),
-                "treasury": game.treasury,
-                "tax_history": [(dt.isoformat(), amount) for dt, amount in game.tax_history],
-                "players": {}
-            }
-            for user_id, player in game.players.items():
-                game_data["players"][str(user_id)] = {
-                    "user_id": player.user_id,
-                    "username": player.username,
-                    "country": player.country,
-                    "money": player.money,
-                    "army_level": player.army_level,
-                    "city_level": player.city_level,
-                    "last_income": player.last_income.isoformat(),
-                    "last_tax": player.last_tax.isoformat(),
-                    "wins": player.wins,
-                    "losses": player.losses,
-                    "is_online": player.is_online,
-                    "has_dm_notifications": player.has_dm_notifications,
-                    "tax_paid": player.tax_paid,
-                    "used_promocodes": player.used_promocodes
-                }
-            data_to_save[str(chat_id)] = game_data
-
-        with open(GAMES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=2)
-
-        # Сохраняем промокоды
-        promocodes_data = {}
-        for code, promo in promocodes.items():
-            promocodes_data[code] = {
-                "reward": promo.reward,
-                "max_uses": promo.max_uses,
-                "used_count": promo.used_count,
-                "created_by": promo.created_by,
-                "created_at": promo.created_at.isoformat(),
-                "is_active": promo.is_active,
-                "users_used": promo.users_used
-            }
-
-        with open(PROMOCODES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(promocodes_data, f, ensure_ascii=False, indent=2)
-
-        logger.debug(f"Данные сохранены асинхронно: {len(games)} игр, {len(promocodes)} промокодов")
-    except Exception as e:
-        logger.error(f"Ошибка асинхронного сохранения данных: {e}")
+    """Сообщить координатору сохранений, что состояние изменилось"""
+    save_coordinator.notify()
+
+
+def game_from_row(chat_id: int, game_data: Dict[str, Any]) -> Game:
+    """Восстановить игру (вместе с игроками) из словаря"""
+    game = Game(
+        chat_id=chat_id,
+        creator_id=game_data["creator_id"],
+        war_active=game_data["war_active"],
+        war_preparation=game_data.get("war_preparation", False),
+        war_participants=list(game_data["war_participants"]),
+        created_at=datetime.fromisoformat(game_data["created_at"]),
+        treasury=game_data.get("treasury", 0.0)
+    )
+
+    if game_data["war_start_time"]:
+        game.war_start_time = datetime.fromisoformat(game_data["war_start_time"])
+    if game_data.get("war_preparation_end"):
+        game.war_preparation_end = datetime.fromisoformat(game_data["war_preparation_end"])
+    if game_data["last_war"]:
+        game.last_war = datetime.fromisoformat(game_data["last_war"])
+
+    # Загружаем историю налогов
+    game.tax_history = TaxHistory.from_rows(game_data.get("tax_history", []))
+
+    for user_id_str, player_data in game_data["players"].items():
+        game.players[int(user_id_str)] = player_from_row(player_data)
+
+    return game
+
+
+def player_from_row(player_data: Dict[str, Any]) -> Player:
+    """Восстановить игрока из словаря
+
+    Поля записываются прямо в слоты, минуя __init__ и дескрипторы Timestamp:
+    при загрузке это основная часть времени после разбора JSON.
+    """
+    player = Player.__new__(Player)
+    player.user_id = player_data["user_id"]
+    player.username = player_data["username"]
+    country = player_data["country"]
+    player.country = COUNTRY_IDS.get(country, country)
+    player.money = player_data["money"]
+    player.army_level = player_data["army_level"]
+    player.city_level = player_data["city_level"]
+    player.last_income_ts = datetime.fromisoformat(player_data["last_income"]).timestamp()
+    player.last_tax_ts = datetime.fromisoformat(player_data["last_tax"]).timestamp()
+    player.wins = player_data["wins"]
+    player.losses = player_data["losses"]
+    player.is_online = player_data.get("is_online", True)
+    player.has_dm_notifications = player_data.get("has_dm_notifications", True)
+    player.tax_paid = player_data.get("tax_paid", 0.0)
+    player.used_promocodes = tuple(player_data.get("used_promocodes", ()))
+    return player
+
+
+def promocode_from_row(code: str, promo_data: Dict[str, Any]) -> Promocode:
+    """Восстановить промокод из словаря"""
+    return Promocode(
+        code=code,
+        reward=promo_data["reward"],
+        max_uses=promo_data["max_uses"],
+        used_count=promo_data["used_count"],
+        created_by=promo_data["created_by"],
+        created_at=datetime.fromisoformat(promo_data["created_at"]),
+        is_active=promo_data["is_active"],
+        users_used=list(promo_data["users_used"])
+    )
 
 
 def load_data():
-    """Загрузить данные игр и промокодов"""
+    """Загрузить данные игр и промокодов из хранилища"""
     global games, promocodes
-    if not os.path.exists(GAMES_FILE):
-        logger.info("Файл данных не найден, будет создан новый")
+    try:
+        raw = storage.load_raw() if STARTUP_LOAD == "lazy" else None
+        if raw is None:
+            data, promocodes_data = storage.load()
+        else:
+            data, promocodes_data = {}, raw[1]
+    except Exception as e:
+        logger.error(f"Ошибка чтения хранилища: {e}")
         return
 
     try:
-        with open(GAMES_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        games = {}
+        games = GameTable()
         for chat_id_str, game_data in data.items():
             chat_id = int(chat_id_str)
-            game = Game(
-                chat_id=chat_id,
-                creator_id=game_data["creator_id"],
-                war_active=game_data["war_active"],
-                war_preparation=game_data.get("war_preparation", False),
-                war_participants=game_data["war_participants"],
-                created_at=datetime.fromisoformat(game_data["created_at"]),
-                treasury=game_data.get("treasury", 0.0)
-            )
-
-            if game_data["war_start_time"]:
-                game.war_start_time = datetime.fromisoformat(game_data["war_start_time"])
-            if game_data.get("war_preparation_end"):
-                game.war_preparation_end = datetime.fromisoformat(game_data["war_preparation_end"])
-            if game_data["last_war"]:
-                game.last_war = datetime.fromisoformat(game_data["last_war"])
-
-            # Загружаем историю налогов
-            for dt_str, amount in game_data.get("tax_history", []):
-                game.tax_history.append((datetime.fromisoformat(dt_str), amount))
-
-            for user_id_str, player_data in game_data["players"].items():
-                player = Player(
-                    user_id=player_data["user_id"],
-                    username=player_data["username"],
-                    country=player_data["country"],
-                    money=player_data["money"],
-                    army_level=player_data["army_level"],
-                    city_level=player_data["city_level"],
-                    last_income=datetime.fromisoformat(player_data["last_income"]),
-                    last_tax=datetime.fromisoformat(player_data["last_tax"]),
-                    wins=player_data["wins"],
-                    losses=player_data["losses"],
-                    is_online=player_data.get("is_online", True)
-                )
-                player.has_dm_notifications = player_data.get("has_dm_notifications", True)
-                player.tax_paid = player_data.get("tax_paid", 0.0)
-                player.used_promocodes = player_data.get("used_promocodes", [])
-                game.players[int(user_id_str)] = player
-
-            games[chat_id] = game
-
-        logger.info(f"Загружено {len(games)} игр, {sum(len(g.players) for g in games.values())} игроков")
+            games[chat_id] = game_from_row(chat_id, game_data)
+
+        if raw is not None:
+            # Игры восстанавливаются при первом обращении или в фоне (restore_cold_games)
+            for chat_id_str, raw_game in raw[0]:
+                games.add_cold(int(chat_id_str), raw_game)
+            logger.info(f"Найдено {games.cold_count} игр, восстановление по обращению и в фоне")
+
+        tax_scheduler.rebuild(games)
+        war_scheduler.rebuild(games)
+        player_index.rebuild(games)
+        leaderboards.rebuild(games)
+        if raw is None:
+            logger.info(f"Загружено {len(games)} игр, {sum(len(g.players) for g in games.values())} игроков")
     except Exception as e:
         logger.error(f"Ошибка загрузки данных: {e}")
 
     # Загружаем промокоды
-    if os.path.exists(PROMOCODES_FILE):
-        try:
-            with open(PROMOCODES_FILE, 'r', encoding='utf-8') as f:
-                promocodes_data = json.load(f)
-
-            promocodes = {}
-            for code, promo_data in promocodes_data.items():
-                promo = Promocode(
-                    code=code,
-                    reward=promo_data["reward"],
-                    max_uses=promo_data["max_uses"],
-                    used_count=promo_data["used_count"],
-                    created_by=promo_data["created_by"],
-                    created_at=datetime.fromisoformat(promo_data["created_at"]),
-                    is_active=promo_data["is_active"],
-                    users_used=promo_data["users_used"]
-                )
-                promocodes[code] = promo
+    try:
+        promocodes = {}
+        for code, promo_data in promocodes_data.items():
+            promocodes[code] = promocode_from_row(code, promo_data)
 
-            logger.info(f"Загружено {len(promocodes)} промокодов")
-        except Exception as e:
-            logger.error(f"Ошибка загрузки промокодов: {e}")
+        logger.info(f"Загружено {len(promocodes)} промокодов")
+    except Exception as e:
+        logger.error(f"Ошибка загрузки промокодов: {e}")
 
 
 async def auto_save_data():
-    """Фоновая задача для автоматического сохранения данных каждые 5 секунд"""
+    """Фоновая задача для обслуживания хранилища каждые 5 секунд
+
+    Сами записи планирует save_coordinator, здесь выполняются групповой fsync
+    и компакция журнала.
+    """
     while True:
         try:
             await asyncio.sleep(SAVE_INTERVAL)
@@ -362,8 +2558,8 @@ async def auto_save_data():
             if is_shutting_down:
                 break
 
-            # Сохраняем данные асинхронно
-            save_data_async()
+            # Обслуживаем хранилище (fsync, компакция)
+            await asyncio.to_thread(storage.maintain)
             logger.debug(f"Автосохранение данных выполнено")
 
         except Exception as e:
@@ -371,10 +2567,59 @@ async def auto_save_data():
             await asyncio.sleep(5)
 
 
+def collect_due_taxes(current_time: datetime) -> int:
+    """Один тик сбора налогов: игроки, чей дедлайн вышел, вернуть их число"""
+    due_players = tax_scheduler.pop_due(current_time)
+    if not due_players:
+        return 0
+
+    needs_save = False
+    for chat_id, user_id in due_players:
+        game = games.get(chat_id)
+        if game is None or user_id not in game.players:
+            continue
+        player = game.players[user_id]
+
+        # Во время войны налоги не собираются
+        if game.war_active:
+            retry_at = current_time.timestamp() + TAX_RETRY_INTERVAL
+        elif chat_locks.locked(chat_id):
+            # Обработчик этого чата между проверкой и списанием денег — повторим на следующем тике
+            retry_at = current_time.timestamp() + 1
+        else:
+            tax_amount = collect_tax(game, player, current_time)
+            if tax_amount is not None:
+                mark_dirty(chat_id)
+                mark_dirty(chat_id, user_id)
+                mark_tax_collected(game, current_time, tax_amount)
+                tax_scheduler.collected += 1
+                needs_save = True
+                tax_scheduler.schedule(chat_id, user_id, player.last_tax_ts + TAX_INTERVAL)
+                continue
+            retry_at = current_time.timestamp() + tax_retry_delay(player)
+
+        tax_scheduler.deferred += 1
+        tax_scheduler.schedule(chat_id, user_id, retry_at)
+
+    # Если были изменения, сохраняем
+    if needs_save:
+        save_data_async()
+
+    queue = tax_scheduler.metrics()
+    logger.debug(
+        f"Налоги: обработано {len(due_players)}, очередь {queue['queue_depth']}, "
+        f"задержка {queue['last_lag']:.2f} сек"
+    )
+    return len(due_players)
+
+
 async def update_income_and_taxes():
-    """Фоновая задача для обновления пассивного дохода и сбора налогов"""
-    last_save_time = datetime.now()
+    """Фоновая задача для сбора налогов
 
+    Пассивный доход начисляется лениво через settle_income, а налоги
+    собираются только у игроков, чей дедлайн вышел в tax_scheduler
+    (collect_due_taxes).
+    """
     while True:
         try:
             await asyncio.sleep(1)
@@ -383,49 +2628,515 @@ async def update_income_and_taxes():
             if is_shutting_down:
                 break
 
-            current_time = datetime.now()
-            needs_save = False
+            started = time.perf_counter()
+            collect_due_taxes(datetime.now())
+            metrics.observe("bot_tax_tick_seconds", time.perf_counter() - started)
 
-            for game in games.values():
-                if game.war_active:
-                    continue
+        except Exception as e:
+            logger.error(f"Ошибка в update_income_and_taxes: {e}")
+            await asyncio.sleep(5)
 
-                for player in game.players.values():
-                    if not player.is_online:
-                        continue
 
-                    # Обновление дохода
-                    time_diff = (current_time - player.last_income).total_seconds()
-                    if time_diff > 0:
-                        country = COUNTRIES[player.country]
-                        income = country.base_income * player.city_level * time_diff
-                        player.money += income
-                        player.last_income = current_time
-                        needs_save = True
-
-                    # Сбор налогов
-                    tax_diff = (current_time - player.last_tax).total_seconds()
-                    if tax_diff >= TAX_INTERVAL:
-                        tax_amount = player.next_tax_amount
-                        if player.money >= tax_amount:
-                            player.money -= tax_amount
-                            player.tax_paid += tax_amount
-                            game.treasury += tax_amount
-                            game.tax_history.append((current_time, tax_amount))
-                            player.last_tax = current_time
-                            needs_save = True
-
-            # Если были изменения, сохраняем
-            if needs_save:
-                save_data_async()
-                logger.debug("Данные сохранены после обновления дохода/налогов")
+# Метрики
+METRIC_HELP = {
+    "bot_handler_seconds": "Время работы обработчика обновления",
+    "bot_handler_errors_total": "Исключения в обработчиках обновлений",
+    "bot_save_seconds": "Длительность фоновой записи в хранилище",
+    "bot_save_written_total": "Записано хранилищем: байт (json, log) или строк (sqlite)",
+    "bot_save_errors_total": "Неудачные фоновые записи",
+    "bot_tax_tick_seconds": "Длительность тика сбора налогов",
+    "bot_send_seconds": "Отправка сообщения вместе с ожиданием в очереди",
+    "bot_send_errors_total": "Сообщения, которые не удалось отправить",
+    "bot_dm_seconds": "Отправка уведомления в личные сообщения",
+    "bot_dm_notifications_total": "Уведомления в личные сообщения по результату",
+    "bot_tasks_pending": "Незавершенные задачи asyncio",
+    "bot_games": "Игры в памяти, еще не восстановленные и выгруженные",
+}
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]  # (имя, метки)
+
+
+class Histogram:
+    """Гистограмма с корзинами METRICS_BUCKETS (histogram в Prometheus)"""
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)  # Последняя корзина — больше всех границ
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    """Метки в виде {ключ="значение",...}"""
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
 
+
+class Metrics:
+    """Счетчики и гистограммы горячих путей для /metrics
+
+    Метрика задается именем и метками: observe("bot_save_seconds", 0.01),
+    inc("bot_send_errors_total", priority="notice"). Выключенный реестр
+    (METRICS_PORT=0) ничего не запоминает, а middleware обработчиков не
+    подключается, поэтому без метрик остается одна проверка на вызов.
+    Состояние очередей, планировщиков и кэшей снимается их методами
+    metrics() в момент запроса (collect_gauges).
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._histograms: Dict[MetricKey, Histogram] = {}
+        self._counters: Dict[MetricKey, float] = {}
+
+    def observe(self, name: str, value: float, **labels: str):
+        if not self.enabled:
+            return
+        key = (name, tuple(labels.items()))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        if not self.enabled:
+            return
+        key = (name, tuple(labels.items()))
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def render(self, gauges: Dict[MetricKey, float]) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines: List[str] = []
+        declared: Set[str] = set()
+
+        def declare(name: str, kind: str):
+            if name in declared:
+                return
+            declared.add(name)
+            if name in METRIC_HELP:
+                lines.append(f"# HELP {name} {METRIC_HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self._counters.items()):
+            declare(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+
+        bounds = [str(bound) for bound in METRICS_BUCKETS] + ["+Inf"]
+        for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.total}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+        for (name, labels), value in sorted(gauges.items()):
+            declare(name, "gauge")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(enabled=bool(METRICS_PORT))
+
+
+def collect_gauges() -> Dict[MetricKey, float]:
+    """Текущее состояние компонентов: их metrics(), число игр и задач asyncio"""
+    gauges: Dict[MetricKey, float] = {
+        ("bot_tasks_pending", ()): len(asyncio.all_tasks()),
+        ("bot_games", (("state", "loaded"),)): len(games),
+        ("bot_games", (("state", "cold"),)): games.cold_count,
+        ("bot_games", (("state", "evicted"),)): games.evicted_count,
+    }
+    components = {
+        "send_queue": send_queue, "tax": tax_scheduler, "war": war_scheduler, "leaderboard": leaderboards,
+        "views": views, "chat_locks": chat_locks, "save": save_coordinator,
+    }
+    for component, source in components.items():
+        for key, value in source.metrics().items():
+            if isinstance(value, dict):
+                for label, item in value.items():
+                    gauges[(f"bot_{component}_{key}", (("name", str(label)),))] = item
+            elif isinstance(value, bool):
+                gauges[(f"bot_{component}_{key}", ())] = int(value)
+            elif isinstance(value, (int, float)):
+                gauges[(f"bot_{component}_{key}", ())] = value
+    return gauges
+
+
+async def handler_metrics_middleware(handler, event, data):
+    """Время обработчика по имени его функции (cmd_start, callback_stats, ...)"""
+    name = data["handler"].callback.__name__
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        metrics.inc("bot_handler_errors_total", handler=name)
+        raise
+    finally:
+        metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+
+
+async def serve_metrics(port: int):
+    """Локальный HTTP-сервер с /metrics; работает до отмены"""
+    async def handle(request: web.Request) -> web.Response:
+        body = metrics.render(collect_gauges()).encode("utf-8")
+        return web.Response(body=body, headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+        logger.info(f"Метрики доступны на http://{METRICS_HOST}:{port}/metrics")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# Очередь исходящих сообщений
+send_priority: contextvars.ContextVar[int] = contextvars.ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+
+class RateLimiter:
+    """Не больше limit событий за любые period секунд (скользящее окно)"""
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self.moments: deque = deque()
+
+    def _expire(self, now: float):
+        while self.moments and self.moments[0] <= now - self.period:
+            self.moments.popleft()
+
+    def ready_at(self, now: float) -> float:
+        """Момент, когда можно будет отправить следующее сообщение"""
+        self._expire(now)
+        return now if len(self.moments) < self.limit else self.moments[0] + self.period
+
+    def take(self, now: float):
+        self._expire(now)
+        self.moments.append(now)
+
+    def is_idle(self, now: float) -> bool:
+        self._expire(now)
+        return not self.moments
+
+
+class SendQueue(BaseRequestMiddleware):
+    """Очередь исходящих сообщений с учетом лимитов Telegram
+
+    Подключается к сессии бота (bot.session.middleware), поэтому через нее
+    проходят все новые сообщения: send_message и message.answer. Каждое
+    ждет своей очереди с учетом лимитов чата, группы и всего бота;
+    остальные запросы (edit_text, answer_callback_query, getUpdates) идут
+    напрямую. Внутри очереди чата и среди готовых чатов первыми идут
+    интерактивные ответы, затем оповещения (send_priority). Ответ 429
+    блокирует чат на retry_after секунд, и запрос повторяется.
+    """
+
+    def __init__(self, chat_limit: Tuple[int, float], group_limit: Tuple[int, float],
+                 global_limit: Tuple[int, float]):
+        self.chat_limit = chat_limit
+        self.group_limit = group_limit
+        self.global_limiter = RateLimiter(*global_limit)
+        self._chat_limiters: Dict[Any, RateLimiter] = {}
+        self._group_limiters: Dict[Any, RateLimiter] = {}
+        self._blocked_until: Dict[Any, float] = {}
+        self._queues: Dict[Any, List[Tuple[int, int, asyncio.Future]]] = {}  # Куча (приоритет, номер, ожидание)
+        self._ready: List[Tuple[int, int, Any]] = []  # Чаты, готовые к отправке: (приоритет, номер, чат)
+        self._waiting: List[Tuple[float, int, Any]] = []  # Чаты, ждущие токена: (момент, номер, чат)
+        self._entry: Dict[Any, int] = {}  # Актуальная запись чата в _ready/_waiting
+        self._seq = 0
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.sent = 0  # Выданных слотов отправки
+        self.retried = 0  # Повторов после 429
+        self.failed = 0  # Запросов, так и не отправленных из-за 429
+        self.last_wait = 0.0  # Ожидание последнего запроса в очереди (в секундах)
+        self.max_wait = 0.0
+
+    async def __call__(self, make_request, bot_instance, method):
+        if not isinstance(method, SendMessage):
+            return await make_request(bot_instance, method)
+
+        chat_id = method.chat_id
+        priority = send_priority.get()
+        self._seq += 1
+        seq = self._seq
+        started = time.perf_counter()
+        try:
+            for attempt in range(SEND_MAX_RETRIES + 1):
+                await self._acquire(chat_id, priority, seq)
+                try:
+                    return await make_request(bot_instance, method)
+                except TelegramRetryAfter as e:
+                    self._blocked_until[chat_id] = time.monotonic() + e.retry_after
+                    if attempt == SEND_MAX_RETRIES:
+                        self.failed += 1
+                        raise
+                    self.retried += 1
+                    logger.warning(f"Лимит Telegram в чате {chat_id}: повтор через {e.retry_after} сек")
         except Exception as e:
-            logger.error(f"Ошибка в update_income_and_taxes: {e}")
-            await asyncio.sleep(5)
+            metrics.inc("bot_send_errors_total", priority=PRIORITY_NAMES[priority], error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_send_seconds", time.perf_counter() - started, priority=PRIORITY_NAMES[priority])
+
+    async def _acquire(self, chat_id: Any, priority: int, seq: int):
+        """Дождаться разрешения на отправку в чат"""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(chat_id, [])
+        heapq.heappush(queue, (priority, seq, future))
+        if chat_id not in self._entry or queue[0][2] is future:
+            # Чат не запланирован или новый запрос важнее головы очереди
+            self._reschedule(chat_id, time.monotonic())
+
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+        started = time.monotonic()
+        await future
+        self.last_wait = time.monotonic() - started
+        self.max_wait = max(self.max_wait, self.last_wait)
+
+    def _reschedule(self, chat_id: Any, now: float):
+        """Поставить чат в очередь готовых или ожидающих по его голове очереди"""
+        queue = self._queues.get(chat_id)
+        if not queue:
+            self._queues.pop(chat_id, None)
+            self._entry.pop(chat_id, None)
+            return
+
+        ready_at = max(self._chat_limiter(chat_id).ready_at(now), self._blocked_until.get(chat_id, 0.0))
+        group = self._group_limiter(chat_id)
+        if group is not None:
+            ready_at = max(ready_at, group.ready_at(now))
+
+        self._seq += 1
+        self._entry[chat_id] = self._seq
+        if ready_at <= now:
+            heapq.heappush(self._ready, (queue[0][0], self._seq, chat_id))
+        else:
+            heapq.heappush(self._waiting, (ready_at, self._seq, chat_id))
+
+    def _chat_limiter(self, chat_id: Any) -> RateLimiter:
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self._chat_limiters[chat_id] = RateLimiter(*self.chat_limit)
+        return limiter
+
+    def _group_limiter(self, chat_id: Any) -> Optional[RateLimiter]:
+        if not isinstance(chat_id, int) or chat_id >= 0:
+            return None  # Личный чат
+        limiter = self._group_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self._group_limiters[chat_id] = RateLimiter(*self.group_limit)
+        return limiter
+
+    async def _sleep(self, delay: float):
+        """Ждать delay секунд или нового запроса в очереди"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        """Выдавать слоты отправки, пока в очереди есть запросы"""
+        while self._ready or self._waiting:
+            now = time.monotonic()
+            while self._waiting and self._waiting[0][0] <= now:
+                _, seq, chat_id = heapq.heappop(self._waiting)
+                if self._entry.get(chat_id) == seq:
+                    self._reschedule(chat_id, now)
+
+            if not self._ready:
+                if self._waiting:
+                    await self._sleep(self._waiting[0][0] - now)
+                continue
+
+            delay = self.global_limiter.ready_at(now) - now
+            if delay > 0:
+                await self._sleep(delay)
+                continue
+
+            _, seq, chat_id = heapq.heappop(self._ready)
+            if self._entry.get(chat_id) != seq:
+                continue  # Устаревшая запись чата
+
+            _, _, future = heapq.heappop(self._queues[chat_id])
+            if not future.done():
+                self.global_limiter.take(now)
+                self._chat_limiter(chat_id).take(now)
+                group = self._group_limiter(chat_id)
+                if group is not None:
+                    group.take(now)
+                self.sent += 1
+                future.set_result(None)
+            self._reschedule(chat_id, now)
+
+        self._prune(time.monotonic())
+        logger.debug(f"Очередь отправки пуста: {self.metrics()}")
+
+    def _prune(self, now: float):
+        """Забыть лимиты чатов без недавних сообщений"""
+        for limiters in (self._chat_limiters, self._group_limiters):
+            for chat_id in [chat_id for chat_id, limiter in limiters.items() if limiter.is_idle(now)]:
+                del limiters[chat_id]
+        for chat_id in [chat_id for chat_id, until in self._blocked_until.items() if until <= now]:
+            del self._blocked_until[chat_id]
+
+    def metrics(self) -> Dict[str, Any]:
+        """Состояние очереди для логов и мониторинга"""
+        depth = {PRIORITY_INTERACTIVE: 0, PRIORITY_NOTICE: 0}
+        for queue in self._queues.values():
+            for priority, _, _ in queue:
+                depth[priority] = depth.get(priority, 0) + 1
+        return {
+            "queue_depth": sum(depth.values()),
+            "interactive_depth": depth[PRIORITY_INTERACTIVE],
+            "notice_depth": depth[PRIORITY_NOTICE],
+            "chats_waiting": len(self._queues),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "last_wait": self.last_wait,
+            "max_wait": self.max_wait,
+        }
+
+
+send_queue = SendQueue(SEND_LIMIT_PER_CHAT, SEND_LIMIT_PER_GROUP, SEND_LIMIT_GLOBAL)
+
+
+def shard_limit(limit: Tuple[int, float], shard_count: int) -> Tuple[int, float]:
+    """Доля одного шарда в общем лимите: в среднем limit / shard_count событий за тот же период
+
+    У каждого процесса-шарда своя SendQueue, поэтому общий лимит бота
+    делится между ними поровну: (30, 1.0) на 4 шарда — (7, 0.933).
+    """
+    count, period = limit
+    share = max(count // shard_count, 1)
+    return share, period * share * shard_count / count
+
+
+async def send_notice(chat_id: int, text: str):
+    """Отправить оповещение с низким приоритетом (после интерактивных ответов)"""
+    token = send_priority.set(PRIORITY_NOTICE)
+    try:
+        return await bot.send_message(chat_id, text)
+    finally:
+        send_priority.reset(token)
+
+
+async def fan_out(label: str, sends: List[Tuple[int, Any]]) -> Dict[int, bool]:
+    """Отправить сообщения нескольким получателям параллельно
+
+    sends — пары (получатель, функция без аргументов, возвращающая корутину).
+    Одновременно выполняется не больше FANOUT_CONCURRENCY отправок; ошибка
+    одного получателя не мешает остальным. Время каждой отправки и итог
+    рассылки пишутся в лог. Возвращает {получатель: доставлено ли}.
+    """
+    if not sends:
+        return {}
+
+    slots = asyncio.Semaphore(FANOUT_CONCURRENCY)
+    results: Dict[int, bool] = {}
+    started = time.perf_counter()
+
+    async def deliver(recipient: int, send: Any):
+        async with slots:
+            send_started = time.perf_counter()
+            try:
+                results[recipient] = await send() is not False
+            except Exception as e:
+                results[recipient] = False
+                logger.error(f"Рассылка {label}: ошибка для {recipient}: {e}")
+            logger.debug(f"Рассылка {label}: {recipient} за {time.perf_counter() - send_started:.3f} сек")
+
+    await asyncio.gather(*(deliver(recipient, send) for recipient, send in sends))
+
+    failed = [recipient for recipient, delivered in results.items() if not delivered]
+    logger.info(
+        f"Рассылка {label}: доставлено {len(results) - len(failed)}/{len(results)} "
+        f"за {time.perf_counter() - started:.2f} сек" + (f", не доставлено: {failed}" if failed else "")
+    )
+    return results
+
+
+# Кэш отрисованных экранов
+class ViewCache:
+    """Отрисованные экраны игроков: (экран, chat_id, user_id) -> текст
+
+    Экран хранится вместе с состоянием, из которого он собран: версией игры
+    (Game.version растет в mark_dirty) и показанными на нем значениями,
+    которые меняются со временем. Совпало состояние — текст не пересобирается.
+    Хранится не больше size последних экранов.
+    """
+
+    def __init__(self, size: int = VIEW_CACHE_SIZE):
+        self.size = size
+        self._views: "OrderedDict[Tuple[str, int, int], Tuple[Any, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.skipped_edits = 0
+
+    def render(self, view: Tuple[str, int, int], state: Any, build) -> str:
+        """Текст экрана: из кэша, если состояние не изменилось, иначе build()"""
+        entry = self._views.get(view)
+        if entry is not None and entry[0] == state:
+            self.hits += 1
+            self._views.move_to_end(view)
+            return entry[1]
+
+        self.misses += 1
+        text = build()
+        self._views[view] = (state, text)
+        self._views.move_to_end(view)
+        if len(self._views) > self.size:
+            self._views.popitem(last=False)
+        return text
+
+    async def edit(self, message: Message, view: Tuple[str, int, int], state: Any, build,
+                   reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
+        """Показать экран в сообщении; False, если сообщение уже выглядит так же
+
+        Telegram отклоняет правку без изменений, поэтому такой edit_text не отправляется.
+        """
+        text = self.render(view, state, build)
+        if message.text == text and message.reply_markup == reply_markup:
+            self.skipped_edits += 1
+            return False
+        await message.edit_text(text, reply_markup=reply_markup)
+        return True
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "views": len(self._views),
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped_edits": self.skipped_edits,
+        }
+
+
+views = ViewCache()
 
 
 # Функции для создания клавиатур
+@lru_cache(maxsize=VIEW_CACHE_SIZE)
 def get_game_keyboard(player_id: int) -> InlineKeyboardMarkup:
     """Клавиатура для игрока"""
     keyboard = [
@@ -453,6 +3164,7 @@ def get_game_keyboard(player_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+@lru_cache(maxsize=None)
 def get_countries_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура выбора страны"""
     keyboard = []
@@ -537,6 +3249,30 @@ async def show_player_menu(message_or_callback, user_id: Optional[int] = None, i
 
     game = games[chat_id]
     player = game.players[user_id]
+    settle_income(player)
+    now = datetime.now()
+
+    # Расчет времени до следующего налога
+    time_to_tax = TAX_INTERVAL - (now - player.last_tax).total_seconds()
+    if time_to_tax < 0:
+        time_to_tax = 0
+
+    # Оставшееся время подготовки к войне (показывается только ее участникам)
+    preparation_left = None
+    if not game.war_active and game.war_preparation and user_id in game.war_participants:
+        preparation_left = int((game.war_preparation_end - now).total_seconds())
+
+    build = partial(render_player_menu, game, player, time_to_tax, preparation_left)
+    view = ("menu", chat_id, user_id)
+    state = (game.version, int(player.money), int(time_to_tax), preparation_left)
+    if is_callback:
+        await views.edit(message_obj, view, state, build, reply_markup=get_game_keyboard(user_id))
+    else:
+        await message_obj.answer(views.render(view, state, build), reply_markup=get_game_keyboard(user_id))
+
+
+def render_player_menu(game: Game, player: Player, time_to_tax: float, preparation_left: Optional[int]) -> str:
+    """Текст меню игрока"""
     country = COUNTRIES[player.country]
 
     # Расчет стоимости улучшений и налогов
@@ -544,11 +3280,6 @@ async def show_player_menu(message_or_callback, user_id: Optional[int] = None, i
     army_upgrade_cost = country.army_cost * player.army_level
     city_upgrade_cost = country.city_cost * player.city_level
 
-    # Расчет времени до следующего налога
-    time_to_tax = TAX_INTERVAL - (datetime.now() - player.last_tax).total_seconds()
-    if time_to_tax < 0:
-        time_to_tax = 0
-
     # Формирование текста
     text = (
         f"🎮 **Управление страной**\n\n"
@@ -569,27 +3300,25 @@ async def show_player_menu(message_or_callback, user_id: Optional[int] = None, i
 
     if game.war_active:
         text += "\n\n⚔️ **Сейчас идет война!**"
-    elif game.war_preparation:
-        if user_id in game.war_participants:
-            time_left = int((game.war_preparation_end - datetime.now()).total_seconds())
-            if time_left > 0:
-                text += f"\n\n🛡️ **Подготовка к войне!**\n⏳ До начала: {time_left} сек\nУлучшайте армию!"
-
-    if is_callback:
-        await message_obj.edit_text(text, reply_markup=get_game_keyboard(user_id))
-    else:
-        await message_obj.answer(text, reply_markup=get_game_keyboard(user_id))
+    elif preparation_left is not None and preparation_left > 0:
+        text += f"\n\n🛡️ **Подготовка к войне!**\n⏳ До начала: {preparation_left} сек\nУлучшайте армию!"
+    return text
 
 
 async def send_dm_notification(user_id: int, message: str):
     """Отправить уведомление в личные сообщения"""
+    started = time.perf_counter()
     try:
-        await bot.send_message(user_id, message)
+        await send_notice(user_id, message)
         logger.info(f"Уведомление отправлено пользователю {user_id}")
+        metrics.inc("bot_dm_notifications_total", result="sent")
         return True
     except Exception as e:
         logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+        metrics.inc("bot_dm_notifications_total", result="failed")
         return False
+    finally:
+        metrics.observe("bot_dm_seconds", time.perf_counter() - started)
 
 
 async def graceful_shutdown():
@@ -601,8 +3330,12 @@ async def graceful_shutdown():
     is_shutting_down = True
     logger.info("Завершение работы бота...")
 
-    # Сохраняем все данные
-    save_data()
+    # Дожидаемся фоновой записи и сохраняем все данные
+    await save_coordinator.flush()
+
+    storage.close()
+    if dispatcher is not None:
+        await dispatcher.storage.close()
 
     # Закрываем сессию бота
     if bot:
@@ -631,7 +3364,12 @@ async def cmd_taxinfo(message: Message):
         return
 
     game = games[chat_id]
+    await message.answer(taxinfo_rules_text() + f"\n🏛️ **Текущая казна:** {int(game.treasury)} монет")
+
 
+@lru_cache(maxsize=None)
+def taxinfo_rules_text() -> str:
+    """Неизменная часть /taxinfo: правила и модификаторы стран"""
     text = (
         "💰 **Система налогов**\n\n"
         "📊 **Основные правила:**\n"
@@ -644,9 +3382,36 @@ async def cmd_taxinfo(message: Message):
 
     for country in COUNTRIES.values():
         text += f"• {country.emoji} {country.name}: {country.tax_modifier * 100:.0f}%\n"
+    return text
 
-    text += f"\n🏛️ **Текущая казна:** {int(game.treasury)} монет"
 
+GLOBAL_TOP_VIEWS = {
+    "money": ("money", "💰 Богатейшие игроки", lambda score: f"{int(score)} монет"),
+    "power": ("power", "📈 Сильнейшие армии", lambda score: f"сила {score:.1f}"),
+    "taxes": ("tax_paid", "🏛️ Крупнейшие налогоплательщики", lambda score: f"{int(score)} монет налогов"),
+}
+
+
+async def cmd_globaltop(message: Message, command: CommandObject):
+    """Общий рейтинг игроков всех чатов: /globaltop [money|power|taxes]
+
+    При шардировании показывает игроков чатов своего шарда.
+    """
+    view = (command.args or "money").strip().lower()
+    if view not in GLOBAL_TOP_VIEWS:
+        await message.answer("❌ Использование: /globaltop [money|power|taxes]")
+        return
+
+    metric, title, fmt = GLOBAL_TOP_VIEWS[view]
+    entries = leaderboards.board(metric).top(TOP_SIZE, time.time())
+    if not entries:
+        await message.answer("📊 Пока нет игроков!")
+        return
+
+    text = f"🌍 **{title}** 🌍\n\n"
+    for i, (chat_id, player, score) in enumerate(entries, 1):
+        country = COUNTRIES[player.country]
+        text += f"{i}. {country.emoji} **{player.username}** — {fmt(score)}\n"
     await message.answer(text)
 
 
@@ -669,72 +3434,106 @@ async def cmd_promocode(message: Message, state: FSMContext, command: CommandObj
 
     promo_code = command.args.upper().strip()
 
-    if promo_code not in promocodes:
-        await message.answer(f"❌ Промокод `{promo_code}` не найден или недействителен!")
-        return
-
-    promo = promocodes[promo_code]
-
-    if not promo.is_active:
-        await message.answer(f"❌ Промокод `{promo_code}` деактивирован!")
-        return
-
-    if promo.used_count >= promo.max_uses:
-        await message.answer(f"❌ Промокод `{promo_code}` уже использован максимальное количество раз!")
-        return
-
-    if user_id in promo.users_used:
-        await message.answer(f"❌ Вы уже использовали промокод `{promo_code}`!")
-        return
-
-    # Находим все игры, где есть игрок
-    player_games = []
-    for chat_id, game in games.items():
-        if user_id in game.players:
-            player_games.append((chat_id, game))
+    # Награда начисляется во всех играх игрока, поэтому нужны все игры
+    await wait_games_restored()
+
+    # Проверка и использование промокода атомарны: между ними есть ожидание ответов шардов.
+    # Другие шарды только резервируют игры и отвечают сразу, награду они начисляют
+    # после использования (promocode_commit), уже без ответа и без этой блокировки.
+    # Ответы отправляются после блокировки: очередь отправки не задерживает других игроков
+    error = None
+    async with promocode_locks.hold(promo_code):
+        promo = promocodes.get(promo_code)
+        player_games = []
+        if promo is None:
+            error = f"❌ Промокод `{promo_code}` не найден или недействителен!"
+        elif not promo.is_active:
+            error = f"❌ Промокод `{promo_code}` деактивирован!"
+        elif promo.used_count >= promo.max_uses:
+            error = f"❌ Промокод `{promo_code}` уже использован максимальное количество раз!"
+        elif user_id in promo.users_used:
+            error = f"❌ Вы уже использовали промокод `{promo_code}`!"
+        else:
+            # Находим все игры, где есть игрок
+            player_games = [(chat_id, games[chat_id]) for chat_id in player_index.chats_of(user_id)]
+
+            # При шардировании игры игрока могут принадлежать другим процессам
+            remote_games = 0
+            if shard_link is not None:
+                # Резервируем использование, пока награда начисляется в других шардах
+                promo.used_count += 1
+                promo.users_used.append(user_id)
+                try:
+                    results = await shard_link.request_all("promocode_reserve", user_id=user_id, code=promo_code)
+                    remote_games = sum(results)
+                except asyncio.TimeoutError:
+                    # Не все шарды ответили: промокод не используется, резервирования снимаются
+                    shard_link.send_all("promocode_rollback", user_id=user_id, code=promo_code)
+                    error = "❌ Не удалось активировать промокод, попробуйте позже"
+                finally:
+                    promo.used_count -= 1
+                    promo.users_used.remove(user_id)
+
+            if error is None and not player_games and not remote_games:
+                error = "❌ Вы должны быть в игре, чтобы использовать промокод!"
+
+        if error is None:
+            # Используем промокод
+            promo.used_count += 1
+            promo.users_used.append(user_id)
+
+            # Награждаем игрока во всех играх, где он участвует
+            async with chat_locks.hold(*(chat_id for chat_id, _ in player_games)):
+                for chat_id, game in player_games:
+                    player = game.players[user_id]
+                    settle_income(player)
+                    player.money += promo.reward
+                    mark_dirty(chat_id, user_id)
+            if remote_games:
+                shard_link.send_all("promocode_commit", user_id=user_id, code=promo_code, reward=promo.reward)
+
+            # Сохраняем данные немедленно
+            record_event("promocode_redeemed", code=promo_code, user_id=user_id, reward=promo.reward)
+            mark_promocode_dirty(promo_code)
+            save_data_async()
+            used_count = promo.used_count
 
-    if not player_games:
-        await message.answer("❌ Вы должны быть в игре, чтобы использовать промокод!")
+    if error is not None:
+        await message.answer(error)
         return
 
-    # Используем промокод
-    promo.used_count += 1
-    promo.users_used.append(user_id)
-
-    # Награждаем игрока во всех играх, где он участвует
-    total_reward = 0
-    for chat_id, game in player_games:
-        player = game.players[user_id]
-        player.money += promo.reward
-        total_reward += promo.reward
-
-    # Сохраняем данные немедленно
-    save_data_async()
-
     # Сообщение в ЛС
     await message.answer(
         f"🎉 **Промокод активирован!**\n\n"
         f"📝 **Код:** `{promo_code}`\n"
         f"💰 **Награда:** {int(promo.reward)} монет\n"
-        f"📊 **Использований:** {promo.used_count}/{promo.max_uses}\n\n"
+        f"📊 **Использований:** {used_count}/{promo.max_uses}\n\n"
         f"Награда добавлена на ваш счет во всех играх!"
     )
 
     # Оповещаем во все чаты, где есть игрок
-    for chat_id, game in player_games:
-        player = game.players[user_id]
-        announcement = (
-            f"🎉 **Промокод активирован!**\n\n"
-            f"👤 **Игрок:** {player.username}\n"
-            f"🎁 **Промокод:** `{promo_code}`\n"
-            f"💰 **Награда:** {int(promo.reward)} монет\n\n"
-            f"Поздравляем с получением награды! 🎊"
-        )
+    await fan_out(f"promocode {promo_code}", [
+        (chat_id, partial(announce_promocode, chat_id, game.players[user_id], promo_code, promo.reward))
+        for chat_id, game in player_games
+    ])
 
-        try:
-            await bot.send_message(chat_id, announcement)
-        except Exception as e:
-            logger.error(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+
+async def announce_promocode(chat_id: int, player: Player, promo_code: str, reward: float):
+    """Оповестить чат об активации промокода игроком"""
+    announcement = (
+        f"🎉 **Промокод активирован!**\n\n"
+        f"👤 **Игрок:** {player.username}\n"
+        f"🎁 **Промокод:** `{promo_code}`\n"
+        f"💰 **Награда:** {int(reward)} монет\n\n"
+        f"Поздравляем с получением награды! 🎊"
+    )
+
+    try:
+        await send_notice(chat_id, announcement)
+        return True
+    except Exception as e:
+        logger.error(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+        return False
 
 
 # Админские команды для управления промокодами
@@ -794,6 +3593,8 @@ async def cmd_create_promo(message: Message, command: CommandObject):
     )
 
     promocodes[code] = promo
+    record_event("promocode_created", code=code)
+    mark_promocode_dirty(code)
     save_data_async()
 
     await message.answer(
@@ -827,9 +3628,12 @@ async def cmd_delete_promo(message: Message, command: CommandObject):
         await message.answer(f"❌ Промокод `{code}` не найден!")
         return
 
-    # Удаляем промокод
-    del promocodes[code]
-    save_data_async()
+    # Удаляем промокод, дождавшись активаций, которые уже идут
+    async with promocode_locks.hold(code):
+        promocodes.pop(code, None)
+        record_event("promocode_deleted", code=code)
+        mark_promocode_dirty(code)
+        save_data_async()
 
     await message.answer(f"✅ Промокод `{code}` успешно удален!")
 
@@ -875,16 +3679,20 @@ async def cmd_toggle_promo(message: Message, command: CommandObject):
 
     code = command.args.upper().strip()
 
-    if code not in promocodes:
+    # Переключаем статус, дождавшись активаций, которые уже идут
+    async with promocode_locks.hold(code):
+        promo = promocodes.get(code)
+        if promo is not None:
+            promo.is_active = not promo.is_active
+            record_event("promocode_toggled", code=code, is_active=promo.is_active)
+            mark_promocode_dirty(code)
+            save_data_async()
+
+    if promo is None:
         await message.answer(f"❌ Промокод `{code}` не найден!")
         return
 
-    # Переключаем статус
-    promo = promocodes[code]
-    promo.is_active = not promo.is_active
-
     status = "активирован" if promo.is_active else "деактивирован"
-    save_data_async()
 
     await message.answer(f"✅ Промокод `{code}` {status}!")
 
@@ -905,6 +3713,7 @@ async def callback_taxes(callback: CallbackQuery):
 
     game = games[chat_id]
     player = game.players[user_id]
+    settle_income(player)
     country = COUNTRIES[player.country]
 
     # Расчет времени до следующего налога
@@ -913,8 +3722,7 @@ async def callback_taxes(callback: CallbackQuery):
         time_to_tax = 0
 
     # Расчет налогов за последние 24 часа
-    recent_taxes = sum(amount for dt, amount in game.tax_history
-                       if (datetime.now() - dt).total_seconds() <= 86400)
+    recent_taxes = game.tax_history.total(24)
 
     text = (
         f"💰 **Налоговая информация**\n\n"
@@ -953,19 +3761,13 @@ async def callback_treasury(callback: CallbackQuery):
     game = games[chat_id]
 
     # Расчет налогов за разные периоды
-    taxes_24h = sum(amount for dt, amount in game.tax_history
-                    if (datetime.now() - dt).total_seconds() <= 86400)
-
-    taxes_7d = sum(amount for dt, amount in game.tax_history
-                   if (datetime.now() - dt).total_seconds() <= 604800)
-
-    taxes_30d = sum(amount for dt, amount in game.tax_history
-                    if (datetime.now() - dt).total_seconds() <= 2592000)
+    now = datetime.now()
+    taxes_24h = game.tax_history.total(24, now)
+    taxes_7d = game.tax_history.total(7 * 24, now)
+    taxes_30d = game.tax_history.total(30 * 24, now)
 
     # Топ налогоплательщиков
-    top_taxpayers = sorted(game.players.values(),
-                           key=lambda p: p.tax_paid,
-                           reverse=True)[:5]
+    top_taxpayers = top_players(game.players.values(), key=lambda p: p.tax_paid, n=5)
 
     text = (
         f"🏛️ **Государственная казна**\n\n"
@@ -1039,11 +3841,10 @@ async def callback_country_selection(callback: CallbackQuery, state: FSMContext)
     game = games[chat_id]
 
     # Проверка, не выбрана ли страна другим игроком
-    for player in game.players.values():
-        if player.country == country_id:
-            await callback.message.edit_text("❌ Эта страна уже занята другим игроком!")
-            await state.clear()
-            return
+    if player_index.country_owner(chat_id, country_id) is not None:
+        await callback.message.edit_text("❌ Эта страна уже занята другим игроком!")
+        await state.clear()
+        return
 
     # Создание игрока
     player = Player(
@@ -1053,8 +3854,12 @@ async def callback_country_selection(callback: CallbackQuery, state: FSMContext)
     )
 
     game.players[user_id] = player
+    player_index.add(chat_id, player)
+    tax_scheduler.schedule(chat_id, user_id, player.last_tax_ts + TAX_INTERVAL)
 
     # НЕМЕДЛЕННО сохраняем нового игрока в файл
+    record_event("player_joined", chat_id=chat_id, user_id=user_id, country=country_id)
+    mark_dirty(chat_id, user_id)
     save_data_async()
     logger.info(f"Новый игрок создан и сохранен: {player.username} ({country_id})")
 
@@ -1090,6 +3895,21 @@ async def callback_stats(callback: CallbackQuery):
 
     game = games[chat_id]
     player = game.players[user_id]
+    settle_income(player)
+
+    # Расчет времени до следующего налога
+    time_to_tax = TAX_INTERVAL - (datetime.now() - player.last_tax).total_seconds()
+    if time_to_tax < 0:
+        time_to_tax = 0
+
+    state = (game.version, int(player.money), int(time_to_tax), int(player.last_income_ts // 60))
+    await views.edit(callback.message, ("stats", chat_id, user_id), state,
+                     partial(render_player_stats, player, time_to_tax))
+    await callback.answer()
+
+
+def render_player_stats(player: Player, time_to_tax: float) -> str:
+    """Текст детальной статистики игрока"""
     country = COUNTRIES[player.country]
 
     # Расчет статистики
@@ -1098,11 +3918,6 @@ async def callback_stats(callback: CallbackQuery):
     city_upgrade_cost = country.city_cost * player.city_level
     total_income = player.money - 1000
 
-    # Расчет времени до следующего налога
-    time_to_tax = TAX_INTERVAL - (datetime.now() - player.last_tax).total_seconds()
-    if time_to_tax < 0:
-        time_to_tax = 0
-
     notification_status = "✅ Включены" if player.has_dm_notifications else "❌ Выключены"
 
     text = (
@@ -1121,7 +3936,7 @@ async def callback_stats(callback: CallbackQuery):
         f"⚔️ **Военная мощь:**\n"
         f"• Уровень армии: {player.army_level}\n"
         f"• След. улучшение: {army_upgrade_cost} монет\n"
-        f"• Сила атаки: {player.army_level * (1 + 0.1 * player.city_level):.1f}\n\n"
+        f"• Сила атаки: {player.power:.1f}\n\n"
         f"🏙️ **Экономика:**\n"
         f"• Уровень города: {player.city_level}\n"
         f"• След. улучшение: {city_upgrade_cost} монет\n"
@@ -1140,9 +3955,7 @@ async def callback_stats(callback: CallbackQuery):
     text += f"\n💰 **Следующий налог:** {int(player.next_tax_amount)} монет\n"
     text += f"⏳ **До налога:** {int(time_to_tax)} сек\n"
     text += f"\n🔄 Измените настройки уведомлений через меню 'Настройки'"
-
-    await callback.message.edit_text(text)
-    await callback.answer()
+    return text
 
 
 async def callback_upgrade_army(callback: CallbackQuery):
@@ -1166,6 +3979,7 @@ async def callback_upgrade_army(callback: CallbackQuery):
         return
 
     player = game.players[user_id]
+    settle_income(player)
     country = COUNTRIES[player.country]
 
     upgrade_cost = country.army_cost * player.army_level
@@ -1174,6 +3988,8 @@ async def callback_upgrade_army(callback: CallbackQuery):
         player.money -= upgrade_cost
         player.army_level += 1
         # Немедленно сохраняем после улучшения
+        record_event("army_upgraded", chat_id=chat_id, user_id=user_id, level=player.army_level)
+        mark_dirty(chat_id, user_id)
         save_data_async()
         logger.debug(f"Армия улучшена для {player.username}: уровень {player.army_level}")
 
@@ -1204,6 +4020,7 @@ async def callback_upgrade_city(callback: CallbackQuery):
         return
 
     player = game.players[user_id]
+    settle_income(player)
     country = COUNTRIES[player.country]
 
     upgrade_cost = country.city_cost * player.city_level
@@ -1212,6 +4029,8 @@ async def callback_upgrade_city(callback: CallbackQuery):
         player.money -= upgrade_cost
         player.city_level += 1
         # Немедленно сохраняем после улучшения
+        record_event("city_upgraded", chat_id=chat_id, user_id=user_id, level=player.city_level)
+        mark_dirty(chat_id, user_id)
         save_data_async()
         logger.debug(f"Город улучшен для {player.username}: уровень {player.city_level}")
 
@@ -1240,22 +4059,19 @@ async def callback_top(callback: CallbackQuery):
         await callback.answer()
         return
 
-    # Сортировка игроков по деньгам
-    sorted_players = sorted(
-        game.players.values(),
-        key=lambda p: p.money,
-        reverse=True
-    )
+    settle_game_income(game)
+
+    # Лучшие игроки по деньгам
+    sorted_players = top_players(game.players.values(), key=lambda p: p.money)
 
     text = "🏆 **Топ игроков** 🏆\n\n"
     medals = ["🥇", "🥈", "🥉", "4.", "5.", "6.", "7.", "8.", "9.", "10."]
 
-    for i, player in enumerate(sorted_players[:10], 1):
+    for i, player in enumerate(sorted_players, 1):
         country = COUNTRIES[player.country]
         medal = medals[i - 1] if i <= 10 else f"{i}."
-        power = player.army_level * (1 + 0.1 * player.city_level)
         text += f"{medal} {country.emoji} **{player.username}**\n"
-        text += f"   💰 {int(player.money)} | ⚔️ {player.army_level} | 🏙️ {player.city_level} | 📈 {power:.1f}\n\n"
+        text += f"   💰 {int(player.money)} | ⚔️ {player.army_level} | 🏙️ {player.city_level} | 📈 {player.power:.1f}\n\n"
 
     text += f"Всего игроков: {len(game.players)}"
     await callback.message.edit_text(text)
@@ -1308,6 +4124,8 @@ async def callback_toggle_notifications(callback: CallbackQuery):
 
     player = games[chat_id].players[user_id]
     player.has_dm_notifications = not player.has_dm_notifications
+    record_event("notifications_toggled", chat_id=chat_id, user_id=user_id)
+    mark_dirty(chat_id, user_id)
     save_data_async()
     logger.debug(f"Настройки уведомлений изменены для {player.username}: {player.has_dm_notifications}")
 
@@ -1361,6 +4179,8 @@ async def callback_start_war(callback: CallbackQuery, state: FSMContext):
         await callback.answer("❌ Недостаточно игроков для войны!")
         return
 
+    settle_game_income(game)
+
     # Сохранение состояния и показ выбора цели
     await state.set_state(GameStates.waiting_for_war_target)
     await state.update_data(chat_id=chat_id, attacker_id=user_id)
@@ -1424,9 +4244,15 @@ async def callback_war_target(callback: CallbackQuery, state: FSMContext):
     target_country = COUNTRIES[target.country]
 
     # Немедленно сохраняем состояние игры
+    record_event("war_declared", chat_id=chat_id, attacker_id=attacker_id, target_id=target_id)
+    mark_dirty(chat_id)
     save_data_async()
     logger.info(f"Война объявлена: {attacker.username} vs {target.username}")
 
+    # Таймер начала войны (до рассылки: первый запрос к Telegram снимает блокировку чата)
+    war_scheduler.schedule(chat_id, "start", game.war_preparation_end_ts)
+    await state.clear()
+
     # Сообщение в чат для всех
     war_announcement = (
         f"⚔️ **ОБЪЯВЛЕНА ВОЙНА!** ⚔️\n\n"
@@ -1440,9 +4266,7 @@ async def callback_war_target(callback: CallbackQuery, state: FSMContext):
         f"Участники могут улучшать армию во время подготовки!"
     )
 
-    await callback.message.edit_text(war_announcement)
-
-    # Отправляем уведомления в ЛС только участникам
+    # Сообщение в чат и уведомления в ЛС только участникам отправляются параллельно
     attacker_message = (
         f"🎯 **Вы объявили войну!**\n\n"
         f"Вы атакуете {target_country.emoji} {target.username}\n"
@@ -1461,23 +4285,17 @@ async def callback_war_target(callback: CallbackQuery, state: FSMContext):
         f"Война начнется автоматически через {WAR_PREPARATION_TIME} секунд."
     )
 
+    sends = [(chat_id, partial(callback.message.edit_text, war_announcement))]
     if attacker.has_dm_notifications:
-        await send_dm_notification(attacker.user_id, attacker_message)
-
+        sends.append((attacker.user_id, partial(send_dm_notification, attacker.user_id, attacker_message)))
     if target.has_dm_notifications:
-        await send_dm_notification(target.user_id, target_message)
-
-    # Запуск таймера подготовки к войне
-    asyncio.create_task(war_preparation_countdown(chat_id))
-
-    await state.clear()
+        sends.append((target.user_id, partial(send_dm_notification, target.user_id, target_message)))
+    await fan_out(f"war_declared {chat_id}", sends)
 
 
-async def war_preparation_countdown(chat_id: int):
-    """Таймер подготовки к войне"""
+async def start_war(chat_id: int):
+    """Начало войны по окончании подготовки (вызывается war_scheduler)"""
     try:
-        await asyncio.sleep(WAR_PREPARATION_TIME)  # Ждем время подготовки
-
         if chat_id not in games:
             return
 
@@ -1487,6 +4305,7 @@ async def war_preparation_countdown(chat_id: int):
             game.war_preparation = False
             game.war_participants = []
             game.war_preparation_end = None
+            mark_dirty(chat_id)
             save_data_async()
             return
 
@@ -1494,7 +4313,10 @@ async def war_preparation_countdown(chat_id: int):
         game.war_preparation = False
         game.war_active = True
         game.war_start_time = datetime.now()
+        record_event("war_started", chat_id=chat_id)
+        mark_dirty(chat_id)
         save_data_async()  # Сохраняем изменение состояния
+        war_scheduler.schedule(chat_id, "finish", game.war_start_time_ts + WAR_DURATION)
 
         attacker_id = game.war_participants[0]
         target_id = game.war_participants[1]
@@ -1513,42 +4335,38 @@ async def war_preparation_countdown(chat_id: int):
             f"⚔️ **Текущие силы:**\n"
             f"• {attacker.username}: армия {attacker.army_level}\n"
             f"• {target.username}: армия {target.army_level}\n\n"
-            f"⏳ **Бой продлится 60 секунд...**"
+            f"⏳ **Бой продлится {WAR_DURATION} секунд...**"
         )
 
-        await bot.send_message(chat_id, war_start_message)
-
-        # Отправляем уведомления в ЛС только участникам
+        # Уведомления в ЛС только участникам
         war_start_dm = (
             f"⚔️ **ВОЙНА НАЧАЛАСЬ!**\n\n"
             f"Бой между {attacker.username} и {target.username} начался!\n"
-            f"⏳ **Длительность:** 60 секунд\n"
+            f"⏳ **Длительность:** {WAR_DURATION} секунд\n"
             f"💰 **Награда:** 15% казны проигравшего\n\n"
             f"Удачи в бою!"
         )
 
+        sends = [(chat_id, partial(send_notice, chat_id, war_start_message))]
         if attacker.has_dm_notifications:
-            await send_dm_notification(attacker.user_id, war_start_dm)
-
+            sends.append((attacker.user_id, partial(send_dm_notification, attacker.user_id, war_start_dm)))
         if target.has_dm_notifications:
-            await send_dm_notification(target.user_id, war_start_dm)
-
-        # Запуск таймера войны
-        asyncio.create_task(war_countdown(chat_id))
+            sends.append((target.user_id, partial(send_dm_notification, target.user_id, war_start_dm)))
+        await fan_out(f"war_started {chat_id}", sends)
 
     except Exception as e:
-        logger.error(f"Ошибка в war_preparation_countdown: {e}")
+        logger.error(f"Ошибка в start_war: {e}")
+        war_scheduler.unschedule(chat_id)
         if chat_id in games:
             games[chat_id].war_preparation = False
             games[chat_id].war_participants = []
+            mark_dirty(chat_id)
             save_data_async()
 
 
-async def war_countdown(chat_id: int):
-    """Таймер войны"""
+async def finish_war(chat_id: int):
+    """Окончание войны и подведение итогов (вызывается war_scheduler)"""
     try:
-        await asyncio.sleep(60)  # Война длится 60 секунд
-
         if chat_id not in games:
             return
 
@@ -1558,6 +4376,7 @@ async def war_countdown(chat_id: int):
             game.war_active = False
             game.war_participants = []
             game.war_start_time = None
+            mark_dirty(chat_id)
             save_data_async()
             return
 
@@ -1568,8 +4387,13 @@ async def war_countdown(chat_id: int):
         attacker = game.players[attacker_id]
         target = game.players[target_id]
 
-        attacker_power = attacker.army_level * (1 + 0.1 * attacker.city_level)
-        target_power = target.army_level * (1 + 0.1 * target.city_level)
+        # Начисляем доход до раздела добычи
+        now = datetime.now()
+        settle_income(attacker, now)
+        settle_income(target, now)
+
+        attacker_power = attacker.power
+        target_power = target.power
 
         # Добавление случайности (10%)
         attacker_power *= random.uniform(0.95, 1.05)
@@ -1640,13 +4464,14 @@ async def war_countdown(chat_id: int):
         game.last_war = datetime.now()
 
         # Сохраняем данные ПЕРЕД отправкой сообщений
+        record_event("war_result", chat_id=chat_id, winner_id=winner.user_id, loser_id=loser.user_id, loot=loot)
+        mark_dirty(chat_id)
+        mark_dirty(chat_id, winner.user_id)
+        mark_dirty(chat_id, loser.user_id)
         save_data_async()
         logger.info(f"Война окончена: победитель {winner.username}")
 
-        # Отправка результата в чат
-        await bot.send_message(chat_id, result_message)
-
-        # Отправка уведомлений в ЛС только участникам
+        # Результат в чат и уведомления в ЛС только участникам
         winner_message = (
             f"🎉 **ВЫ ПОБЕДИЛИ В ВОЙНЕ!**\n\n"
             f"Вы победили {COUNTRIES[loser.country].emoji} {loser.username}\n"
@@ -1663,17 +4488,19 @@ async def war_countdown(chat_id: int):
             f"Не отчаивайтесь! Улучшайте армию и попробуйте снова!"
         )
 
+        sends = [(chat_id, partial(send_notice, chat_id, result_message))]
         if winner.has_dm_notifications:
-            await send_dm_notification(winner.user_id, winner_message)
-
+            sends.append((winner.user_id, partial(send_dm_notification, winner.user_id, winner_message)))
         if loser.has_dm_notifications:
-            await send_dm_notification(loser.user_id, loser_message)
+            sends.append((loser.user_id, partial(send_dm_notification, loser.user_id, loser_message)))
+        await fan_out(f"war_result {chat_id}", sends)
 
     except Exception as e:
-        logger.error(f"Ошибка в war_countdown: {e}")
+        logger.error(f"Ошибка в finish_war: {e}")
         if chat_id in games:
             games[chat_id].war_active = False
             games[chat_id].war_participants = []
+            mark_dirty(chat_id)
             save_data_async()
 
 
@@ -1703,7 +4530,8 @@ async def cmd_start(message: Message):
             "/join - Присоединиться к игре\n"
             "/players - Список игроков\n"
             "/help - Помощь по игре\n"
-            "/taxinfo - Информация о налогах"
+            "/taxinfo - Информация о налогах\n"
+            "/globaltop - Общий рейтинг игроков"
         )
 
 
@@ -1722,6 +4550,8 @@ async def cmd_join(message: Message, state: FSMContext):
             chat_id=chat_id,
             creator_id=user_id
         )
+        record_event("game_created", chat_id=chat_id, creator_id=user_id)
+        mark_dirty(chat_id)
         save_data_async()  # Немедленно сохраняем новую игру
         logger.info(f"Создана новая игра в чате {chat_id}")
 
@@ -1770,6 +4600,8 @@ async def cmd_players(message: Message):
         await message.answer("👥 В игре пока нет игроков. Используйте /join чтобы присоединиться!")
         return
 
+    settle_game_income(game)
+
     text = "👥 **Список игроков:**\n\n"
     for i, (player_id, player) in enumerate(game.players.items(), 1):
         country = COUNTRIES[player.country]
@@ -1805,67 +4637,651 @@ async def cmd_help(message: Message):
         "/join - Присоединиться к игре\n"
         "/players - Список игроков\n"
         "/help - Эта справка\n"
-        "/taxinfo - Информация о налогах\n\n"
+        "/taxinfo - Информация о налогах\n"
+        "/globaltop [money|power|taxes] - Общий рейтинг игроков\n\n"
         "**Уведомления:**\n"
         "Уведомления о войнах приходят в ЛС. Можно отключить в настройках."
     )
     await message.answer(help_text)
 
 
+# Прием обновлений по webhook
+class WebhookReceiver:
+    """Прием обновлений Telegram по webhook (aiohttp)
+
+    Запрос проверяется по секретному токену, обновление обрабатывается в
+    фоновой задаче, а Telegram сразу получает ответ 200. В обработке
+    одновременно не больше max_concurrency обновлений: когда все слоты
+    заняты, новый запрос ждет свободного, и Telegram замедляет отправку.
+    """
+
+    def __init__(self, process_update: Any, secret: str, max_concurrency: int):
+        self.process_update = process_update
+        self.secret = secret
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._tasks: Set[asyncio.Task] = set()
+        self.received = 0  # Принятых обновлений
+        self.rejected = 0  # Запросов с неверным токеном или телом
+        self.failed = 0  # Обновлений, обработка которых завершилась ошибкой
+
+    def app(self, path: str) -> web.Application:
+        """aiohttp-приложение с единственным маршрутом webhook"""
+        application = web.Application()
+        application.router.add_post(path, self.handle)
+        return application
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if self.secret and not hmac.compare_digest(token, self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+
+        try:
+            update = json_loads(await request.read())
+        except JSON_DECODE_ERRORS:
+            self.rejected += 1
+            return web.Response(status=400)
+
+        await self._slots.acquire()
+        self.received += 1
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Dict[str, Any]):
+        try:
+            await self.process_update(update)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+        finally:
+            self._slots.release()
+
+    async def drain(self):
+        """Дождаться обработки всех принятых обновлений"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def serve_webhook(bot_instance: Bot, process_update: Any):
+    """Запустить webhook-сервер, зарегистрировать адрес в Telegram и работать до отмены
+
+    Без секретного токена адрес принимал бы обновления от кого угодно,
+    поэтому при пустом WEBHOOK_SECRET генерируется случайный токен: он
+    передается в set_webhook и действует до перезапуска.
+    """
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET не задан: используется случайный секретный токен до перезапуска")
+    receiver = WebhookReceiver(process_update, secret, WEBHOOK_MAX_CONCURRENCY)
+    runner = web.AppRunner(receiver.app(WEBHOOK_PATH))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot_instance.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100)
+        )
+        logger.info(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await receiver.drain()
+        logger.info(
+            f"Webhook остановлен: принято {receiver.received}, отклонено {receiver.rejected}, "
+            f"ошибок {receiver.failed}"
+        )
+
+
+# Шардирование по чатам
+def shard_of(chat_id: int, shard_count: int) -> int:
+    """Номер шарда, которому принадлежит чат"""
+    return chat_id % shard_count
+
+
+def update_shard(update: Dict[str, Any], shard_count: int) -> int:
+    """Номер шарда для сырого обновления Telegram
+
+    Обновления групп уходят шарду чата. Личные сообщения и команды
+    промокодов обрабатывает PROMOCODE_SHARD, которому принадлежат промокоды.
+    """
+    callback = update.get("callback_query")
+    message = callback.get("message") if callback else update.get("message") or update.get("edited_message")
+    if not message:
+        return PROMOCODE_SHARD
+
+    chat = message["chat"]
+    if chat["type"] == "private":
+        return PROMOCODE_SHARD
+
+    if not callback:
+        command = (message.get("text") or "").split(maxsplit=1)[:1]
+        if command and command[0].split("@")[0].lower() in PROMOCODE_COMMANDS:
+            return PROMOCODE_SHARD
+    return shard_of(chat["id"], shard_count)
+
+
+def shard_file(path: str, shard_id: int) -> str:
+    """Имя файла данных шарда: games_data.json -> games_data.shard1.json"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard_id}{ext}"
+
+
+def configure_shard(shard_id: int, shard_count: int):
+    """Переключить процесс на собственные файлы данных шарда
+
+    Если у шарда еще нет файла игр, его чаты переносятся из общего
+    games_data.json или games_data.db (первый запуск после включения
+    шардирования). Глобальный лимит отправки делится между шардами (shard_limit).
+    """
+    global GAMES_FILE, PROMOCODES_FILE, SQLITE_FILE, EVENT_LOG_FILE, storage, promocodes
+
+    # Группа целиком принадлежит одному шарду, поэтому лимиты чата и группы не меняются.
+    # Личные сообщения одному игроку могут идти из нескольких шардов: их лимит
+    # соблюдается только в пределах шарда, а превышение обрабатывается повтором после 429
+    send_queue.global_limiter = RateLimiter(*shard_limit(SEND_LIMIT_GLOBAL, shard_count))
+
+    unsharded_games_file = GAMES_FILE
+    unsharded_sqlite_file = SQLITE_FILE
+    GAMES_FILE = shard_file(GAMES_FILE, shard_id)
+    SQLITE_FILE = shard_file(SQLITE_FILE, shard_id)
+    EVENT_LOG_FILE = shard_file(EVENT_LOG_FILE, shard_id)
+    if shard_id != PROMOCODE_SHARD:
+        PROMOCODES_FILE = shard_file(PROMOCODES_FILE, shard_id)
+    storage = create_storage(STORAGE_BACKEND)
+
+    if STORAGE_BACKEND == "sqlite":
+        data_file, source_file = SQLITE_FILE, unsharded_sqlite_file
+    else:
+        data_file, source_file = GAMES_FILE, unsharded_games_file
+    if os.path.exists(data_file) or not os.path.exists(source_file):
+        return
+
+    if STORAGE_BACKEND == "sqlite":
+        source = SqliteStorage(source_file)
+        try:
+            games_data, promocodes_data = source.load_shard(shard_id, shard_count)
+        finally:
+            source.close()
+        rows = games_data.items()
+        if shard_id == PROMOCODE_SHARD:
+            # Промокоды лежат в той же базе, а не в общем promocodes.json
+            promocodes = {code: promocode_from_row(code, promo_data) for code, promo_data in promocodes_data.items()}
+            for code in promocodes:
+                mark_promocode_dirty(code)
+    else:
+        rows = iter_json_object(source_file)
+
+    moved = 0
+    for chat_id_str, game_data in rows:
+        chat_id = int(chat_id_str)
+        if shard_of(chat_id, shard_count) != shard_id:
+            continue
+        games[chat_id] = game_from_row(chat_id, game_data)
+        mark_dirty(chat_id)
+        for user_id in games[chat_id].players:
+            mark_dirty(chat_id, user_id)
+        moved += 1
+    save_data()
+    logger.info(f"Шард {shard_id}: перенесено {moved} игр из {source_file}")
+
+
+class ShardLink:
+    """Связь процесса-шарда с остальными шардами
+
+    Все шарды знают входящие очереди друг друга. request_all рассылает
+    запрос остальным шардам и ждет ответов всех (иначе asyncio.TimeoutError
+    через SHARD_REQUEST_TIMEOUT), send_all рассылает сообщение без ответа.
+    """
+
+    def __init__(self, shard_id: int, inboxes: List[Any]):
+        self.shard_id = shard_id
+        self.inboxes = inboxes
+        self._next_request = 0
+        self._pending: Dict[int, Tuple[asyncio.Future, List[Any], int]] = {}
+
+    async def request_all(self, kind: str, **fields: Any) -> List[Any]:
+        """Отправить запрос всем остальным шардам и вернуть их ответы"""
+        others = [shard_id for shard_id in range(len(self.inboxes)) if shard_id != self.shard_id]
+        if not others:
+            return []
+
+        self._next_request += 1
+        request_id = self._next_request
+        future = asyncio.get_running_loop().create_future()
+        results: List[Any] = []
+        self._pending[request_id] = (future, results, len(others))
+        for shard_id in others:
+            self.inboxes[shard_id].put((kind, {"request_id": request_id, "reply_to": self.shard_id, **fields}))
+
+        try:
+            return await asyncio.wait_for(future, SHARD_REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Неполные ответы не выдаются за результат: молчащий шард мог не успеть ответить
+            logger.error(f"Шард {self.shard_id}: ответили {len(results)} из {len(others)} шардов на {kind}")
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    def send_all(self, kind: str, **fields: Any):
+        """Отправить сообщение всем остальным шардам, не дожидаясь ответа"""
+        for shard_id in range(len(self.inboxes)):
+            if shard_id != self.shard_id:
+                self.inboxes[shard_id].put((kind, {"reply_to": self.shard_id, **fields}))
+
+    def reply(self, request: Dict[str, Any], result: Any):
+        """Ответить шарду, приславшему запрос"""
+        self.inboxes[request["reply_to"]].put(("reply", {"request_id": request["request_id"], "result": result}))
+
+    def resolve(self, response: Dict[str, Any]):
+        """Принять ответ другого шарда"""
+        pending = self._pending.get(response["request_id"])
+        if pending is None:
+            return
+        future, results, expected = pending
+        results.append(response["result"])
+        if len(results) == expected and not future.done():
+            future.set_result(list(results))
+
+
+async def reserve_promocode_locally(request: Dict[str, Any]) -> int:
+    """Первая фаза награды в другом шарде: запомнить игры игрока, ничего не начисляя
+
+    Возвращает число игр. Деньги начисляет только promocode_commit, поэтому
+    таймаут или отказ шарда промокодов не оставляет начисленной награды.
+    """
+    await wait_games_restored()
+    now = time.monotonic()
+    for key, (_, reserved_at) in list(promocode_reservations.items()):
+        if now - reserved_at > PROMOCODE_RESERVATION_TTL:
+            del promocode_reservations[key]
+
+    chat_ids = player_index.chats_of(request["user_id"])
+    if chat_ids:
+        promocode_reservations[(request["code"], request["user_id"])] = (chat_ids, now)
+    return len(chat_ids)
+
+
+def rollback_promocode_locally(request: Dict[str, Any]):
+    """Отменить резервирование, если промокод не был использован"""
+    promocode_reservations.pop((request["code"], request["user_id"]), None)
+
+
+async def reward_promocode_locally(request: Dict[str, Any]) -> int:
+    """Вторая фаза: начислить награду в зарезервированных играх игрока в этом шарде"""
+    user_id = request["user_id"]
+    reservation = promocode_reservations.pop((request["code"], user_id), None)
+    if reservation is None:
+        # Резервирование устарело, а использование уже засчитано: награждаем по текущим играм
+        logger.warning(f"Нет резервирования промокода {request['code']} для {user_id}")
+        await wait_games_restored()
+        chat_ids = player_index.chats_of(user_id)
+    else:
+        chat_ids = reservation[0]
+    async with chat_locks.hold(*chat_ids):
+        # Между фазами игрок мог покинуть игру, а игра — закончиться
+        player_games = [(chat_id, games[chat_id]) for chat_id in chat_ids
+                        if chat_id in games and user_id in games[chat_id].players]
+        for chat_id, game in player_games:
+            player = game.players[user_id]
+            settle_income(player)
+            player.money += request["reward"]
+            mark_dirty(chat_id, user_id)
+
+    if player_games:
+        record_event("promocode_rewarded", code=request["code"], user_id=user_id, reward=request["reward"])
+        save_data_async()
+        await fan_out(f"promocode {request['code']}", [
+            (chat_id, partial(announce_promocode, chat_id, game.players[user_id], request["code"], request["reward"]))
+            for chat_id, game in player_games
+        ])
+    return len(player_games)
+
+
+async def handle_shard_message(dp: Dispatcher, kind: str, payload: Dict[str, Any]):
+    """Обработать одно сообщение из входящей очереди шарда"""
+    try:
+        if kind == "update":
+            await dp.feed_raw_update(bot, payload)
+        elif kind == "promocode_reserve":
+            # Отвечаем даже при ошибке, чтобы шард промокодов не ждал таймаута
+            reserved = 0
+            try:
+                reserved = await reserve_promocode_locally(payload)
+            finally:
+                shard_link.reply(payload, reserved)
+        elif kind == "promocode_commit":
+            await reward_promocode_locally(payload)
+        elif kind == "promocode_rollback":
+            rollback_promocode_locally(payload)
+        else:
+            logger.warning(f"Неизвестное сообщение шарда: {kind}")
+    except Exception as e:
+        logger.error(f"Ошибка обработки {kind} в шарде: {e}")
+
+
+def prepare_game_data():
+    """Загрузить данные и догнать доход и налоги за время простоя"""
+    logger.info("Загрузка данных...")
+    load_data()
+
+    started = time.perf_counter()
+    collected = run_economy_pass()
+    logger.info(
+        f"Экономика пересчитана: "
+        f"собрано налогов {collected}, {time.perf_counter() - started:.2f} сек"
+    )
+    save_data_async()
+
+
+async def restore_cold_games():
+    """Фоновое восстановление игр, к которым еще не обращались, по RESTORE_SLICE за шаг"""
+    if not games.cold_count:
+        return
+
+    started = time.perf_counter()
+    restored = 0
+    while games.cold_count and not is_shutting_down:
+        batch = games.restore(games.cold_ids(RESTORE_SLICE))
+        restored += len(batch)
+        if batch:
+            save_data_async()
+        await asyncio.sleep(RESTORE_PAUSE)
+    logger.info(
+        f"В фоне восстановлено {restored} игр, всего {len(games)} игр, "
+        f"{sum(len(g.players) for g in games.values())} игроков за {time.perf_counter() - started:.2f} сек"
+    )
+
+
+async def evict_idle_games():
+    """Фоновая выгрузка из памяти игр, к которым давно не обращались
+
+    Раз в EVICT_INTERVAL выгружаются игры без обновлений дольше GAME_IDLE_TTL
+    и самые давние сверх GAMES_HOT_LIMIT (evict_games). Пока идет запись,
+    выгрузка откладывается: хранилище еще может не видеть последних изменений.
+    """
+    if not GAME_IDLE_TTL and not GAMES_HOT_LIMIT:
+        return
+
+    while not is_shutting_down:
+        await asyncio.sleep(EVICT_INTERVAL)
+        try:
+            started = time.perf_counter()
+            idle_before = time.monotonic() - GAME_IDLE_TTL if GAME_IDLE_TTL else float("-inf")
+            candidates = games.idle_ids(idle_before, GAMES_HOT_LIMIT)
+            pinned = leaderboards.chat_ids()
+            evicted = 0
+            for start in range(0, len(candidates), EVICT_SLICE):
+                if save_coordinator.writing:
+                    break
+                evicted += evict_games(candidates[start:start + EVICT_SLICE], pinned)
+                await asyncio.sleep(RESTORE_PAUSE)
+            if evicted:
+                logger.info(
+                    f"Выгружено {evicted} игр за {time.perf_counter() - started:.2f} сек: "
+                    f"в памяти {len(games)}, выгружено всего {games.evicted_count}"
+                )
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки игр: {e}")
+
+
+async def wait_games_restored():
+    """Дождаться восстановления всех игр (нужно операциям по всем чатам игрока)"""
+    while games.cold_count:
+        await asyncio.sleep(0.05)
+
+
+async def run_shard_worker(shard_id: int, shard_count: int, inboxes: List[Any], outbox: Any,
+                           bot_factory: Optional[Any] = None):
+    """Цикл процесса-шарда: свои игры, свое хранилище, обновления из очереди"""
+    global bot, shard_link
+
+    if games or promocodes:
+        raise RuntimeError("Шард должен запускаться в чистом процессе")
+    configure_shard(shard_id, shard_count)
+    prepare_game_data()
+    bot = bot_factory() if bot_factory else Bot(token=TOKEN)
+    bot.session.middleware(release_chat_lock_middleware)
+    bot.session.middleware(send_queue)
+    dp = build_dispatcher()
+    shard_link = ShardLink(shard_id, inboxes)
+    background = [
+        asyncio.create_task(auto_save_data()),
+        asyncio.create_task(update_income_and_taxes()),
+        asyncio.create_task(war_scheduler.run()),
+        asyncio.create_task(leaderboards.run()),
+        asyncio.create_task(restore_cold_games()),
+        asyncio.create_task(evict_idle_games())
+    ]
+    if isinstance(dp.storage, SqliteFsmStorage):
+        background.append(asyncio.create_task(dp.storage.run()))
+    if metrics.enabled:
+        background.append(asyncio.create_task(serve_metrics(METRICS_PORT + 1 + shard_id)))
+
+    # Блокирующее чтение multiprocessing-очереди идет в отдельном потоке
+    loop = asyncio.get_running_loop()
+    messages: asyncio.Queue = asyncio.Queue()
+
+    def read_inbox():
+        while True:
+            item = inboxes[shard_id].get()
+            loop.call_soon_threadsafe(messages.put_nowait, item)
+            if item[0] == "stop":
+                return
+
+    threading.Thread(target=read_inbox, name=f"shard-{shard_id}-inbox", daemon=True).start()
+    outbox.put(("ready", {"shard_id": shard_id, "games": len(games)}))
+    logger.info(f"Шард {shard_id}/{shard_count} запущен: {len(games)} игр")
+
+    in_flight: Set[asyncio.Task] = set()
+    updates = 0
+    while True:
+        kind, payload = await messages.get()
+        if kind == "stop":
+            break
+        if kind == "reply":
+            shard_link.resolve(payload)
+            continue
+        if kind == "update":
+            updates += 1
+        task = asyncio.create_task(handle_shard_message(dp, kind, payload))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    # Дорабатываем начатые обновления и сохраняем данные шарда
+    if in_flight:
+        await asyncio.gather(*in_flight, return_exceptions=True)
+    for task in background:
+        task.cancel()
+    await save_coordinator.flush()
+    storage.close()
+    await dp.storage.close()
+    await bot.session.close()
+    outbox.put(("stopped", {"shard_id": shard_id, "updates": updates}))
+    logger.info(f"Шард {shard_id} остановлен: обработано {updates} обновлений")
+
+
+def shard_worker_main(shard_id: int, shard_count: int, inboxes: List[Any], outbox: Any,
+                      bot_factory: Optional[Any] = None):
+    """Точка входа процесса-шарда (останавливается сообщением "stop" от маршрутизатора)"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(run_shard_worker(shard_id, shard_count, inboxes, outbox, bot_factory))
+
+
+def start_shards(shard_count: int, bot_factory: Optional[Any] = None) -> Tuple[List[Any], Any, List[Any]]:
+    """Запустить процессы-шарды и дождаться их готовности
+
+    Возвращает (входящие очереди шардов, общую очередь ответов, процессы).
+    """
+    context = multiprocessing.get_context("spawn")
+    inboxes = [context.Queue() for _ in range(shard_count)]
+    outbox = context.Queue()
+    workers = [
+        context.Process(
+            target=shard_worker_main,
+            args=(shard_id, shard_count, inboxes, outbox, bot_factory),
+            name=f"shard-{shard_id}",
+            daemon=True
+        )
+        for shard_id in range(shard_count)
+    ]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        kind, payload = outbox.get()
+        logger.info(f"Шард {payload['shard_id']}: {kind}")
+    return inboxes, outbox, workers
+
+
+def stop_shards(inboxes: List[Any], outbox: Any, workers: List[Any]) -> List[Dict[str, Any]]:
+    """Остановить шарды после обработки уже отправленных обновлений"""
+    for inbox in inboxes:
+        inbox.put(("stop", None))
+
+    stats = []
+    deadline = time.monotonic() + SHARD_STOP_TIMEOUT
+    while len(stats) < len(workers) and time.monotonic() < deadline:
+        try:
+            kind, payload = outbox.get(timeout=max(deadline - time.monotonic(), 0.1))
+        except Exception:
+            break
+        if kind == "stopped":
+            stats.append(payload)
+
+    for worker in workers:
+        worker.join(timeout=max(deadline - time.monotonic(), 1))
+        if worker.is_alive():
+            logger.error(f"Процесс {worker.name} не остановился, завершаем принудительно")
+            worker.terminate()
+    return stats
+
+
+async def run_shard_router(shard_count: int):
+    """Процесс-маршрутизатор: получает обновления и раздает их шардам"""
+    inboxes, outbox, workers = start_shards(shard_count)
+    router_bot = Bot(token=TOKEN)
+
+    async def route(update: Dict[str, Any]):
+        inboxes[update_shard(update, shard_count)].put(("update", update))
+
+    async def poll_updates():
+        await router_bot.delete_webhook()
+        offset = None
+        while True:
+            try:
+                updates = await router_bot.get_updates(offset=offset, timeout=SHARD_POLLING_TIMEOUT)
+            except Exception as e:
+                logger.error(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(5)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                await route(update.dict(by_alias=True, exclude_none=True))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    poller = asyncio.create_task(serve_webhook(router_bot, route) if WEBHOOK_URL else poll_updates())
+    logger.info(f"Бот запущен с {shard_count} шардами!")
+    try:
+        await stop.wait()
+    finally:
+        poller.cancel()
+        logger.info("Остановка шардов...")
+        stats = await asyncio.to_thread(stop_shards, inboxes, outbox, workers)
+        await router_bot.session.close()
+        logger.info(f"Шарды остановлены: {stats}")
+
+
+def build_dispatcher() -> Dispatcher:
+    """Создать диспетчер со всеми обработчиками"""
+    dp = Dispatcher(storage=create_fsm_storage(FSM_STORAGE))
+    dp.update.outer_middleware(chat_lock_middleware)
+    if metrics.enabled:
+        dp.message.middleware(handler_metrics_middleware)
+        dp.callback_query.middleware(handler_metrics_middleware)
+
+    # Регистрация обработчиков команд
+    dp.message.register(cmd_start, Command("start"))
+    dp.message.register(cmd_join, Command("join"))
+    dp.message.register(cmd_players, Command("players"))
+    dp.message.register(cmd_help, Command("help"))
+    dp.message.register(cmd_taxinfo, Command("taxinfo"))
+    dp.message.register(cmd_globaltop, Command("globaltop"))
+    dp.message.register(cmd_promocode, Command("promocode"))
+    dp.message.register(cmd_create_promo, Command("createpromo"))
+    dp.message.register(cmd_delete_promo, Command("deletepromo"))
+    dp.message.register(cmd_list_promos, Command("listpromos"))
+    dp.message.register(cmd_toggle_promo, Command("togglepromo"))
+
+    # Регистрация обработчиков callback-запросов
+    dp.callback_query.register(callback_country_selection, F.data.startswith("country_"))
+    dp.callback_query.register(callback_stats, F.data.startswith("stats_"))
+    dp.callback_query.register(callback_upgrade_army, F.data.startswith("upgrade_army_"))
+    dp.callback_query.register(callback_upgrade_city, F.data.startswith("upgrade_city_"))
+    dp.callback_query.register(callback_top, F.data.startswith("top_"))
+    dp.callback_query.register(callback_settings, F.data.startswith("settings_"))
+    dp.callback_query.register(callback_toggle_notifications, F.data.startswith("toggle_notifications_"))
+    dp.callback_query.register(callback_start_war, F.data.startswith("start_war_"))
+    dp.callback_query.register(callback_war_target, F.data.startswith("wartarget_"))
+    dp.callback_query.register(callback_refresh, F.data.startswith("refresh_"))
+    dp.callback_query.register(callback_taxes, F.data.startswith("taxes_"))
+    dp.callback_query.register(callback_treasury, F.data.startswith("treasury_"))
+    dp.callback_query.register(callback_promocode, F.data.startswith("promocode_"))
+    return dp
+
+
 # Основная функция
 async def main():
     """Основная функция запуска бота"""
-    global bot
+    global bot, dispatcher
+
+    if SHARD_COUNT > 1:
+        # Игры распределены по процессам-шардам, здесь только маршрутизация
+        await run_shard_router(SHARD_COUNT)
+        return
 
     # Настройка обработчиков сигналов
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
     try:
-        # Загрузка данных
-        logger.info("Загрузка данных...")
-        load_data()
+        prepare_game_data()
 
         # Инициализация бота
         bot = Bot(token=TOKEN)
-        storage = MemoryStorage()
-        dp = Dispatcher(storage=storage)
-
-        # Регистрация обработчиков команд
-        dp.message.register(cmd_start, Command("start"))
-        dp.message.register(cmd_join, Command("join"))
-        dp.message.register(cmd_players, Command("players"))
-        dp.message.register(cmd_help, Command("help"))
-        dp.message.register(cmd_taxinfo, Command("taxinfo"))
-        dp.message.register(cmd_promocode, Command("promocode"))
-        dp.message.register(cmd_create_promo, Command("createpromo"))
-        dp.message.register(cmd_delete_promo, Command("deletepromo"))
-        dp.message.register(cmd_list_promos, Command("listpromos"))
-        dp.message.register(cmd_toggle_promo, Command("togglepromo"))
-
-        # Регистрация обработчиков callback-запросов
-        dp.callback_query.register(callback_country_selection, F.data.startswith("country_"))
-        dp.callback_query.register(callback_stats, F.data.startswith("stats_"))
-        dp.callback_query.register(callback_upgrade_army, F.data.startswith("upgrade_army_"))
-        dp.callback_query.register(callback_upgrade_city, F.data.startswith("upgrade_city_"))
-        dp.callback_query.register(callback_top, F.data.startswith("top_"))
-        dp.callback_query.register(callback_settings, F.data.startswith("settings_"))
-        dp.callback_query.register(callback_toggle_notifications, F.data.startswith("toggle_notifications_"))
-        dp.callback_query.register(callback_start_war, F.data.startswith("start_war_"))
-        dp.callback_query.register(callback_war_target, F.data.startswith("wartarget_"))
-        dp.callback_query.register(callback_refresh, F.data.startswith("refresh_"))
-        dp.callback_query.register(callback_taxes, F.data.startswith("taxes_"))
-        dp.callback_query.register(callback_treasury, F.data.startswith("treasury_"))
-        dp.callback_query.register(callback_promocode, F.data.startswith("promocode_"))
+        bot.session.middleware(release_chat_lock_middleware)
+        bot.session.middleware(send_queue)
+        dispatcher = dp = build_dispatcher()
 
         # Запуск фоновых задач
         logger.info("Запуск фоновых задач...")
         asyncio.create_task(auto_save_data())
         asyncio.create_task(update_income_and_taxes())
+        asyncio.create_task(war_scheduler.run())
+        asyncio.create_task(leaderboards.run())
+        asyncio.create_task(restore_cold_games())
+        asyncio.create_task(evict_idle_games())
+        if isinstance(dp.storage, SqliteFsmStorage):
+            asyncio.create_task(dp.storage.run())
+        if metrics.enabled:
+            asyncio.create_task(serve_metrics(METRICS_PORT))
 
         # Запуск бота
-        logger.info("Бот запущен!")
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            logger.info("Бот запущен (webhook)!")
+            await serve_webhook(bot, lambda update: dp.feed_raw_update(bot, update))
+        else:
+            logger.info("Бот запущен!")
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
 
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске бота: {e}")
@@ -1876,6 +5292,10 @@ if __name__ == "__main__":
     # Простой запуск для Render
     import os
 
+    if "--migrate-to-sqlite" in sys.argv:
+        # Одноразовый перенос games_data.json/promocodes.json в SQLite
+        sys.exit(0 if migrate_json_to_sqlite() else 1)
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt: